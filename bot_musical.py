@@ -1,11 +1,32 @@
 import os
+import copy
+import hashlib
+import heapq
+import hmac
+import json
+import sqlite3
 import logging
+import re
+import math
+import time
 import asyncio
+import contextvars
+import signal
+import secrets
+import shutil
+import subprocess
+import sys
+import unicodedata
+import urllib.parse
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from telegram.error import TelegramError, NetworkError, TimedOut
+from telegram.ext import Application, BaseRateLimiter, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.error import TelegramError, NetworkError, TimedOut, BadRequest, RetryAfter
 import yt_dlp
 
 # Configuración de logging
@@ -21,6 +42,201 @@ TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not TOKEN:
     raise ValueError("❌ TELEGRAM_BOT_TOKEN no está configurado en las variables de entorno")
 
+# Búsquedas: workers en paralelo y cuántas pueden esperar en cola
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', '4'))
+SEARCH_QUEUE_MAX = int(os.getenv('SEARCH_QUEUE_MAX', '32'))
+
+# Variantes de discografía/álbumes consultadas en paralelo por búsqueda
+SEARCH_FANOUT = int(os.getenv('SEARCH_FANOUT', '3'))
+
+# Cache de resultados de búsqueda: vigencia y total de resultados guardados
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', '900'))
+SEARCH_CACHE_MAX_RESULTS = int(os.getenv('SEARCH_CACHE_MAX_RESULTS', '20000'))
+
+# Paginado perezoso: se muestra la primera página apenas llega y el resto de
+# los resultados se busca en segundo plano (o al pedir la página siguiente)
+SEARCH_LAZY_PAGING = os.getenv('SEARCH_LAZY_PAGING', 'true').lower() in ('1', 'true', 'yes')
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_RESULTS = 100
+# Cada cuántos segundos se re-dibuja el mensaje mientras llegan resultados
+SEARCH_PROGRESS_INTERVAL = float(os.getenv('SEARCH_PROGRESS_INTERVAL', '1.0'))
+
+# Rate limiting: fichas por usuario y globales por minuto, y costo de cada operación
+RATE_LIMIT_PER_MINUTE = int(os.getenv('RATE_LIMIT_PER_MINUTE', '20'))
+RATE_LIMIT_GLOBAL_PER_MINUTE = int(os.getenv('RATE_LIMIT_GLOBAL_PER_MINUTE', '600'))
+OPERATION_COSTS = {
+    'search': 1,
+    'discography': 5,  # una consulta por variante
+    'albums': 4,
+    'download': 3,  # descarga + conversión a MP3
+}
+
+# Sesiones en memoria: máximo de usuarios, inactividad tolerada y frecuencia de limpieza
+SESSION_MAX_USERS = int(os.getenv('SESSION_MAX_USERS', '10000'))
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '1800'))
+PLAYLIST_MAX_USERS = int(os.getenv('PLAYLIST_MAX_USERS', '50000'))
+PLAYLIST_IDLE_TTL = float(os.getenv('PLAYLIST_IDLE_TTL', str(7 * 24 * 3600)))
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', '60'))
+
+# Descargas: un proceso por núcleo, cola máxima y timeout por trabajo
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', str(os.cpu_count() or 1)))
+DOWNLOAD_QUEUE_MAX = int(os.getenv('DOWNLOAD_QUEUE_MAX', '16'))
+DOWNLOAD_TIMEOUT = float(os.getenv('DOWNLOAD_TIMEOUT', '120'))
+
+# Prefetch: al abrir el detalle de un tema se empieza a preparar el audio en
+# segundo plano, solo si hay procesos libres y sin pasar estos límites
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+PREFETCH_PER_USER = int(os.getenv('PREFETCH_PER_USER', '1'))
+PREFETCH_MAX_GLOBAL = int(os.getenv('PREFETCH_MAX_GLOBAL', str(max(1, DOWNLOAD_WORKERS // 2))))
+
+# 'direct': FFmpeg lee el audio de la red y lo convierte en una sola pasada, sin
+# el archivo intermedio de yt-dlp; 'file': yt-dlp descarga y convierte en disco.
+# En los dos modos el worker deja un único archivo terminado y el proceso
+# principal lo adopta en la cache de disco: el audio no viaja por el pipe del
+# worker ni se sube en vivo, así un reintento del envío o el próximo pedido
+# del mismo tema lo reutilizan. Si la conversión directa no es posible
+# (formato fragmentado, audio muy grande) se usa 'file'. 'stream' es el
+# nombre anterior de 'direct'.
+DOWNLOAD_MODE = os.getenv('DOWNLOAD_MODE', 'direct').lower()
+if DOWNLOAD_MODE == 'stream':
+    DOWNLOAD_MODE = 'direct'
+# Tope por descarga en modo direct (Telegram no acepta audios de más de 50 MB)
+STREAM_MAX_BYTES = int(os.getenv('STREAM_MAX_BYTES', str(50 * 1024 * 1024)))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Progreso de descargas: cada cuánto el worker lo informa y cada cuánto se edita el mensaje
+# (Telegram limita las ediciones por chat, así que se agrupan)
+DOWNLOAD_PROGRESS_REPORT_INTERVAL = 0.5
+DOWNLOAD_PROGRESS_INTERVAL = float(os.getenv('DOWNLOAD_PROGRESS_INTERVAL', '3'))
+
+# Carpeta de datos persistentes (cache de file_id de Telegram, etc.)
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+
+# Dónde vive el estado: 'sqlite' (local, persistente), 'memory' (local, volátil)
+# o 'redis' (servidor clave-valor compartido por varias réplicas del bot)
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite').lower()
+STATE_URL = os.getenv('STATE_URL', 'redis://localhost:6379/0')
+KV_POOL_SIZE = int(os.getenv('KV_POOL_SIZE', '8'))
+
+# Base SQLite (WAL) con playlists y sesiones de búsqueda; cada cuánto se escriben los cambios
+STORAGE_PATH = os.getenv('STORAGE_PATH', os.path.join(DATA_DIR, 'bot.db'))
+STORAGE_FLUSH_INTERVAL = float(os.getenv('STORAGE_FLUSH_INTERVAL', '0.5'))
+
+# Cache en disco de audios ya convertidos, por video y perfil (0 la desactiva)
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', os.path.join(DATA_DIR, 'audio'))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+
+# Calidad MP3 de las descargas (forma parte de la clave de cache)
+AUDIO_QUALITY = '192'
+
+# Instancias de YoutubeDL reutilizables: se reciclan tras N usos o M segundos
+YDL_MAX_USES = int(os.getenv('YDL_MAX_USES', '50'))
+YDL_MAX_AGE = float(os.getenv('YDL_MAX_AGE', '1800'))
+
+# Opciones de yt-dlp para búsquedas (sin descargar, solo metadatos)
+SEARCH_YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': True,
+    'socket_timeout': 30,
+    'extractor_args': {'youtube': {'skip': ['hls', 'dash']}},
+    'no_check_certificate': True,
+    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+}
+
+# Opciones de yt-dlp para descargas; el outtmpl se asigna en cada trabajo
+DOWNLOAD_YDL_OPTS = {
+    'format': 'bestaudio/best',
+    'postprocessors': [{
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': 'mp3',
+        'preferredquality': AUDIO_QUALITY,
+    }],
+    # El progreso se informa por hooks al mensaje del usuario; los errores llegan al logger
+    'quiet': True,
+    'no_warnings': True,
+    'noprogress': True,
+    'max_filesize': 50 * 1024 * 1024,
+    'socket_timeout': 60,
+    'no_check_certificate': True,
+    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'http_headers': {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    },
+}
+
+# Opciones para entregar el AAC original: se prefiere una pista mp4a y
+# FFmpegExtractAudio la copia al contenedor m4a sin recodificar
+REMUX_YDL_OPTS = dict(
+    DOWNLOAD_YDL_OPTS,
+    format='bestaudio[acodec^=mp4a]/bestaudio/best',
+    postprocessors=[{'key': 'FFmpegExtractAudio', 'preferredcodec': 'm4a'}],
+)
+
+# Perfiles de entrega. 'mp3' recodifica (máxima compatibilidad); 'm4a' copia el
+# audio AAC tal como viene de YouTube, casi sin CPU. AUDIO_PROFILE elige el
+# perfil del botón "Reproducir"; "Descargar" siempre entrega MP3.
+# cache_key separa los file_id de cada perfil (el de MP3 se mantiene como antes).
+AUDIO_PROFILES = {
+    'mp3': {'ext': 'mp3', 'label': 'MP3 HD', 'cache_key': AUDIO_QUALITY, 'ydl_opts': DOWNLOAD_YDL_OPTS},
+    'm4a': {'ext': 'm4a', 'label': 'M4A original', 'cache_key': 'm4a', 'ydl_opts': REMUX_YDL_OPTS},
+}
+AUDIO_PROFILE = os.getenv('AUDIO_PROFILE', 'mp3').lower()
+if AUDIO_PROFILE not in AUDIO_PROFILES:
+    AUDIO_PROFILE = 'mp3'
+
+# Updates que PTB procesa a la vez (una búsqueda lenta no bloquea a los demás)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Solo se piden a Telegram los tipos de update que el bot maneja
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+DROP_PENDING_UPDATES = os.getenv('DROP_PENDING_UPDATES', 'false').lower() in ('1', 'true', 'yes')
+
+# Modo webhook: se activa definiendo WEBHOOK_URL (URL pública, sin la ruta)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_QUEUE_MAX = int(os.getenv('WEBHOOK_QUEUE_MAX', '1000'))
+
+# Envíos a Telegram: mensajes por segundo en total y por chat (la Bot API
+# responde RetryAfter por encima de ~30/s, ~1/s por chat y 20/min por grupo)
+OUTBOUND_PER_SECOND = float(os.getenv('OUTBOUND_PER_SECOND', '30'))
+OUTBOUND_CHAT_PER_SECOND = float(os.getenv('OUTBOUND_CHAT_PER_SECOND', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv('OUTBOUND_GROUP_PER_MINUTE', '20'))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+# Fracción de los límites de Telegram que se usa de verdad: el margen absorbe la
+# diferencia entre cuándo sale un envío y cuándo lo cuenta el servidor
+OUTBOUND_HEADROOM = float(os.getenv('OUTBOUND_HEADROOM', '0.9'))
+
+# Métricas para Prometheus en GET /metrics (0 = desactivado)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '0.0.0.0')
+# Límites en segundos de los histogramas de latencia
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Trazas por update: se loguea el desglose de los que tardan más de TRACE_SLOW_SECONDS
+# (0 = nunca); PROFILE_SLOW_UPDATES además guarda sus pilas más frecuentes en PROFILE_DIR
+TRACE_SLOW_SECONDS = float(os.getenv('TRACE_SLOW_SECONDS', '3'))
+PROFILE_SLOW_UPDATES = os.getenv('PROFILE_SLOW_UPDATES', 'false').lower() in ('1', 'true', 'yes')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(DATA_DIR, 'profiles'))
+# Rutas de botones que se usan como etiqueta de métricas; cualquier otro
+# callback_data (lo manda el cliente) se cuenta como 'other'
+SEARCH_TYPES = ('normal', 'songs', 'karaoke', 'discography', 'albums', 'playlist')
+CALLBACK_ROUTES = frozenset({
+    'back_to_main_menu', 'back_to_results', 'page_info', 'playlist_clear', 'playlist_finish',
+    'menu_create_playlist', 'menu_help', 'menu_info', 'menu_search_albums', 'menu_search_discography',
+    'menu_search_karaoke', 'menu_search_songs', 'add_to_playlist', 'add_to_playlist_from_download',
+    'add_to_playlist_from_link', 'create_playlist_and_add', 'download', 'link',
+    *(f"{action}_{search_type}" for action in ('page', 'select') for search_type in SEARCH_TYPES),
+})
+
+# Bot API alternativa (servidor propio o tools/fake_bot_api.py para pruebas locales)
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL', '').rstrip('/')
+
 # Logo mejorado del bot
 LOGO = """
 ╔═══════════════════════════════════╗
@@ -30,46 +246,2495 @@ LOGO = """
 ╚═══════════════════════════════════╝
 """
 
-# Separadores visuales
-SEPARATOR = "━━━━━━━━━━━━━━━━━━━━━━━━━━"
-MINI_SEP = "─────────────────────"
+# Separadores visuales
+SEPARATOR = "━━━━━━━━━━━━━━━━━━━━━━━━━━"
+MINI_SEP = "─────────────────────"
+
+
+class RateLimiter:
+    """Token bucket por usuario más un bucket global.
+    
+    Cada usuario tiene max_requests fichas que se recargan de forma
+    continua a lo largo de window_seconds; cada operación consume según
+    su costo. Usa reloj monotónico y cada chequeo es O(1). Los buckets que
+    ya se recargaron por completo se eliminan en evict_idle(). Un costo
+    mayor que la capacidad se cobra como la capacidad entera: si no, esa
+    operación no se permitiría nunca.
+    """
+    def __init__(self, max_requests=5, window_seconds=60, global_max_requests=600):
+        self.capacity = max_requests
+        self.rate = max_requests / window_seconds
+        self.global_capacity = global_max_requests
+        self.global_rate = global_max_requests / window_seconds
+        self.max_cost = min(max_requests, global_max_requests)
+        self.buckets = {}
+        self._global = [float(global_max_requests), time.monotonic()]
+    
+    @staticmethod
+    def _refill(bucket, capacity, rate, now):
+        bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+    
+    def _buckets(self, user_id, now):
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = [float(self.capacity), now]
+        else:
+            self._refill(bucket, self.capacity, self.rate, now)
+        self._refill(self._global, self.global_capacity, self.global_rate, now)
+        return bucket
+    
+    def is_allowed(self, user_id, cost=1):
+        bucket = self._buckets(user_id, time.monotonic())
+        if bucket[0] < cost or self._global[0] < cost:
+            return False
+        bucket[0] -= cost
+        self._global[0] -= cost
+        return True
+    
+    def get_wait_time(self, user_id, cost=1):
+        """Segundos hasta que la operación esté permitida"""
+        bucket = self._buckets(user_id, time.monotonic())
+        wait = max(
+            (cost - bucket[0]) / self.rate,
+            (cost - self._global[0]) / self.global_rate,
+            0
+        )
+        return math.ceil(wait)
+    
+    async def check(self, user_id, cost=1):
+        """Consume fichas si alcanza; devuelve los segundos de espera (0 = permitido)"""
+        cost = min(cost, self.max_cost)
+        if self.is_allowed(user_id, cost):
+            return 0
+        return max(1, self.get_wait_time(user_id, cost))
+    
+    async def refund(self, user_id, cost=1):
+        """Devuelve las fichas de una operación cobrada que al final no se hizo"""
+        cost = min(cost, self.max_cost)
+        bucket = self._buckets(user_id, time.monotonic())
+        bucket[0] = min(self.capacity, bucket[0] + cost)
+        self._global[0] = min(self.global_capacity, self._global[0] + cost)
+    
+    def limited_users(self):
+        """Usuarios que ahora mismo no pueden hacer ni una búsqueda"""
+        now = time.monotonic()
+        return sum(
+            1 for tokens, last in self.buckets.values()
+            if tokens + (now - last) * self.rate < 1
+        )
+    
+    def evict_idle(self):
+        """Elimina buckets llenos (equivalen a uno nuevo); devuelve cuántos"""
+        now = time.monotonic()
+        idle = [
+            user_id for user_id, (tokens, last) in self.buckets.items()
+            if tokens + (now - last) * self.rate >= self.capacity
+        ]
+        for user_id in idle:
+            del self.buckets[user_id]
+        return len(idle)
+
+
+class SessionStore:
+    """Diccionario por usuario con límite de tamaño y expiración por inactividad.
+    
+    Cada acceso renueva la sesión. Al superar max_entries se descarta la
+    menos usada; las sesiones inactivas más de idle_ttl segundos se borran
+    en sweep(), que corre periódicamente en el JobQueue.
+    """
+    def __init__(self, max_entries=10000, idle_ttl=1800):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.evicted_idle = 0
+        self.evicted_capacity = 0
+        self._data = OrderedDict()
+    
+    def _expired(self, last_seen, now):
+        return now - last_seen > self.idle_ttl
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return False
+        if self._expired(item[0], time.monotonic()):
+            del self._data[key]
+            self.evicted_idle += 1
+            return False
+        return True
+    
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        item = self._data[key]
+        item[0] = time.monotonic()
+        self._data.move_to_end(key)
+        return item[1]
+    
+    def __setitem__(self, key, value):
+        self._data[key] = [time.monotonic(), value]
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evicted_capacity += 1
+    
+    def __delitem__(self, key):
+        del self._data[key]
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def peek(self, key, default=None):
+        """Lee sin renovar la sesión ni cambiar el orden LRU"""
+        item = self._data.get(key)
+        return default if item is None else item[1]
+    
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+    
+    def sweep(self):
+        """Borra las sesiones inactivas; devuelve cuántas se eliminaron"""
+        now = time.monotonic()
+        removed = 0
+        # El OrderedDict está ordenado por último acceso: basta con recorrer el inicio
+        while self._data:
+            key, item = next(iter(self._data.items()))
+            if not self._expired(item[0], now):
+                break
+            del self._data[key]
+            removed += 1
+        self.evicted_idle += removed
+        return removed
+    
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'evicted_idle': self.evicted_idle,
+            'evicted_capacity': self.evicted_capacity,
+        }
+
+
+class StateBackend:
+    """Interfaz de almacenamiento de sesiones de búsqueda y playlists.
+    
+    shared=True indica que otras réplicas pueden modificar el estado, así
+    que hay que leerlo en cada update y escribirlo al terminar.
+    """
+    shared = False
+    # False: el estado se pierde al reiniciar o al desalojarlo de memoria
+    persistent = True
+    
+    async def start(self):
+        pass
+    
+    async def load_user(self, user_id):
+        """Devuelve ((data, updated) | None, data | None) de búsqueda y playlist"""
+        raise NotImplementedError
+    
+    async def save_users(self, rows):
+        """Guarda filas (user_id, búsqueda | None, playlist | None).
+        
+        La playlist es el JSON completo; con shared=True es la lista de
+        cambios [('append', canción) | ('replace', canciones)].
+        """
+        raise NotImplementedError
+    
+    async def close(self):
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """Estado solo en memoria del proceso (se pierde al reiniciar)"""
+    persistent = False
+    
+    async def load_user(self, user_id):
+        return None, None
+    
+    async def save_users(self, rows):
+        pass
+
+
+class SQLiteBackend(StateBackend):
+    """Persistencia local en SQLite (modo WAL) desde un único thread dedicado"""
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+    
+    def _open(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS playlists (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS searches (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self._conn.commit()
+    
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._thread, func, *args)
+    
+    async def start(self):
+        await self._call(self._open)
+    
+    def _read_user(self, user_id):
+        search = self._conn.execute(
+            "SELECT data, updated FROM searches WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        playlist = self._conn.execute(
+            "SELECT data FROM playlists WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return search, playlist[0] if playlist else None
+    
+    async def load_user(self, user_id):
+        return await self._call(self._read_user, user_id)
+    
+    def _write(self, rows):
+        now = time.time()
+        with self._conn:
+            for user_id, search, playlist in rows:
+                if search is None:
+                    self._conn.execute("DELETE FROM searches WHERE user_id = ?", (user_id,))
+                else:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO searches (user_id, data, updated) VALUES (?, ?, ?)",
+                        (user_id, search, now)
+                    )
+                # Una playlist ausente en memoria solo fue desalojada: se conserva en disco
+                if playlist is not None:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO playlists (user_id, data, updated) VALUES (?, ?, ?)",
+                        (user_id, playlist, now)
+                    )
+    
+    async def save_users(self, rows):
+        await self._call(self._write, rows)
+    
+    async def close(self):
+        if self._conn is not None:
+            await self._call(self._conn.close)
+        self._thread.shutdown(wait=True)
+
+
+class KVError(Exception):
+    """Error devuelto por el servidor clave-valor"""
+
+
+class KVClient:
+    """Cliente asyncio mínimo del protocolo RESP (compatible con Redis).
+    
+    Mantiene hasta pool_size conexiones; pipeline() envía varios comandos
+    juntos y lee todas las respuestas en un solo viaje.
+    """
+    def __init__(self, url, pool_size=8):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.pool_size = pool_size
+        self._idle = asyncio.Queue()
+        self._open = 0
+    
+    @staticmethod
+    def _encode(command):
+        parts = [f"*{len(command)}\r\n".encode()]
+        for arg in command:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        return b''.join(parts)
+    
+    @classmethod
+    async def _read_reply(cls, reader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('conexión cerrada por el servidor')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            return KVError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            size = int(payload)
+            if size < 0:
+                return None
+            return (await reader.readexactly(size + 2))[:-2].decode()
+        if kind == b'*':
+            size = int(payload)
+            if size < 0:
+                return None
+            return [await cls._read_reply(reader) for _ in range(size)]
+        raise KVError(f"respuesta inválida: {line!r}")
+    
+    async def _roundtrip(self, conn, commands):
+        reader, writer = conn
+        writer.write(b''.join(self._encode(command) for command in commands))
+        await writer.drain()
+        return [await self._read_reply(reader) for _ in commands]
+    
+    async def _connect(self):
+        conn = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        for reply in (await self._roundtrip(conn, setup) if setup else []):
+            if isinstance(reply, KVError):
+                conn[1].close()
+                raise reply
+        return conn
+    
+    async def _acquire(self):
+        if self._idle.empty() and self._open < self.pool_size:
+            self._open += 1
+            try:
+                return await self._connect()
+            except BaseException:
+                self._open -= 1
+                raise
+        return await self._idle.get()
+    
+    async def pipeline(self, commands):
+        """Ejecuta varios comandos; los errores vuelven como KVError en la lista"""
+        conn = await self._acquire()
+        try:
+            replies = await self._roundtrip(conn, commands)
+        except BaseException:
+            # Conexión en estado desconocido: se descarta
+            conn[1].close()
+            self._open -= 1
+            raise
+        self._idle.put_nowait(conn)
+        return replies
+    
+    async def execute(self, *command):
+        reply = (await self.pipeline([command]))[0]
+        if isinstance(reply, KVError):
+            raise reply
+        return reply
+    
+    async def close(self):
+        while not self._idle.empty():
+            _, writer = self._idle.get_nowait()
+            writer.close()
+            self._open -= 1
+
+
+# Token bucket atómico en el servidor: KEYS = bucket del usuario y global;
+# ARGV = costo, capacidad, recarga/s, capacidad global, recarga global/s, ttl ms.
+# La hora sale del TIME del servidor, así el desfase de reloj entre réplicas no
+# cambia a quién se limita (requiere Redis >= 5, que replica los efectos del script).
+# Devuelve los segundos de espera ("0" si se permitió y se descontaron las fichas).
+TOKEN_BUCKET_SCRIPT = """
+local function level(key, capacity, rate, now)
+  local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+  local tokens = tonumber(bucket[1]) or capacity
+  local ts = tonumber(bucket[2]) or now
+  return math.min(capacity, tokens + math.max(0, now - ts) * rate)
+end
+local cost = tonumber(ARGV[1])
+local capacity, rate = tonumber(ARGV[2]), tonumber(ARGV[3])
+local global_capacity, global_rate = tonumber(ARGV[4]), tonumber(ARGV[5])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tokens = level(KEYS[1], capacity, rate, now)
+local global_tokens = level(KEYS[2], global_capacity, global_rate, now)
+local wait = math.max((cost - tokens) / rate, (cost - global_tokens) / global_rate, 0)
+if wait == 0 then
+  tokens = tokens - cost
+  global_tokens = global_tokens - cost
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], ARGV[6])
+redis.call('HSET', KEYS[2], 'tokens', tostring(global_tokens), 'ts', tostring(now))
+return tostring(wait)
+"""
+TOKEN_BUCKET_SHA = hashlib.sha1(TOKEN_BUCKET_SCRIPT.encode()).hexdigest()
+
+
+class KVBackend(StateBackend):
+    """Estado compartido en un servidor clave-valor RESP (Redis o compatible).
+    
+    Las sesiones de búsqueda expiran solas en el servidor tras
+    session_ttl segundos; las playlists no expiran. Cada playlist es una
+    lista del servidor: agregar es un RPUSH, así dos réplicas (o dos
+    updates del mismo usuario) no se pisan las canciones.
+    """
+    shared = True
+    
+    def __init__(self, url, session_ttl=1800, pool_size=8):
+        self.client = KVClient(url, pool_size=pool_size)
+        self.session_ttl_ms = int(session_ttl * 1000)
+    
+    async def start(self):
+        await self.client.execute('PING')
+        logger.info(f"🔗 Estado compartido en {self.client.host}:{self.client.port}")
+    
+    async def load_user(self, user_id):
+        search, songs = await self.client.pipeline([
+            ('GET', f"session:{user_id}"),
+            ('LRANGE', f"playlist:{user_id}:songs", 0, -1),
+        ])
+        for reply in (search, songs):
+            if isinstance(reply, KVError):
+                raise reply
+        playlist = f"[{','.join(songs)}]" if songs else None
+        return ((search, time.time()) if search is not None else None), playlist
+    
+    async def save_users(self, rows):
+        commands = []
+        for user_id, search, playlist in rows:
+            if search is None:
+                commands.append(('DEL', f"session:{user_id}"))
+            else:
+                commands.append(('SET', f"session:{user_id}", search, 'PX', self.session_ttl_ms))
+            key = f"playlist:{user_id}:songs"
+            for change, value in playlist or ():
+                if change == 'append':
+                    commands.append(('RPUSH', key, json.dumps(value, ensure_ascii=False)))
+                    continue
+                # Reemplazo atómico: ningún RPUSH de otra réplica queda entre el DEL y el nuevo contenido
+                commands += [('MULTI',), ('DEL', key)]
+                if value:
+                    commands.append(('RPUSH', key, *(json.dumps(song, ensure_ascii=False) for song in value)))
+                commands.append(('EXEC',))
+        if commands:
+            for reply in await self.client.pipeline(commands):
+                for error in (reply if isinstance(reply, list) else [reply]):
+                    if isinstance(error, KVError):
+                        raise error
+    
+    async def take_tokens(self, user_id, cost, capacity, rate, global_capacity, global_rate):
+        """Token bucket atómico; devuelve los segundos de espera (0 = permitido)"""
+        keys = (f"bucket:{user_id}", "bucket:__global__")
+        # El bucket lleno equivale a no tenerlo: expira cuando se recargaría por completo
+        ttl_ms = int(capacity / rate * 1000) + 1000
+        args = (cost, capacity, rate, global_capacity, global_rate, ttl_ms)
+        try:
+            reply = await self.client.execute('EVALSHA', TOKEN_BUCKET_SHA, 2, *keys, *args)
+        except KVError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+            reply = await self.client.execute('EVAL', TOKEN_BUCKET_SCRIPT, 2, *keys, *args)
+        return float(reply)
+    
+    async def close(self):
+        await self.client.close()
+
+
+class SharedRateLimiter:
+    """Misma política que RateLimiter, con los buckets en el KVBackend compartido.
+    
+    La hora la pone el servidor (TIME dentro del script) porque los buckets
+    se comparten entre máquinas; los inactivos expiran solos en el servidor.
+    """
+    def __init__(self, backend, max_requests=5, window_seconds=60, global_max_requests=600):
+        self.backend = backend
+        self.capacity = max_requests
+        self.rate = max_requests / window_seconds
+        self.global_capacity = global_max_requests
+        self.global_rate = global_max_requests / window_seconds
+        self.max_cost = min(max_requests, global_max_requests)
+    
+    async def check(self, user_id, cost=1):
+        try:
+            wait = await self.backend.take_tokens(
+                user_id, min(cost, self.max_cost), self.capacity, self.rate, self.global_capacity, self.global_rate
+            )
+        except Exception as e:
+            # Si el servidor no responde se permite la operación antes que bloquear a todos
+            logger.error(f"Error en rate limit compartido: {e}")
+            return 0
+        return math.ceil(wait) if wait > 0 else 0
+    
+    async def refund(self, user_id, cost=1):
+        # Un costo negativo suma fichas; el script las recorta a la capacidad al leerlas
+        try:
+            await self.backend.take_tokens(
+                user_id, -min(cost, self.max_cost), self.capacity, self.rate, self.global_capacity, self.global_rate
+            )
+        except Exception as e:
+            logger.error(f"Error devolviendo fichas del rate limit compartido: {e}")
+    
+    def evict_idle(self):
+        return 0
+
+
+def create_state_backend():
+    """Crea el backend de estado según STATE_BACKEND"""
+    if STATE_BACKEND == 'memory':
+        return MemoryBackend()
+    if STATE_BACKEND == 'redis':
+        return KVBackend(STATE_URL, session_ttl=SESSION_IDLE_TTL, pool_size=KV_POOL_SIZE)
+    return SQLiteBackend(STORAGE_PATH)
+
+
+class Storage:
+    """Escritura de playlists y sesiones de búsqueda hacia un StateBackend.
+    
+    Con un backend local las escrituras no se hacen por cada toque: los
+    usuarios modificados se marcan como sucios y cada flush_interval se
+    guardan todos juntos, tomando el estado más reciente vía
+    snapshot(user_id). Con un backend compartido se escribe al terminar
+    cada update, para que la próxima réplica vea el estado actualizado.
+    """
+    def __init__(self, backend, snapshot, flush_interval=0.5):
+        self.backend = backend
+        self.snapshot = snapshot
+        self.flush_interval = flush_interval
+        self._dirty = set()
+        self._task = None
+        self._started = False
+    
+    async def start(self):
+        await self.backend.start()
+        self._started = True
+        if not self.backend.shared:
+            self._task = asyncio.create_task(self._flush_loop())
+    
+    async def load_user(self, user_id):
+        return await self.backend.load_user(user_id)
+    
+    async def release(self, user_id):
+        """Se llama al terminar cada update del usuario"""
+        if not self.backend.shared:
+            self._dirty.add(user_id)
+            return
+        try:
+            await self.backend.save_users([(user_id, *self.snapshot(user_id))])
+        except Exception as e:
+            logger.error(f"Error guardando estado compartido: {e}")
+    
+    async def flush(self):
+        if not self._dirty or not self._started:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = [(user_id, *self.snapshot(user_id)) for user_id in dirty]
+        try:
+            await self.backend.save_users(rows)
+        except Exception as e:
+            logger.error(f"Error guardando estado: {e}")
+            self._dirty |= dirty
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        await self.flush()
+        await self.backend.close()
+
+
+class SearchResult:
+    """Resultado de búsqueda compacto.
+    
+    Guarda solo lo que usan los teclados y la vista de detalle, en lugar
+    del dict completo de yt-dlp (miniaturas, formatos, URLs...). Los
+    strings se internan para compartirlos entre sesiones.
+    """
+    __slots__ = ('id', 'title', 'channel', 'duration')
+    
+    def __init__(self, id, title, channel, duration):
+        self.id = id
+        self.title = title
+        self.channel = channel
+        self.duration = duration
+    
+    @classmethod
+    def from_entry(cls, entry):
+        """Convierte una entrada de yt-dlp; devuelve None si no tiene id"""
+        video_id = entry.get('id')
+        if not video_id:
+            return None
+        try:
+            duration = int(float(entry.get('duration') or 0))
+        except (ValueError, TypeError):
+            duration = 0
+        return cls(
+            sys.intern(video_id),
+            sys.intern(entry.get('title') or 'Sin título'),
+            sys.intern(entry.get('channel') or entry.get('uploader') or ''),
+            duration
+        )
+    
+    def to_row(self):
+        return [self.id, self.title, self.channel, self.duration]
+    
+    @classmethod
+    def from_row(cls, row):
+        video_id, title, channel, duration = row
+        return cls(sys.intern(video_id), sys.intern(title), sys.intern(channel), duration)
+
+
+class YoutubeDLPool:
+    """Pool de instancias de YoutubeDL pre-calentadas para un juego de opciones.
+    
+    Crear un YoutubeDL por llamada repite la inicialización de extractores,
+    cookies y sesión HTTP. Aquí las instancias se prestan y se devuelven;
+    una instancia se recicla tras max_uses usos, al superar max_age segundos
+    o si el trabajo terminó con un error inesperado.
+    """
+    def __init__(self, ydl_opts, max_uses=50, max_age=1800):
+        self.ydl_opts = ydl_opts
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.created = 0
+        self.recycled = 0
+        self._idle = []
+        self._lock = threading.Lock()
+    
+    def _create(self):
+        ydl = yt_dlp.YoutubeDL(copy.deepcopy(self.ydl_opts))
+        self.created += 1
+        return {'ydl': ydl, 'uses': 0, 'born': time.monotonic()}
+    
+    def _is_healthy(self, item):
+        return item['uses'] < self.max_uses and time.monotonic() - item['born'] < self.max_age
+    
+    def _recycle(self, item):
+        self.recycled += 1
+        try:
+            item['ydl'].close()
+        except Exception as e:
+            logger.warning(f"Error cerrando YoutubeDL: {e}")
+    
+    def warm(self, count):
+        """Crea instancias hasta tener count libres"""
+        with self._lock:
+            missing = count - len(self._idle)
+        for _ in range(missing):
+            item = self._create()
+            with self._lock:
+                self._idle.append(item)
+    
+    @contextmanager
+    def borrow(self):
+        item = None
+        with self._lock:
+            while self._idle:
+                candidate = self._idle.pop()
+                if self._is_healthy(candidate):
+                    item = candidate
+                    break
+                self._recycle(candidate)
+        if item is None:
+            item = self._create()
+        
+        healthy = False
+        try:
+            yield item['ydl']
+            healthy = True
+        except (yt_dlp.utils.DownloadError, SearchCancelled):
+            # Errores del video o cancelaciones: la instancia sigue sirviendo
+            healthy = True
+            raise
+        finally:
+            item['uses'] += 1
+            if healthy and self._is_healthy(item):
+                with self._lock:
+                    self._idle.append(item)
+            else:
+                self._recycle(item)
+    
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for item in idle:
+            self._recycle(item)
+
+
+class SearchBusyError(Exception):
+    """La cola de búsquedas está llena"""
+
+
+class SearchIncomplete(Exception):
+    """Alguna variante de una búsqueda múltiple falló: los resultados son parciales"""
+
+
+class SearchCancelled(Exception):
+    """La búsqueda fue cancelada (timeout o el usuario navegó a otro menú)"""
+
+
+class SearchExecutor:
+    """Ejecuta las búsquedas bloqueantes de yt-dlp fuera del event loop.
+    
+    Pool acotado de threads + límite de cola. Cada trabajo recibe un
+    threading.Event que se activa al cancelar; la función lo revisa entre
+    resultados y corta, liberando el worker.
+    """
+    def __init__(self, max_workers=4, max_queue=32):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='search')
+        self._slots = asyncio.Semaphore(max_workers)
+        self._owners = defaultdict(set)
+    
+    async def run(self, func, *args, owner=None):
+        """Ejecuta func(*args, cancel_event) en el pool y espera el resultado"""
+        if self.pending >= self.max_workers + self.max_queue:
+            raise SearchBusyError()
+        
+        cancel_event = threading.Event()
+        self.pending += 1
+        self._owners[owner].add(cancel_event)
+        try:
+            await self._slots.acquire()
+            if cancel_event.is_set():
+                self._slots.release()
+                raise SearchCancelled()
+            
+            loop = asyncio.get_running_loop()
+            try:
+                future = self._pool.submit(func, *args, cancel_event)
+            except BaseException:
+                self._slots.release()
+                raise
+            # El slot se libera cuando el thread termina de verdad, no al cancelar
+            future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._slots.release))
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+        finally:
+            self.pending -= 1
+            self._owners[owner].discard(cancel_event)
+            if not self._owners[owner]:
+                del self._owners[owner]
+    
+    def cancel_owner(self, owner):
+        """Cancela todas las búsquedas en curso de un usuario"""
+        for cancel_event in self._owners.get(owner, ()):
+            cancel_event.set()
+    
+    def shutdown(self):
+        for events in self._owners.values():
+            for cancel_event in events:
+                cancel_event.set()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class SearchCache:
+    """Cache TTL + LRU de resultados de búsqueda.
+    
+    La clave es (consulta normalizada, modo, cantidad de resultados). La
+    memoria se acota por el total de resultados guardados: al pasarse del
+    límite se descartan las búsquedas menos usadas.
+    """
+    def __init__(self, ttl_seconds=900, max_results=20000):
+        self.ttl_seconds = ttl_seconds
+        self.max_results = max_results
+        self.total_results = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+    
+    @staticmethod
+    def normalize(query):
+        """'  Bad   BUNNY! ' y 'bad bunny' comparten clave"""
+        text = unicodedata.normalize('NFKD', query.casefold())
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+        return ' '.join(re.sub(r'[^\w\s]', ' ', text).split())
+    
+    def _key(self, query, mode, max_results):
+        return (self.normalize(query), mode, max_results)
+    
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, results = entry
+        if time.monotonic() >= expires_at:
+            self._remove(key)
+            return None
+        return results
+    
+    def _remove(self, key):
+        _, results = self._entries.pop(key)
+        self.total_results -= len(results)
+    
+    def contains(self, query, mode, max_results):
+        """Consulta sin afectar contadores ni el orden LRU"""
+        return self._lookup(self._key(query, mode, max_results)) is not None
+    
+    def get(self, query, mode, max_results):
+        key = self._key(query, mode, max_results)
+        results = self._lookup(key)
+        if results is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return results
+    
+    def put(self, query, mode, max_results, results):
+        if not results or len(results) > self.max_results:
+            return
+        key = self._key(query, mode, max_results)
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, results)
+        self.total_results += len(results)
+        while self.total_results > self.max_results:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+
+class DownloadBusyError(Exception):
+    """La cola de descargas está llena"""
+
+
+# Pools del proceso hijo, uno por juego de opciones de descarga
+_download_pools = {}
+
+
+def _get_download_pool(ydl_opts):
+    key = json.dumps(ydl_opts, sort_keys=True)
+    if key not in _download_pools:
+        # Los hooks no viajan en las opciones (no son serializables): se agregan en el hijo
+        ydl_opts = dict(
+            ydl_opts,
+            progress_hooks=[_progress_hook],
+            postprocessor_hooks=[_postprocessor_hook],
+        )
+        _download_pools[key] = YoutubeDLPool(ydl_opts, max_uses=YDL_MAX_USES, max_age=YDL_MAX_AGE)
+    return _download_pools[key]
+
+
+class _ProgressReporter:
+    """Envía el progreso del trabajo actual al proceso principal, como mucho cada `interval` segundos"""
+    def __init__(self, conn, interval=DOWNLOAD_PROGRESS_REPORT_INTERVAL):
+        self.conn = conn
+        self.interval = interval
+        self._last_sent = 0
+        self._last_phase = None
+    
+    def report(self, phase, done_bytes=None, total_bytes=None, speed=None, eta=None):
+        now = time.monotonic()
+        if phase == self._last_phase and now - self._last_sent < self.interval:
+            return
+        self._last_sent = now
+        self._last_phase = phase
+        percent = None
+        if done_bytes is not None and total_bytes:
+            percent = min(100.0, done_bytes * 100 / total_bytes)
+        try:
+            self.conn.send(('progress', {
+                'phase': phase, 'percent': percent, 'bytes': done_bytes, 'speed': speed, 'eta': eta
+            }))
+        except (OSError, ValueError):
+            pass
+
+
+# Reporter del trabajo en curso; cada proceso hijo atiende un trabajo a la vez
+_progress_reporter = None
+# Cuándo empezó y terminó la conversión de FFmpeg en el trabajo en curso
+_postprocess_marks = {}
+
+
+def _report_progress(phase, **fields):
+    if _progress_reporter is not None:
+        _progress_reporter.report(phase, **fields)
+
+
+def _progress_hook(status):
+    """progress_hooks de yt-dlp: bytes descargados, velocidad y ETA"""
+    if status.get('status') == 'downloading':
+        _report_progress(
+            'downloading',
+            done_bytes=status.get('downloaded_bytes'),
+            total_bytes=status.get('total_bytes') or status.get('total_bytes_estimate'),
+            speed=status.get('speed'),
+            eta=status.get('eta'),
+        )
+
+
+def _postprocessor_hook(status):
+    """postprocessor_hooks de yt-dlp: fase de conversión"""
+    if status.get('postprocessor') != 'ExtractAudio':
+        return
+    _postprocess_marks[status.get('status')] = time.monotonic()
+    if status.get('status') == 'started':
+        _report_progress('converting')
+
+
+def _ffmpeg_command(source_url, headers, profile, remux):
+    """FFmpeg lee de la URL directa y escribe el audio del perfil por stdout"""
+    command = ['ffmpeg', '-nostdin', '-loglevel', 'error']
+    if headers:
+        command += ['-headers', ''.join(f"{key}: {value}\r\n" for key, value in headers.items())]
+    command += [
+        '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+        '-i', source_url, '-vn',
+    ]
+    if profile == 'm4a':
+        # MP4 fragmentado: se puede escribir en un pipe sin volver atrás a escribir el índice
+        codec = ['-codec:a', 'copy'] if remux else ['-codec:a', 'aac', '-b:a', f"{AUDIO_QUALITY}k"]
+        command += codec + ['-f', 'ipod', '-movflags', '+frag_keyframe+empty_moov', 'pipe:1']
+    else:
+        command += ['-codec:a', 'libmp3lame', '-b:a', f"{AUDIO_QUALITY}k", '-f', 'mp3', 'pipe:1']
+    return command
+
+
+def _is_remux(info, profile):
+    """El perfil m4a con una pista AAC se copia sin recodificar"""
+    return profile == 'm4a' and (info.get('acodec') or '').startswith('mp4a')
+
+
+def _direct_transcode(ydl, url, output, max_bytes, profile='mp3'):
+    """Convierte el audio leyendo la red directo hacia `output`. Devuelve (tamaño, título, camino) o None si hay que usar archivo"""
+    info = ydl.extract_info(url, download=False)
+    if not info or not info.get('url'):
+        return None
+    if info.get('protocol') not in ('http', 'https'):
+        # HLS/DASH fragmentado: yt-dlp lo maneja mejor descargando a disco
+        logger.info(f"↩️ Protocolo {info.get('protocol')} sin conversión directa")
+        return None
+    
+    remux = _is_remux(info, profile)
+    # Tamaño esperado para estimar el avance: el original si se copia, duración × bitrate si se convierte
+    if remux:
+        expected_size = info.get('filesize') or info.get('filesize_approx')
+    else:
+        expected_size = (info.get('duration') or 0) * int(AUDIO_QUALITY) * 1000 // 8
+    started = time.monotonic()
+    try:
+        process = subprocess.Popen(
+            _ffmpeg_command(info['url'], info.get('http_headers'), profile, remux),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    except OSError as e:
+        logger.error(f"❌ No se pudo iniciar FFmpeg: {e}")
+        return None
+    
+    size = 0
+    completed = False
+    try:
+        with open(output, 'wb') as audio_file:
+            while True:
+                chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    logger.warning(f"↩️ El audio supera {max_bytes} bytes")
+                    return None
+                audio_file.write(chunk)
+                elapsed = time.monotonic() - started
+                speed = size / elapsed if elapsed > 0 else None
+                eta = (expected_size - size) / speed if speed and expected_size and expected_size > size else None
+                _report_progress('streaming', done_bytes=size, total_bytes=expected_size, speed=speed, eta=eta)
+        stderr = process.stderr.read()
+        if process.wait() != 0 or not size:
+            logger.error(f"❌ FFmpeg falló: {stderr.decode(errors='replace').strip()[:300]}")
+            return None
+        completed = True
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+        if not completed and os.path.exists(output):
+            os.remove(output)
+    
+    logger.info(f"✅ Audio convertido directo de la red, tamaño: {size} bytes")
+    return size, info.get('title', 'Audio'), 'remux' if remux else 'transcode'
+
+
+def _download_to_file(ydl, job):
+    """Descarga y convierte en disco; deja el audio en job['output'] y devuelve (tamaño, título, camino)"""
+    url = job['url']
+    profile = job.get('profile', 'mp3')
+    ydl.params['outtmpl']['default'] = job['outtmpl']
+    info = ydl.extract_info(url, download=True)
+    
+    if not info:
+        logger.error("❌ No se pudo obtener info del video")
+        return None
+    
+    # Buscar el archivo descargado
+    filename = ydl.prepare_filename(info).rsplit('.', 1)[0] + '.' + AUDIO_PROFILES[profile]['ext']
+    
+    logger.info(f"✅ Archivo generado: {filename}")
+    
+    # Verificar que el archivo existe
+    if not os.path.exists(filename):
+        logger.error(f"❌ Archivo no existe: {filename}")
+        return None
+    
+    os.replace(filename, job['output'])
+    size = os.path.getsize(job['output'])
+    logger.info(f"✅ Archivo existe, tamaño: {size} bytes")
+    return size, info.get('title', 'Audio'), 'remux' if _is_remux(info, profile) else 'transcode'
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _cpu_seconds():
+    """CPU usada por este proceso y sus hijos ya terminados (FFmpeg)"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _run_download_job(job):
+    """Descarga y convierte un audio dentro del proceso hijo.
+    
+    Devuelve (ruta del audio, título, métricas) o (None, None, None). El
+    audio queda escrito en job['output']: por el pipe solo viajan la ruta y
+    las métricas, no los bytes, así el proceso principal nunca espera a
+    recibir un archivo entero.
+    """
+    url = job['url']
+    started = time.monotonic()
+    cpu_start = _cpu_seconds()
+    _postprocess_marks.clear()
+    mode = 'file'
+    result = None
+    try:
+        with _get_download_pool(job['ydl_opts']).borrow() as ydl:
+            logger.info(f"🎵 Descargando: {url}")
+            if job.get('mode') == 'direct':
+                result = _direct_transcode(
+                    ydl, url, job['output'], job.get('max_bytes', STREAM_MAX_BYTES), job.get('profile', 'mp3')
+                )
+                if result:
+                    mode = 'direct'
+                else:
+                    logger.info("↩️ Usando descarga a archivo")
+            if not result:
+                result = _download_to_file(ydl, job)
+                
+    except yt_dlp.utils.DownloadError as e:
+        logger.error(f"❌ Error de descarga de yt-dlp: {e}")
+    except Exception as e:
+        logger.error(f"❌ Error general en descarga: {type(e).__name__}: {e}")
+    
+    if not result:
+        return None, None, None
+    size, title, path = result
+    finished = time.monotonic()
+    # En modo direct FFmpeg descarga y convierte a la vez: no hay fase de conversión aparte
+    postprocess_started = _postprocess_marks.get('started')
+    postprocess_seconds = None
+    if postprocess_started:
+        postprocess_seconds = _postprocess_marks.get('finished', finished) - postprocess_started
+    stats = {
+        'path': path,
+        'mode': mode,
+        'bytes': size,
+        'cpu_seconds': _cpu_seconds() - cpu_start,
+        'seconds': finished - started,
+        'download_seconds': (postprocess_started or finished) - started,
+        'postprocess_seconds': postprocess_seconds,
+    }
+    return job['output'], title, stats
+
+
+def _download_worker_main(conn, warm_opts):
+    """Bucle del proceso hijo: recibe trabajos por el pipe hasta recibir None.
+    
+    Por el pipe vuelven mensajes ('progress', datos) y al final ('result', resultado).
+    """
+    global _progress_reporter
+    # Ctrl+C lo maneja el proceso principal, que cierra los workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Grupo de procesos propio: al matar el worker también muere el FFmpeg que lanzó
+    if hasattr(os, 'setpgid'):
+        os.setpgid(0, 0)
+    if warm_opts:
+        _get_download_pool(warm_opts).warm(1)
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        _progress_reporter = _ProgressReporter(conn)
+        try:
+            result = _run_download_job(job)
+        finally:
+            _progress_reporter = None
+        conn.send(('result', result))
+    for pool in _download_pools.values():
+        pool.close()
+
+
+class _DownloadWorker:
+    """Proceso hijo de larga vida conectado por un pipe"""
+    def __init__(self, ctx, warm_opts=None):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_download_worker_main, args=(child_conn, warm_opts), daemon=True)
+        self.process.start()
+        child_conn.close()
+    
+    def is_alive(self):
+        return self.process.is_alive()
+    
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+    
+    def kill(self):
+        """Mata el worker junto con su grupo (FFmpeg incluido) para no dejar huérfanos"""
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            # Sin grupos de procesos (Windows) o el hijo aún no creó el suyo
+            self.process.kill()
+        self.conn.close()
+
+
+class DownloadEngine:
+    """Pool de procesos para yt-dlp + FFmpeg.
+    
+    Cada worker atiende un trabajo a la vez, así que N descargas simultáneas
+    ocupan N núcleos. La cola tiene un límite (DownloadBusyError) y si un
+    trabajo excede su timeout o se cancela, el proceso hijo se mata y se
+    reemplaza por uno nuevo.
+    """
+    def __init__(self, workers=1, max_queue=16, warm_opts=None):
+        self.size = max(1, workers)
+        self.max_queue = max_queue
+        self.warm_opts = warm_opts
+        self.pending = 0
+        self._ctx = multiprocessing.get_context('spawn')
+        self._workers = set()
+        self._idle = None
+    
+    def start(self):
+        """Lanza los procesos (se llama al iniciar la aplicación)"""
+        if self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            self._idle.put_nowait(self._spawn())
+        logger.info(f"⚙️ Motor de descargas: {self.size} procesos")
+    
+    def _spawn(self):
+        worker = _DownloadWorker(self._ctx, self.warm_opts)
+        self._workers.add(worker)
+        return worker
+    
+    def _replace(self, worker):
+        worker.kill()
+        self._workers.discard(worker)
+        # join no bloqueante para no dejar procesos zombie
+        asyncio.get_running_loop().run_in_executor(None, worker.process.join, 5)
+        self._idle.put_nowait(self._spawn())
+    
+    def has_idle_worker(self):
+        """Hay al menos un proceso libre y nadie esperando en la cola"""
+        return self._idle is not None and self.pending < self.size
+    
+    async def run(self, job, timeout, on_progress=None, on_start=None):
+        """Ejecuta un trabajo en un proceso libre y devuelve su resultado.
+        
+        on_progress(datos) se llama con cada aviso de progreso del worker y
+        on_start() cuando un proceso toma el trabajo: desde ahí cancelarlo
+        cuesta matar y relanzar ese proceso.
+        """
+        self.start()
+        if self.pending >= self.size + self.max_queue:
+            raise DownloadBusyError()
+        
+        self.pending += 1
+        try:
+            worker = await self._idle.get()
+            if not worker.is_alive():
+                self._workers.discard(worker)
+                worker = self._spawn()
+            if on_start:
+                on_start()
+            try:
+                result = await asyncio.wait_for(self._exchange(worker, job, on_progress), timeout=timeout)
+            except BaseException:
+                # Timeout, cancelación o worker caído: el hijo puede seguir trabajando
+                self._replace(worker)
+                raise
+            self._idle.put_nowait(worker)
+            return result
+        finally:
+            self.pending -= 1
+    
+    async def _exchange(self, worker, job, on_progress=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        fd = worker.conn.fileno()
+        
+        def on_readable():
+            if future.done():
+                return
+            try:
+                kind, payload = worker.conn.recv()
+            except (EOFError, OSError) as e:
+                future.set_exception(e)
+                return
+            if kind == 'result':
+                future.set_result(payload)
+            elif on_progress:
+                try:
+                    on_progress(payload)
+                except Exception as e:
+                    logger.error(f"Error informando progreso: {e}")
+        
+        worker.conn.send(job)
+        loop.add_reader(fd, on_readable)
+        try:
+            return await future
+        finally:
+            loop.remove_reader(fd)
+    
+    def shutdown(self):
+        for worker in list(self._workers):
+            worker.stop()
+        for worker in list(self._workers):
+            worker.process.join(timeout=2)
+            if worker.is_alive():
+                worker.kill()
+        self._workers.clear()
+
+
+class SingleFlight:
+    """Une llamadas concurrentes con la misma clave en una sola ejecución.
+    
+    La primera llamada lanza el trabajo como tarea y las demás esperan esa
+    misma tarea. Cada espera se cuenta: si todas se cancelan (el usuario se
+    fue, timeout del handler), la tarea se cancela y la clave queda libre para
+    un intento nuevo.
+    """
+    def __init__(self):
+        self._calls = {}
+        self.started = 0
+        self.coalesced = 0
+    
+    def __contains__(self, key):
+        return key in self._calls
+    
+    async def do(self, key, factory):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = {'task': asyncio.ensure_future(factory()), 'waiters': 0}
+            call['task'].add_done_callback(lambda _, key=key, call=call: self._forget(key, call))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        
+        call['waiters'] += 1
+        try:
+            return await asyncio.shield(call['task'])
+        finally:
+            call['waiters'] -= 1
+            if call['waiters'] == 0 and not call['task'].done():
+                # Nadie más espera el resultado
+                self._forget(key, call)
+                call['task'].cancel()
+    
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+class Prefetcher:
+    """Descargas especulativas de baja prioridad, limitadas por usuario y en total.
+    
+    Cada prefetch es solo una espera más dentro de SingleFlight: si el usuario
+    pulsa el botón se suma a la misma descarga, y cancelar el prefetch no la
+    corta mientras alguien más la espere. Solo se cancelan los que esperan
+    worker: cortar uno que ya descarga mataría el proceso, así que ese
+    termina y deja el audio en la cache de disco.
+    """
+    def __init__(self, per_user=1, max_global=1):
+        self.per_user = per_user
+        self.max_global = max_global
+        self.tasks = {}
+        # Prefetch que ya tomó un worker del motor de descargas
+        self._running = set()
+        self.started = 0
+        self.skipped = 0
+        self.cancelled = 0
+    
+    def active(self):
+        return sum(len(tasks) for tasks in self.tasks.values())
+    
+    def start(self, user_id, key, factory):
+        """Lanza factory(on_start) en segundo plano si hay cupo. Devuelve True si quedó en curso.
+        
+        factory debe llamar a on_start() cuando la descarga toma un worker.
+        """
+        user_tasks = self.tasks.get(user_id, {})
+        if key in user_tasks:
+            return True
+        # El tema nuevo es el más probable: se reemplaza el prefetch más viejo del usuario
+        while user_tasks and len(user_tasks) >= self.per_user:
+            oldest = next(iter(user_tasks))
+            if user_tasks[oldest] in self._running:
+                break
+            self._cancel(user_tasks.pop(oldest))
+        if self.per_user <= 0 or len(user_tasks) >= self.per_user or self.active() >= self.max_global:
+            self.skipped += 1
+            return False
+        
+        task = asyncio.ensure_future(factory(lambda: self._running.add(task)))
+        self.tasks.setdefault(user_id, {})[key] = task
+        task.add_done_callback(lambda _: self._finished(user_id, key, task))
+        self.started += 1
+        return True
+    
+    def _finished(self, user_id, key, task):
+        self._running.discard(task)
+        user_tasks = self.tasks.get(user_id)
+        if user_tasks and user_tasks.get(key) is task:
+            del user_tasks[key]
+            if not user_tasks:
+                del self.tasks[user_id]
+        if not task.cancelled() and task.exception():
+            logger.info(f"Prefetch de {key[0]} falló: {type(task.exception()).__name__}")
+    
+    def _cancel(self, task):
+        if not task.done():
+            task.cancel()
+            self.cancelled += 1
+    
+    def cancel_user(self, user_id):
+        """Cancela los prefetch del usuario que aún no empezaron a descargar"""
+        user_tasks = self.tasks.get(user_id, {})
+        for key, task in list(user_tasks.items()):
+            if task not in self._running:
+                del user_tasks[key]
+                self._cancel(task)
+        if not user_tasks:
+            self.tasks.pop(user_id, None)
+    
+    def shutdown(self):
+        for user_tasks in self.tasks.values():
+            for task in user_tasks.values():
+                self._cancel(task)
+        self.tasks.clear()
+
+
+class ProgressMessage:
+    """Edita un mensaje con el último progreso recibido, como mucho una vez cada `interval` segundos.
+    
+    update() es síncrono y barato: solo guarda el dato y agenda la edición;
+    los avisos que llegan mientras se espera se agrupan en una sola.
+    """
+    def __init__(self, edit, render, interval=DOWNLOAD_PROGRESS_INTERVAL):
+        self.edit = edit
+        self.render = render
+        self.interval = interval
+        self.latest = None
+        self.edits = 0
+        self._flushed = None
+        self._last_text = None
+        self._last_edit = 0
+        self._task = None
+        self._closed = False
+    
+    def update(self, progress):
+        if self._closed:
+            return
+        self.latest = progress
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._flush())
+    
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        while self.latest is not self._flushed:
+            delay = self._last_edit + self.interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            progress = self._flushed = self.latest
+            text = self.render(progress)
+            if text == self._last_text:
+                continue
+            self._last_edit = loop.time()
+            try:
+                with outbound_priority(PRIORITY_LOW):
+                    await self.edit(text)
+                self._last_text = text
+                self.edits += 1
+            except TelegramError as e:
+                logger.debug(f"No se pudo editar el progreso: {e}")
+    
+    def close(self):
+        """Corta las ediciones pendientes (se llama antes de mostrar el resultado final)"""
+        self._closed = True
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+
+# Prioridad de los envíos a Telegram: entregas de audio primero, los
+# mensajes "cargando..." y el progreso al final
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+_outbound_priority = contextvars.ContextVar('outbound_priority', default=None)
+
+
+@contextmanager
+def outbound_priority(priority):
+    """Marca con `priority` los envíos a Telegram hechos dentro del bloque"""
+    token = _outbound_priority.set(priority)
+    try:
+        yield
+    finally:
+        _outbound_priority.reset(token)
+
+
+class _OutboundJob:
+    def __init__(self, callback, args, kwargs, endpoint, chat_id, priority, edit_key):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.endpoint = endpoint
+        self.chat_id = chat_id
+        self.priority = priority
+        self.edit_key = edit_key
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.waiters = 0
+        self.attempts = 0
+        self.started = False
+        self.merged_into = None
+        # Un envío que nadie espera puede fallar sin que se lea la excepción
+        self.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Cola única de salida hacia la Bot API (se instala como rate_limiter de PTB).
+    
+    Cada envío espera una ficha del bucket global y otra del bucket de su chat
+    (los grupos tienen su propio ritmo), a `headroom` veces el ritmo nominal.
+    Cada chat tiene su cola por prioridad; los chats sin fichas se apartan
+    hasta que se recargan, así elegir el próximo envío solo mira chats listos
+    y no recorre toda la cola. Una edición de texto que
+    llega mientras otra del mismo mensaje espera en cola la reemplaza y ambos
+    llamadores reciben el mismo resultado. Ante RetryAfter el chat se pausa el
+    tiempo indicado y el envío vuelve al frente de su carril; si el envío no
+    tiene chat (answerCallbackQuery) la espera no es de nadie en particular y
+    se pausa todo el bucket global.
+    """
+    PRIORITIES = {
+        'sendAudio': PRIORITY_HIGH,
+        'sendDocument': PRIORITY_HIGH,
+        'answerCallbackQuery': PRIORITY_HIGH,
+    }
+    # Sin chat_id pero igual cuentan para el límite global
+    GLOBAL_ONLY = {'answerCallbackQuery'}
+    
+    def __init__(self, per_second=30, chat_per_second=1, chat_burst=3, group_per_minute=20, max_retries=3,
+                 headroom=1.0, drain_timeout=5, metrics=None):
+        self.rate = per_second * headroom
+        self.chat_rate = chat_per_second * headroom
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_minute / 60 * headroom
+        self.max_retries = max_retries
+        self.drain_timeout = drain_timeout
+        lanes = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+        # chat_id -> una cola por prioridad
+        self.queues = {}
+        # Por prioridad, los chats con fichas y envíos en ese carril, en orden de llegada
+        self.ready = [OrderedDict() for _ in lanes]
+        self.queued = [0 for _ in lanes]
+        # Chats apartados hasta que se recarguen sus fichas (o termine su pausa)
+        self.parked = {}
+        self._parked_heap = []
+        self._parked_count = 0
+        self.pending_edits = {}
+        self.in_flight_edits = set()
+        self.chat_buckets = {}
+        self.paused_until = {}
+        # RetryAfter de un envío sin chat: frena todos los envíos
+        self.global_paused_until = 0.0
+        self._global = [float(per_second), time.monotonic()]
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Envíos en vuelo: se guarda la referencia para que no los junte el GC y poder esperarlos al cerrar
+        self._sending = set()
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.dropped = 0
+        self.metrics = metrics
+        if metrics:
+            self._register_metrics(metrics)
+    
+    def _register_metrics(self, metrics):
+        metrics.histogram('bot_telegram_request_seconds', 'Duración de cada llamada a la Bot API (sendAudio = subida)')
+        metrics.histogram('bot_telegram_queue_seconds', 'Espera en la cola de salida antes de enviar')
+        metrics.collect('bot_telegram_queued', 'gauge', 'Envíos esperando en la cola de salida', lambda: [
+            ({'priority': priority}, count) for priority, count in enumerate(self.queued)
+        ])
+        counters = {
+            'sent': 'Envíos a Telegram completados',
+            'coalesced': 'Ediciones reemplazadas por una más nueva antes de enviarse',
+            'retried': 'Envíos reintentados tras un RetryAfter',
+            'dropped': 'Envíos descartados porque nadie esperaba el resultado',
+        }
+        for name, help_text in counters.items():
+            metrics.collect(f'bot_telegram_{name}_total', 'counter', help_text, lambda name=name: getattr(self, name))
+    
+    async def initialize(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+    
+    async def shutdown(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # PTB cierra el rate limiter antes que las conexiones: los envíos en vuelo pueden terminar
+        if self._sending:
+            await asyncio.wait(self._sending, timeout=self.drain_timeout)
+        for task in self._sending:
+            task.cancel()
+        await asyncio.gather(*self._sending, return_exceptions=True)
+        for queues in self.queues.values():
+            for queue in queues:
+                while queue:
+                    queue.popleft().future.cancel()
+        self.queues.clear()
+        for ready in self.ready:
+            ready.clear()
+        self.queued = [0 for _ in self.queued]
+        self.pending_edits.clear()
+    
+    def _priority(self, endpoint, rate_limit_args):
+        if isinstance(rate_limit_args, dict) and 'priority' in rate_limit_args:
+            return rate_limit_args['priority']
+        priority = _outbound_priority.get()
+        if priority is not None:
+            return priority
+        return self.PRIORITIES.get(endpoint, PRIORITY_NORMAL)
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None and endpoint not in self.GLOBAL_ONLY:
+            # getMe, setWebhook y similares no son mensajes
+            return await callback(*args, **kwargs)
+        await self.initialize()
+        
+        priority = self._priority(endpoint, rate_limit_args)
+        edit_key = None
+        if endpoint == 'editMessageText':
+            edit_key = (chat_id, data.get('message_id'), data.get('inline_message_id'))
+        
+        job = self.pending_edits.get(edit_key) if edit_key else None
+        if job is not None:
+            # La edición en cola queda obsoleta: se envía el texto nuevo en su lugar
+            job.args, job.kwargs = args, kwargs
+            self.coalesced += 1
+            if priority < job.priority:
+                self._dequeue(job)
+                job.priority = priority
+                self._enqueue(job)
+        else:
+            job = _OutboundJob(callback, args, kwargs, endpoint, chat_id, priority, edit_key)
+            if edit_key:
+                self.pending_edits[edit_key] = job
+            self._enqueue(job)
+        self._wakeup.set()
+        
+        job.waiters += 1
+        try:
+            with trace_span(f"api:{endpoint}"):
+                return await asyncio.shield(job.future)
+        finally:
+            while job.merged_into is not None:
+                job = job.merged_into
+            job.waiters -= 1
+            if job.waiters == 0 and not job.started and not job.future.done():
+                # Nadie espera ya este envío (p. ej. progreso cancelado): se descarta
+                self._discard(job)
+    
+    def _enqueue(self, job, front=False):
+        queues = self.queues.setdefault(job.chat_id, [deque() for _ in self.ready])
+        queue = queues[job.priority]
+        if front:
+            queue.appendleft(job)
+        else:
+            queue.append(job)
+        self.queued[job.priority] += 1
+        if job.chat_id not in self.parked:
+            self.ready[job.priority][job.chat_id] = None
+    
+    def _dequeue(self, job):
+        queues = self.queues[job.chat_id]
+        queues[job.priority].remove(job)
+        self.queued[job.priority] -= 1
+        if not queues[job.priority]:
+            self.ready[job.priority].pop(job.chat_id, None)
+            if not any(queues):
+                del self.queues[job.chat_id]
+    
+    def _park(self, chat_id, until):
+        """Aparta el chat hasta `until`; sus envíos no se miran mientras tanto"""
+        self.parked[chat_id] = until
+        # El contador desempata sin comparar chat_id (puede ser int o str)
+        self._parked_count += 1
+        heapq.heappush(self._parked_heap, (until, self._parked_count, chat_id))
+        for ready in self.ready:
+            ready.pop(chat_id, None)
+    
+    def _unpark(self, now):
+        """Devuelve a los carriles los chats apartados que ya tienen fichas"""
+        while self._parked_heap and self._parked_heap[0][0] <= now:
+            until, _, chat_id = heapq.heappop(self._parked_heap)
+            if self.parked.get(chat_id) != until:
+                # Entrada vieja: el chat se volvió a apartar con otro plazo
+                continue
+            del self.parked[chat_id]
+            chat_wait = self._chat_wait(chat_id, now)
+            if chat_wait > 0:
+                self._park(chat_id, now + chat_wait)
+                continue
+            for priority, queue in enumerate(self.queues.get(chat_id, ())):
+                if queue:
+                    self.ready[priority][chat_id] = None
+    
+    def _discard(self, job):
+        self._dequeue(job)
+        if job.edit_key and self.pending_edits.get(job.edit_key) is job:
+            del self.pending_edits[job.edit_key]
+        job.future.cancel()
+        self.dropped += 1
+    
+    @staticmethod
+    def _refill(bucket, capacity, rate, now):
+        bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+    
+    def _chat_limits(self, chat_id):
+        if isinstance(chat_id, int) and chat_id < 0:
+            return float(self.chat_burst), self.group_rate
+        return float(self.chat_burst), self.chat_rate
+    
+    def _chat_wait(self, chat_id, now):
+        """Segundos hasta que el chat pueda recibir otro envío (0 si ya puede)"""
+        paused = self.paused_until.get(chat_id, 0) - now
+        if paused > 0:
+            return paused
+        if chat_id is None:
+            return 0
+        capacity, rate = self._chat_limits(chat_id)
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            return 0
+        self._refill(bucket, capacity, rate, now)
+        return max(0, (1 - bucket[0]) / rate)
+    
+    def _next_job(self, now):
+        """Devuelve (job, None) con el próximo envío posible, o (None, espera)"""
+        self._refill(self._global, self.rate, self.rate, now)
+        global_wait = max(0, (1 - self._global[0]) / self.rate, self.global_paused_until - now)
+        if global_wait > 0 and any(self.queued):
+            return None, global_wait
+        
+        self._unpark(now)
+        for priority, ready in enumerate(self.ready):
+            for chat_id in ready:
+                for job in self.queues[chat_id][priority]:
+                    # Una edición del mismo mensaje sigue en vuelo: se espera su respuesta
+                    if job.edit_key not in self.in_flight_edits:
+                        return job, None
+        if self._parked_heap:
+            return None, max(0, self._parked_heap[0][0] - now)
+        return None, None
+    
+    def _start(self, job, now):
+        self._dequeue(job)
+        if job.edit_key:
+            if self.pending_edits.get(job.edit_key) is job:
+                del self.pending_edits[job.edit_key]
+            self.in_flight_edits.add(job.edit_key)
+        self._global[0] -= 1
+        if job.chat_id is not None:
+            capacity, rate = self._chat_limits(job.chat_id)
+            bucket = self.chat_buckets.setdefault(job.chat_id, [capacity, now])
+            self._refill(bucket, capacity, rate, now)
+            bucket[0] -= 1
+            chat_wait = self._chat_wait(job.chat_id, now)
+            if chat_wait > 0:
+                self._park(job.chat_id, now + chat_wait)
+        job.started = True
+        job.attempts += 1
+        if self.metrics:
+            self.metrics.observe('bot_telegram_queue_seconds', now - job.enqueued_at, priority=job.priority)
+        task = asyncio.create_task(self._send(job))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+    
+    def _evict_idle(self, now):
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            capacity, rate = self._chat_limits(chat_id)
+            if bucket[0] + (now - bucket[1]) * rate >= capacity:
+                del self.chat_buckets[chat_id]
+        for chat_id, until in list(self.paused_until.items()):
+            if until <= now:
+                del self.paused_until[chat_id]
+    
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            job, wait = self._next_job(now)
+            if job is not None:
+                self._start(job, now)
+                continue
+            if wait is None:
+                self._evict_idle(now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _send(self, job):
+        started = time.monotonic()
+        try:
+            result = await job.callback(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            until = time.monotonic() + e.retry_after
+            if job.chat_id is None:
+                # Apartar el carril None frenaría solo a los envíos sin chat; la espera es del bot entero
+                self.global_paused_until = max(self.global_paused_until, until)
+            else:
+                self.paused_until[job.chat_id] = until
+                self._park(job.chat_id, until)
+            logger.warning(f"⏳ Telegram pidió esperar {e.retry_after}s (chat {job.chat_id}, {job.endpoint})")
+            if job.attempts <= self.max_retries and job.waiters:
+                self._retry(job)
+            elif not job.future.done():
+                job.future.set_exception(e)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            if self.metrics:
+                self.metrics.observe('bot_telegram_request_seconds', time.monotonic() - started, method=job.endpoint)
+            self.in_flight_edits.discard(job.edit_key)
+            self._wakeup.set()
+    
+    def _retry(self, job):
+        self.retried += 1
+        job.started = False
+        newer = self.pending_edits.get(job.edit_key) if job.edit_key else None
+        if newer is not None:
+            # Mientras tanto llegó un texto más nuevo: se reintenta con ese
+            self._dequeue(newer)
+            job.args, job.kwargs = newer.args, newer.kwargs
+            job.priority = min(job.priority, newer.priority)
+            job.waiters += newer.waiters
+            newer.merged_into = job
+            job.future.add_done_callback(lambda done: self._chain(done, newer.future))
+            self.coalesced += 1
+        if job.edit_key:
+            self.pending_edits[job.edit_key] = job
+        self._enqueue(job, front=True)
+    
+    @staticmethod
+    def _chain(source, target):
+        if target.done():
+            return
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+
 
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
 
-class RateLimiter:
-    """Control de rate limiting por usuario"""
-    def __init__(self, max_requests=5, window_seconds=60):
-        self.max_requests = max_requests
-        self.window_seconds = window_seconds
-        self.user_requests = defaultdict(list)
-    
-    def is_allowed(self, user_id):
-        now = datetime.now()
-        self.user_requests[user_id] = [
-            req_time for req_time in self.user_requests[user_id]
-            if now - req_time < timedelta(seconds=self.window_seconds)
-        ]
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Métricas del proceso en el formato de texto de Prometheus.
+    
+    Histogramas y contadores se actualizan en el momento. Los gauges, y los
+    contadores que ya llevan otras clases (caches, SingleFlight...), se leen
+    con un callback al exportar: devuelve un número o una lista de
+    (etiquetas, valor).
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._families = {}
+        self._histograms = defaultdict(dict)
+        self._counters = defaultdict(lambda: defaultdict(float))
+        self._collectors = {}
+    
+    def histogram(self, name, help_text):
+        self._families[name] = ('histogram', help_text)
+    
+    def counter(self, name, help_text):
+        self._families[name] = ('counter', help_text)
+    
+    def collect(self, name, kind, help_text, callback):
+        self._families[name] = (kind, help_text)
+        self._collectors[name] = callback
+    
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._histograms[name].get(key)
+        if series is None:
+            # Un contador por límite, más la suma y el total
+            series = self._histograms[name][key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+    
+    def inc(self, name, amount=1, **labels):
+        self._counters[name][tuple(sorted(labels.items()))] += amount
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+    
+    def _samples(self, name):
+        if name in self._collectors:
+            try:
+                value = self._collectors[name]()
+            except Exception as e:
+                logger.error(f"Error leyendo la métrica {name}: {e}")
+                return
+            if isinstance(value, (int, float)):
+                yield name, (), value
+            else:
+                for labels, item in value:
+                    yield name, tuple(sorted(labels.items())), item
+            return
+        for key, value in self._counters[name].items():
+            yield name, key, value
+        for key, series in self._histograms[name].items():
+            for bound, count in zip(self.buckets, series):
+                yield f"{name}_bucket", key + (('le', bound),), count
+            yield f"{name}_bucket", key + (('le', '+Inf'),), series[-1]
+            yield f"{name}_sum", key, series[-2]
+            yield f"{name}_count", key, series[-1]
+    
+    def render(self):
+        lines = []
+        for name, (kind, help_text) in self._families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in self._samples(name):
+                lines.append(f"{sample}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+def record_span(name, seconds):
+    """Agrega al update en curso un tramo de `seconds` que terminó recién (fuera de un update no hace nada)"""
+    trace = _current_trace.get()
+    if trace is not None:
+        finished = time.monotonic()
+        trace.add_span(name, finished - seconds, finished)
+
+
+@contextmanager
+def trace_span(name):
+    """Mide el bloque como un tramo del update en curso"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record_span(name, time.monotonic() - started)
+
+
+class Trace:
+    """Tramos (búsqueda, descarga, render, llamadas a la API) medidos durante un update"""
+    def __init__(self, route):
+        self.route = route
+        self.started = time.monotonic()
+        self.finished = None
+        self.spans = []
+        self.samples = defaultdict(int)
+    
+    def add_span(self, name, started, finished):
+        # Lo que sigue en segundo plano después de responder ya no es parte del update
+        if self.finished is None:
+            self.spans.append((name, started - self.started, finished - started))
+    
+    def breakdown(self):
+        """Texto con el tiempo total por tipo de tramo, de mayor a menor"""
+        totals = defaultdict(lambda: [0.0, 0])
+        for name, _, seconds in self.spans:
+            totals[name][0] += seconds
+            totals[name][1] += 1
+        parts = []
+        for name, (seconds, count) in sorted(totals.items(), key=lambda item: -item[1][0]):
+            parts.append(f"{name} {seconds:.2f}s" + (f" ×{count}" if count > 1 else ""))
+        return ', '.join(parts) or 'sin tramos'
+
+
+class SamplingProfiler:
+    """Muestrea la pila del event loop desde un thread aparte y la suma al Trace del update que se ejecuta.
+    
+    Solo ve el código que corre en el loop (no lo que espera red o procesos),
+    que es justo lo que frena a todos los demás updates. El thread no toca
+    el estado de asyncio: reconoce el update por el frame de la corrutina de
+    su tarea dentro de la pila muestreada.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # Frame de la corrutina de cada tarea vigilada -> su Trace
+        self._traces = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._loop_thread = None
+    
+    def start(self):
+        """Se llama desde el event loop que se quiere muestrear"""
+        self._loop_thread = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=1)
+    
+    @staticmethod
+    def _task_frame():
+        return asyncio.current_task().get_coro().cr_frame
+    
+    def watch(self, trace):
+        frame = self._task_frame()
+        with self._lock:
+            self._traces[frame] = trace
+    
+    def unwatch(self, trace):
+        """Deja de muestrear el update; después de esto el thread ya no escribe en trace.samples"""
+        frame = self._task_frame()
+        with self._lock:
+            if self._traces.get(frame) is trace:
+                del self._traces[frame]
+    
+    @staticmethod
+    def _stack(frame, limit=64):
+        names = []
+        while frame is not None and len(names) < limit:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self._traces:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            with self._lock:
+                # El frame más externo de la pila que sea de una tarea vigilada
+                trace = None
+                outer = frame
+                while outer is not None:
+                    trace = self._traces.get(outer, trace)
+                    outer = outer.f_back
+                if trace is not None:
+                    trace.samples[self._stack(frame)] += 1
+
+
+class Tracer:
+    """Abre un Trace por update, mide su duración por ruta y explica los lentos.
+    
+    Los updates que pasan slow_seconds se registran en el log con el desglose
+    de sus tramos; con el profiler activo, además se guardan sus pilas más
+    frecuentes en profile_dir (formato "folded", apto para flamegraph).
+    """
+    def __init__(self, metrics=None, slow_seconds=3.0, profiler=None, profile_dir=None, max_profiles=200):
+        self.metrics = metrics
+        self.slow_seconds = slow_seconds
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self.max_profiles = max_profiles
+        self.profiles = 0
+        if metrics:
+            metrics.histogram('bot_update_seconds', 'Duración de cada update, por ruta')
+            metrics.counter('bot_slow_updates_total', 'Updates más lentos que TRACE_SLOW_SECONDS')
+    
+    def start(self):
+        if self.profiler:
+            self.profiler.start()
+    
+    def stop(self):
+        if self.profiler:
+            self.profiler.stop()
+    
+    @contextmanager
+    def trace(self, route):
+        trace = Trace(route)
+        token = _current_trace.set(trace)
+        if self.profiler:
+            self.profiler.watch(trace)
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+            if self.profiler:
+                self.profiler.unwatch(trace)
+            trace.finished = time.monotonic()
+            self._finish(trace, trace.finished - trace.started)
+    
+    def _finish(self, trace, elapsed):
+        if self.metrics:
+            self.metrics.observe('bot_update_seconds', elapsed, route=trace.route)
+        if not self.slow_seconds or elapsed < self.slow_seconds:
+            return
+        if self.metrics:
+            self.metrics.inc('bot_slow_updates_total', route=trace.route)
+        logger.warning(f"🐢 Update lento {trace.route}: {elapsed:.2f}s ({trace.breakdown()})")
+        if trace.samples and self.profile_dir and self.profiles < self.max_profiles:
+            self.profiles += 1
+            # Copia en el loop: el thread del executor no comparte el dict con nadie
+            asyncio.get_running_loop().run_in_executor(None, self._dump, trace.route, dict(trace.samples), elapsed)
+    
+    def _dump(self, route, samples, elapsed):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        route = re.sub(r'[^\w.-]', '_', route)
+        path = os.path.join(self.profile_dir, f"{datetime.now():%Y%m%d-%H%M%S}-{route}-{int(elapsed * 1000)}ms.folded")
+        with open(path, 'w') as profile:
+            for stack, count in sorted(samples.items(), key=lambda item: -item[1]):
+                profile.write(f"{stack} {count}\n")
+        logger.info(f"🔥 Perfil del update lento guardado en {path}")
+
+
+class DownloadMetrics:
+    """Contadores por camino de entrega: remux/transcode y direct/file"""
+    def __init__(self):
+        self.paths = defaultdict(lambda: {'count': 0, 'bytes': 0, 'cpu_seconds': 0.0, 'seconds': 0.0})
+        self.failures = 0
+    
+    def record(self, stats):
+        key = f"{stats['path']}/{stats['mode']}"
+        totals = self.paths[key]
+        totals['count'] += 1
+        for field in ('bytes', 'cpu_seconds', 'seconds'):
+            totals[field] += stats[field]
+        logger.info(
+            f"📊 Entrega {key}: {stats['bytes']} bytes, CPU {stats['cpu_seconds']:.2f}s, "
+            f"{stats['seconds']:.1f}s (promedio CPU {totals['cpu_seconds'] / totals['count']:.2f}s)"
+        )
+    
+    def summary(self):
+        return {key: dict(totals) for key, totals in self.paths.items()}
+
+
+class FileIdCache:
+    """Cache persistente (video_id, calidad) -> file_id de Telegram.
+    
+    Un audio que ya se subió una vez se reenvía con su file_id sin
+    descargar ni convertir de nuevo. Se guarda en SQLite, una fila por
+    audio, desde un thread dedicado: cada subida escribe solo su fila.
+    """
+    # Errores de la Bot API que indican que el file_id ya no sirve
+    INVALID_FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'file reference', 'file_reference')
+    
+    def __init__(self, path, max_entries=50000, legacy_path=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        self._conn = None
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='file-ids')
+        self._load(legacy_path)
+    
+    def _load(self, legacy_path):
+        try:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_ids (key TEXT PRIMARY KEY, file_id TEXT NOT NULL, title TEXT NOT NULL)"
+            )
+            # rowid crece con cada INSERT OR REPLACE: el orden es del más viejo al más reciente
+            for key, file_id, title in self._conn.execute("SELECT key, file_id, title FROM file_ids ORDER BY rowid"):
+                self.entries[key] = {'file_id': file_id, 'title': title}
+            if not self.entries and legacy_path and os.path.exists(legacy_path):
+                self._import_json(legacy_path)
+            logger.info(f"💾 Cache de file_id: {len(self.entries)} audios")
+        except sqlite3.Error as e:
+            logger.error(f"Error leyendo cache de file_id: {e}")
+    
+    def _import_json(self, legacy_path):
+        """Migra el archivo JSON de versiones anteriores"""
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error leyendo cache de file_id: {e}")
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO file_ids (key, file_id, title) VALUES (?, ?, ?)",
+                [(key, entry['file_id'], entry['title']) for key, entry in self.entries.items()]
+            )
+        os.replace(legacy_path, f"{legacy_path}.migrated")
+    
+    def _write(self, key, entry, evicted):
+        with self._conn:
+            if entry is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO file_ids (key, file_id, title) VALUES (?, ?, ?)",
+                    (key, entry['file_id'], entry['title'])
+                )
+            self._conn.executemany("DELETE FROM file_ids WHERE key = ?", [(old,) for old in evicted])
+    
+    async def _save(self, key, entry, evicted=()):
+        if self._conn is None:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._thread, self._write, key, entry, list(evicted))
+        except sqlite3.Error as e:
+            logger.error(f"Error guardando cache de file_id: {e}")
+    
+    @staticmethod
+    def _key(video_id, quality):
+        return f"{video_id}:{quality}"
+    
+    @classmethod
+    def is_invalid_file_id(cls, error):
+        message = str(error).lower()
+        return any(text in message for text in cls.INVALID_FILE_ID_ERRORS)
+    
+    def get(self, video_id, quality):
+        return self.entries.get(self._key(video_id, quality))
+    
+    async def set(self, video_id, quality, file_id, title):
+        key = self._key(video_id, quality)
+        self.entries.pop(key, None)
+        self.entries[key] = entry = {'file_id': file_id, 'title': title}
+        evicted = []
+        while len(self.entries) > self.max_entries:
+            oldest = next(iter(self.entries))
+            del self.entries[oldest]
+            evicted.append(oldest)
+        await self._save(key, entry, evicted)
+    
+    async def discard(self, video_id, quality):
+        key = self._key(video_id, quality)
+        if self.entries.pop(key, None) is not None:
+            await self._save(None, None, [key])
+    
+    def close(self):
+        self._thread.shutdown(wait=True)
+        if self._conn is not None:
+            self._conn.close()
+
+
+class AudioCache:
+    """Cache en disco de audios convertidos, direccionada por (video_id, perfil).
+    
+    Cada entrada es el audio más un .json con su título; el nombre sale de un
+    hash de la clave, así que lo comparten todos los usuarios. Se escribe en un
+    temporal y se renombra, y se descartan los menos usados al pasar el
+    presupuesto de bytes. Al arrancar el índice se reconstruye desde la carpeta.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+    
+    @staticmethod
+    def _key(video_id, cache_key):
+        return hashlib.sha1(f"{video_id}:{cache_key}".encode()).hexdigest()
+    
+    def _path(self, name, ext):
+        return os.path.join(self.directory, f"{name}.{ext}")
+    
+    def rebuild(self):
+        """Reconstruye el índice desde disco (ordenado por último uso) y limpia restos"""
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+                continue
+            if not entry.name.endswith('.json'):
+                continue
+            name = entry.name[:-5]
+            try:
+                with open(entry.path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                stat = os.stat(self._path(name, meta['ext']))
+            except (OSError, ValueError, KeyError):
+                os.remove(entry.path)
+                continue
+            found.append((stat.st_mtime, name, stat.st_size, meta))
         
-        if len(self.user_requests[user_id]) >= self.max_requests:
-            return False
+        known = {name for _, name, _, _ in found}
+        for entry in os.scandir(self.directory):
+            if entry.name.rsplit('.', 1)[0] not in known:
+                os.remove(entry.path)
         
-        self.user_requests[user_id].append(now)
-        return True
+        for _, name, size, meta in sorted(found):
+            self.index[name] = (size, meta['ext'], meta.get('title', 'Audio'))
+            self.total_bytes += size
+        self._evict_sync()
+        logger.info(f"💽 Cache de audio: {len(self.index)} archivos, {self.total_bytes // (1024 * 1024)} MB")
     
-    def get_wait_time(self, user_id):
-        if not self.user_requests[user_id]:
-            return 0
-        oldest = min(self.user_requests[user_id])
-        wait = self.window_seconds - (datetime.now() - oldest).seconds
-        return max(0, wait)
+    def contains(self, video_id, cache_key):
+        return self._key(video_id, cache_key) in self.index
+    
+    def _read(self, name, ext):
+        path = self._path(name, ext)
+        with open(path, 'rb') as f:
+            data = f.read()
+        # mtime marca el último uso para el orden LRU tras reiniciar
+        os.utime(path)
+        return data
+    
+    async def get(self, video_id, cache_key):
+        """Devuelve (bytes, título) o None"""
+        name = self._key(video_id, cache_key)
+        entry = self.index.get(name)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.index.move_to_end(name)
+        size, ext, title = entry
+        try:
+            data = await asyncio.to_thread(self._read, name, ext)
+        except OSError:
+            self._drop(name)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data, title
+    
+    def _adopt(self, name, ext, source, title):
+        """Lee el audio que dejó el worker y lo mueve a la cache (o lo borra si no entra)"""
+        with open(source, 'rb') as f:
+            data = f.read()
+        if not self.enabled or len(data) > self.max_bytes:
+            os.remove(source)
+            return data, False
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # move en vez de reescribir: si está en el mismo disco es solo un rename
+            path = self._path(name, ext)
+            shutil.move(source, f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+            meta_path = self._path(name, 'json')
+            with open(f"{meta_path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump({'ext': ext, 'title': title}, f, ensure_ascii=False)
+            os.replace(f"{meta_path}.tmp", meta_path)
+        except OSError as e:
+            logger.error(f"Error guardando audio en cache: {e}")
+            if os.path.exists(source):
+                os.remove(source)
+            return data, False
+        return data, True
+    
+    async def adopt(self, video_id, cache_key, ext, source, title):
+        """Incorpora el archivo descargado por el worker y devuelve sus bytes"""
+        name = self._key(video_id, cache_key)
+        data, stored = await asyncio.to_thread(self._adopt, name, ext, source, title)
+        if not stored:
+            return data
+        self._drop(name)
+        self.index[name] = (len(data), ext, title)
+        self.total_bytes += len(data)
+        doomed = self._evict()
+        if doomed:
+            await asyncio.to_thread(self._remove_files, doomed)
+        return data
+    
+    def _drop(self, name):
+        entry = self.index.pop(name, None)
+        if entry is None:
+            return None
+        self.total_bytes -= entry[0]
+        return name, entry[1]
+    
+    def _evict(self):
+        """Saca del índice las entradas menos usadas hasta entrar en el presupuesto"""
+        doomed = []
+        while self.total_bytes > self.max_bytes and self.index:
+            doomed.append(self._drop(next(iter(self.index))))
+            self.evictions += 1
+        return doomed
+    
+    def _evict_sync(self):
+        self._remove_files(self._evict())
+    
+    def _remove_files(self, entries):
+        for name, ext in entries:
+            for path in (self._path(name, 'json'), self._path(name, ext)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
 
 
 class MusicBot:
     def __init__(self):
-        self.user_searches = {}
-        self.user_playlists = {}
-        self.rate_limiter = RateLimiter(max_requests=20, window_seconds=60)
+        self.user_searches = SessionStore(max_entries=SESSION_MAX_USERS, idle_ttl=SESSION_IDLE_TTL)
+        self.state_backend = create_state_backend()
+        # Sin backend persistente, desalojar una playlist sería perderla: solo se acotan si se guardan
+        if self.state_backend.persistent:
+            self.user_playlists = SessionStore(max_entries=PLAYLIST_MAX_USERS, idle_ttl=PLAYLIST_IDLE_TTL)
+        else:
+            self.user_playlists = SessionStore(max_entries=math.inf, idle_ttl=math.inf)
+        # Cambios de playlist aún no guardados, solo con backend compartido
+        self.playlist_changes = {}
+        limiter_class = RateLimiter
+        limiter_args = {}
+        if self.state_backend.shared:
+            # Varias réplicas: los buckets viven en el servidor compartido
+            limiter_class = SharedRateLimiter
+            limiter_args = {'backend': self.state_backend}
+        self.rate_limiter = limiter_class(
+            max_requests=RATE_LIMIT_PER_MINUTE,
+            window_seconds=60,
+            global_max_requests=RATE_LIMIT_GLOBAL_PER_MINUTE,
+            **limiter_args
+        )
+        for operation, cost in OPERATION_COSTS.items():
+            if cost > self.rate_limiter.max_cost:
+                logger.warning(
+                    f"⚠️ {operation} cuesta {cost} fichas y el límite es {self.rate_limiter.max_cost}: "
+                    f"se cobrará el límite entero"
+                )
+        self.search_cache = SearchCache(ttl_seconds=SEARCH_CACHE_TTL, max_results=SEARCH_CACHE_MAX_RESULTS)
+        self.search_executor = SearchExecutor(max_workers=SEARCH_WORKERS, max_queue=SEARCH_QUEUE_MAX)
+        # Búsquedas que siguen llenando la sesión por usuario, y la sesión cuyo mensaje se re-dibuja
+        self.search_fill_tasks = {}
+        self.search_progress = {}
+        self.search_ydl_pool = YoutubeDLPool(SEARCH_YDL_OPTS, max_uses=YDL_MAX_USES, max_age=YDL_MAX_AGE)
+        self.download_engine = DownloadEngine(
+            workers=DOWNLOAD_WORKERS, max_queue=DOWNLOAD_QUEUE_MAX,
+            warm_opts=AUDIO_PROFILES[AUDIO_PROFILE]['ydl_opts']
+        )
+        self.download_metrics = DownloadMetrics()
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.tracer = Tracer(
+            metrics=self.metrics,
+            slow_seconds=TRACE_SLOW_SECONDS,
+            profiler=SamplingProfiler(PROFILE_INTERVAL) if PROFILE_SLOW_UPDATES else None,
+            profile_dir=PROFILE_DIR,
+        )
+        # Descargas en curso por (video_id, perfil): pedidos simultáneos comparten una sola
+        self.download_flights = SingleFlight()
+        self.audio_cache = AudioCache(AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES)
+        # Quién quiere ver el progreso de cada descarga en curso
+        self.download_listeners = {}
+        # Subida a Telegram en curso por (video_id, perfil); se resuelve con el file_id
+        self.audio_uploads = {}
+        self.prefetcher = Prefetcher(per_user=PREFETCH_PER_USER, max_global=PREFETCH_MAX_GLOBAL)
         self.download_folder = 'downloads'
         os.makedirs(self.download_folder, exist_ok=True)
+        os.makedirs(DATA_DIR, exist_ok=True)
+        self.file_id_cache = FileIdCache(
+            os.path.join(DATA_DIR, 'file_ids.db'), legacy_path=os.path.join(DATA_DIR, 'file_ids.json')
+        )
+        self.storage = Storage(self.state_backend, self.snapshot_user, flush_interval=STORAGE_FLUSH_INTERVAL)
+        # Usuarios cuyo estado ya se trajo de SQLite (expira junto con las sesiones)
+        self.loaded_users = SessionStore(max_entries=SESSION_MAX_USERS, idle_ttl=SESSION_IDLE_TTL)
+        self.register_metrics()
+    
+    def register_metrics(self):
+        """Declara las métricas del bot; los gauges se leen del estado actual al exportar"""
+        metrics = self.metrics
+        metrics.histogram('bot_search_seconds', 'Duración de cada consulta a YouTube, por variante')
+        metrics.histogram('bot_download_seconds', 'Descarga con yt-dlp dentro del worker (en modo direct incluye la conversión)')
+        metrics.histogram('bot_postprocess_seconds', 'Conversión con FFmpeg después de la descarga (modo file)')
+        metrics.histogram('bot_download_queue_seconds', 'Espera de un proceso de descarga libre')
+        metrics.counter('bot_download_cpu_seconds_total', 'CPU usada por las descargas y conversiones')
+        metrics.counter('bot_timeouts_total', 'Operaciones cortadas por timeout')
+        metrics.counter('bot_unavailable_total', 'Respuestas "MATERIAL NO DISPONIBLE"')
+        metrics.collect('bot_active_sessions', 'gauge', 'Sesiones de búsqueda en memoria', lambda: len(self.user_searches))
+        stores = {
+            'user_searches': self.user_searches,
+            'user_playlists': self.user_playlists,
+            'loaded_users': self.loaded_users,
+        }
+        metrics.collect('bot_session_store_size', 'gauge', 'Entradas en memoria de cada SessionStore', lambda: [
+            ({'store': name}, store.stats()['size']) for name, store in stores.items()
+        ])
+        metrics.collect('bot_session_evictions_total', 'counter', 'Entradas desalojadas de cada SessionStore', lambda: [
+            ({'store': name, 'reason': reason}, store.stats()[f"evicted_{reason}"])
+            for name, store in stores.items() for reason in ('idle', 'capacity')
+        ])
+        # Con estado compartido los buckets están en el servidor: esta réplica no puede contarlos
+        if not self.state_backend.shared:
+            metrics.collect('bot_rate_limited_users', 'gauge', 'Usuarios sin fichas de rate limit',
+                            self.rate_limiter.limited_users)
+        metrics.collect('bot_jobs_in_flight', 'gauge', 'Trabajos en curso o en cola', lambda: [
+            ({'kind': 'search'}, self.search_executor.pending),
+            ({'kind': 'download'}, self.download_engine.pending),
+            ({'kind': 'prefetch'}, self.prefetcher.active()),
+        ])
+        metrics.collect('bot_download_coalesced_total', 'counter', 'Pedidos de descarga unidos a una ya en curso',
+                        lambda: self.download_flights.coalesced)
+        metrics.collect('bot_download_failures_total', 'counter', 'Descargas que no produjeron audio',
+                        lambda: self.download_metrics.failures)
+        metrics.collect('bot_cache_hits_total', 'counter', 'Aciertos de cache', lambda: [
+            ({'cache': 'search'}, self.search_cache.hits),
+            ({'cache': 'audio'}, self.audio_cache.hits),
+        ])
+        metrics.collect('bot_cache_misses_total', 'counter', 'Fallos de cache', lambda: [
+            ({'cache': 'search'}, self.search_cache.misses),
+            ({'cache': 'audio'}, self.audio_cache.misses),
+        ])
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Comando /start - Menú principal mejorado"""
@@ -198,6 +2863,34 @@ class MusicBot:
             parse_mode='Markdown'
         )
     
+    def format_download_progress(self, progress):
+        """Líneas de progreso de una descarga para el mensaje de espera"""
+        if not progress:
+            return "⏳ Preparando..."
+        if progress['phase'] == 'converting':
+            return "🔄 Convirtiendo el audio..."
+        
+        parts = []
+        if progress.get('percent') is not None:
+            filled = int(progress['percent'] // 10)
+            parts.append(f"{'▰' * filled}{'▱' * (10 - filled)} {progress['percent']:.0f}%")
+        elif progress.get('bytes'):
+            parts.append(f"{progress['bytes'] / (1024 * 1024):.1f} MB")
+        if progress.get('speed'):
+            parts.append(f"{progress['speed'] / (1024 * 1024):.1f} MB/s")
+        if progress.get('eta') is not None:
+            eta = int(progress['eta'])
+            parts.append(f"ETA {eta // 60}:{eta % 60:02d}")
+        label = "⬇️ Descargando" if progress['phase'] == 'downloading' else "🎧 Preparando audio"
+        return f"{label}\n{' • '.join(parts)}" if parts else label
+    
+    def download_progress_message(self, query, header):
+        """ProgressMessage que edita el mensaje del callback con el encabezado y el progreso"""
+        return ProgressMessage(
+            lambda text: query.edit_message_text(text, parse_mode='Markdown'),
+            lambda progress: f"{header}\n\n{self.format_download_progress(progress)}",
+        )
+    
     def format_duration(self, duration):
         """Formatea la duración de forma segura"""
         try:
@@ -210,181 +2903,565 @@ class MusicBot:
         except (ValueError, TypeError):
             return ""
     
-    async def search_music(self, query: str, max_results=100, karaoke=False):
-        """Busca música en YouTube - TODOS LOS RESULTADOS"""
-        search_query = f"{query} karaoke" if karaoke else query
-        
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-            'default_search': f'ytsearch{max_results}',
-            'socket_timeout': 30,
-            'extractor_args': {'youtube': {'skip': ['hls', 'dash']}},
-            'no_check_certificate': True,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        }
+    def _extract_search(self, search_url, on_result, cancel_event):
+        """Corre en un thread del SearchExecutor; entrega cada resultado a on_result y revisa la cancelación"""
+        with self.search_ydl_pool.borrow() as ydl:
+            results = ydl.extract_info(search_url, download=False, process=False)
+            # Con process=False yt-dlp entrega los resultados de forma perezosa, página a página
+            for entry in (results or {}).get('entries') or []:
+                if cancel_event.is_set():
+                    raise SearchCancelled()
+                result = SearchResult.from_entry(entry)
+                if result:
+                    on_result(result)
+    
+    async def _iter_extract(self, search_url, owner=None, variant='songs'):
+        """Async iterator sobre una búsqueda de yt-dlp: entrega lotes con lo que llegó desde el último"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        queue = asyncio.Queue()
+        job = asyncio.ensure_future(self.search_executor.run(
+            self._extract_search, search_url,
+            lambda result: loop.call_soon_threadsafe(queue.put_nowait, result),
+            owner=owner
+        ))
+        # Los resultados se encolan antes de que termine el thread, así que None siempre va último
+        job.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while True:
+                batch = [await queue.get()]
+                while not queue.empty():
+                    batch.append(queue.get_nowait())
+                finished = batch[-1] is None
+                if finished:
+                    batch.pop()
+                if batch:
+                    yield batch
+                if finished:
+                    break
+            job.result()
+            self.metrics.observe('bot_search_seconds', loop.time() - started, variant=variant)
+        finally:
+            record_span(f"search:{variant}", loop.time() - started)
+            if not job.done():
+                job.cancel()
+            elif not job.cancelled():
+                # Si se abandonó el iterador antes de tiempo, el error ya no le importa a nadie
+                job.exception()
+    
+    async def _cached_stream(self, query, mode, max_results, factory):
+        """Entrega la búsqueda desde la cache o desde factory(); guarda en cache solo resultados completos"""
+        cached = self.search_cache.get(query, mode, max_results)
+        if cached is not None:
+            yield cached
+            return
         
+        results = []
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                logger.info(f"Buscando: {search_query} (max: {max_results})")
-                results = ydl.extract_info(f"ytsearch{max_results}:{search_query}", download=False)
-                entries = results.get('entries', []) if results else []
-                logger.info(f"Encontrados: {len(entries)} resultados")
-                return entries
+            async for batch in factory():
+                results.extend(batch)
+                yield batch
+        except (SearchBusyError, SearchCancelled):
+            raise
+        except SearchIncomplete as e:
+            # Lo parcial ya se entregó, pero no se reutiliza durante todo el TTL
+            logger.warning(f"Búsqueda incompleta, no se guarda en cache: {e}")
+            return
         except Exception as e:
             logger.error(f"Error en búsqueda: {e}")
-            return []
+            return
+        
+        logger.info(f"Encontrados: {len(results)} resultados ({mode})")
+        self.search_cache.put(query, mode, max_results, results)
     
-    async def search_discography(self, artist: str, max_results=200):
-        """Busca discografía completa de un artista"""
-        search_queries = [
-            f"{artist} discography full",
-            f"{artist} all albums",
-            f"{artist} complete discography",
-            f"{artist} full album",
-            f"{artist} álbum completo"
-        ]
+    @staticmethod
+    async def _collect(stream):
+        results = []
+        async for batch in stream:
+            results.extend(batch)
+        return results
+    
+    def stream_music(self, query: str, max_results=SEARCH_MAX_RESULTS, karaoke=False, owner=None, mode=None):
+        """Busca música en YouTube y entrega los resultados por lotes a medida que llegan"""
+        mode = mode or ("karaoke" if karaoke else "songs")
+        search_query = f"{query} karaoke" if karaoke else query
         
-        all_results = []
-        seen_ids = set()
+        def extract():
+            logger.info(f"Buscando: {search_query} (max: {max_results})")
+            return self._iter_extract(f"ytsearch{max_results}:{search_query}", owner=owner, variant=mode)
         
-        for search_query in search_queries:
-            ydl_opts = {
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': True,
-                'default_search': f'ytsearch{max_results // len(search_queries)}',
-                'socket_timeout': 30,
-                'extractor_args': {'youtube': {'skip': ['hls', 'dash']}},
-                'no_check_certificate': True,
-                'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            }
+        return self._cached_stream(query, mode, max_results, extract)
+    
+    async def search_music(self, query: str, max_results=SEARCH_MAX_RESULTS, karaoke=False, owner=None, mode=None):
+        """Busca música en YouTube - TODOS LOS RESULTADOS"""
+        return await self._collect(self.stream_music(query, max_results, karaoke, owner, mode))
+    
+    def stream_for_session(self, session, owner=None):
+        """Stream completo de la búsqueda guardada en una sesión"""
+        search_type = session.get('search_type', 'songs')
+        if search_type == 'discography':
+            return self.stream_discography(session['query'], owner=owner)
+        if search_type == 'albums':
+            return self.stream_albums(session['query'], owner=owner)
+        return self.stream_music(session['query'], karaoke=search_type == 'karaoke', owner=owner)
+    
+    def start_search_fill(self, user_id, session, stream=None, render=None, ready_at=None):
+        """Lanza la tarea que va llenando session['results'].
+        
+        Devuelve (tarea, evento) donde el evento se activa al juntar ready_at resultados.
+        """
+        previous = self.search_fill_tasks.pop(user_id, None)
+        if previous:
+            previous.cancel()
+        ready = asyncio.Event()
+        stream = stream or self.stream_for_session(session, owner=user_id)
+        task = asyncio.create_task(self.fill_search_results(user_id, session, stream, render, ready, ready_at))
+        self.search_fill_tasks[user_id] = task
+        
+        def finished(_):
+            if self.search_fill_tasks.get(user_id) is task:
+                del self.search_fill_tasks[user_id]
+            if not task.cancelled() and task.exception():
+                error = task.exception()
+                if not isinstance(error, (SearchBusyError, SearchCancelled)):
+                    logger.error(f"Error completando resultados: {error}")
+        
+        task.add_done_callback(finished)
+        return task, ready
+    
+    async def fill_search_results(self, user_id, session, stream, render=None, ready=None, ready_at=None):
+        """Agrega a la sesión los resultados nuevos del stream y re-dibuja con frecuencia limitada"""
+        loop = asyncio.get_running_loop()
+        # Se agregan al final: los índices que el usuario ya ve no cambian
+        results = session['results']
+        seen_ids = {result.id for result in results}
+        last_render = loop.time()
+        try:
+            async for batch in stream:
+                # La sesión pudo cambiar mientras tanto (nueva búsqueda, menú principal)
+                if self.user_searches.peek(user_id) is not session:
+                    return
+                for result in batch:
+                    if result.id not in seen_ids:
+                        seen_ids.add(result.id)
+                        results.append(result)
+                if ready_at and len(results) >= ready_at:
+                    ready.set()
+                if render and loop.time() - last_render >= SEARCH_PROGRESS_INTERVAL:
+                    last_render = loop.time()
+                    await render(partial=True)
+        finally:
+            await stream.aclose()
+        
+        session['complete'] = True
+        if render:
+            await render(partial=False)
+        if self.user_searches.peek(user_id) is session:
+            await self.storage.release(user_id)
+    
+    async def complete_search_results(self, user_id, session, timeout=60.0):
+        """Espera (o lanza) la búsqueda completa cuando el usuario pide una página que aún no está.
+        
+        Relanzarla (sesión recuperada del backend) es otra consulta a YouTube y
+        se cobra como tal. Devuelve los segundos de espera del rate limit.
+        """
+        task = self.search_fill_tasks.get(user_id)
+        if task is None and not session.get('complete', True):
+            search_type = session.get('search_type', 'songs')
+            if search_type in ('discography', 'albums'):
+                cost, max_results = OPERATION_COSTS[search_type], 200
+            else:
+                cost, max_results = OPERATION_COSTS['search'], SEARCH_MAX_RESULTS
+            if not self.search_cache.contains(session['query'], search_type, max_results):
+                wait_time = await self.rate_limiter.check(user_id, cost)
+                if wait_time:
+                    return wait_time
+            task, _ = self.start_search_fill(user_id, session)
+        if task:
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+            if not done:
+                logger.warning(f"Resultados adicionales demorados para {user_id}")
+        return 0
+    
+    def _drop_search_session(self, user_id, session):
+        self.search_progress.pop(user_id, None)
+        if self.user_searches.peek(user_id) is session:
+            self.user_searches.pop(user_id, None)
+    
+    async def render_search(self, user_id, session, search_msg, build_text, empty_text, partial):
+        """Dibuja la lista de resultados en search_msg; partial=True mientras sigue la búsqueda.
+        
+        Deja de tocar el mensaje cuando el usuario ya lo está usando (pulsó algún botón).
+        """
+        async with session.setdefault('render_lock', asyncio.Lock()):
+            if self.search_progress.get(user_id) is not session:
+                return
+            if partial and session.get('complete'):
+                return
+            results = session['results']
+            
+            if not results:
+                if partial:
+                    return
+                self._drop_search_session(user_id, session)
+                keyboard = [[InlineKeyboardButton("🏠 Volver al Menú", callback_data="back_to_main_menu")]]
+                await search_msg.edit_text(
+                    empty_text,
+                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    parse_mode='Markdown'
+                )
+                return
             
+            keyboard = self.create_results_keyboard(
+                results, page=0, search_type=session['search_type'], complete=not partial
+            )
             try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    logger.info(f"Buscando discografía: {search_query}")
-                    results = ydl.extract_info(f"ytsearch{max_results // len(search_queries)}:{search_query}", download=False)
-                    entries = results.get('entries', []) if results else []
-                    
-                    for entry in entries:
-                        video_id = entry.get('id')
-                        duration = entry.get('duration', 0)
-                        
-                        if video_id and video_id not in seen_ids and duration >= 600:
-                            seen_ids.add(video_id)
-                            all_results.append(entry)
-                    
-                    await asyncio.sleep(1)
-            except Exception as e:
-                logger.error(f"Error en búsqueda de discografía: {e}")
-                continue
+                # Los re-dibujos intermedios ceden el paso a los envíos de otros usuarios
+                with outbound_priority(PRIORITY_LOW if partial else PRIORITY_NORMAL):
+                    await search_msg.edit_text(
+                        build_text(len(results), partial),
+                        reply_markup=InlineKeyboardMarkup(keyboard),
+                        parse_mode='Markdown'
+                    )
+            except TelegramError as e:
+                # Un re-dibujo intermedio que falla no corta la búsqueda
+                if not partial:
+                    raise
+                logger.warning(f"No se pudo actualizar el progreso de la búsqueda: {e}")
+            if not partial:
+                self.search_progress.pop(user_id, None)
+    
+    async def run_search(self, user_id, session, search_msg, stream, build_text, empty_text,
+                         timeout, timeout_text, lazy=False):
+        """Llena la sesión desde stream mostrando resultados a medida que llegan.
+        
+        Con lazy=True vuelve apenas hay una página y el resto sigue en segundo plano.
+        """
+        self.user_searches[user_id] = session
+        self.search_progress[user_id] = session
+        
+        async def render(partial):
+            with trace_span('render'):
+                await self.render_search(user_id, session, search_msg, build_text, empty_text, partial)
         
-        logger.info(f"Total discografía encontrada: {len(all_results)} álbumes/compilaciones")
-        return all_results
+        task, ready = self.start_search_fill(
+            user_id, session, stream, render=render, ready_at=SEARCH_PAGE_SIZE if lazy else None
+        )
+        ready_waiter = asyncio.ensure_future(ready.wait())
+        try:
+            waiters = {task, ready_waiter} if lazy else {task}
+            done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise asyncio.TimeoutError()
+            if task in done:
+                if task.cancelled():
+                    return
+                task.result()
+            else:
+                # Primera página lista: se muestra y el resto se agrega en segundo plano
+                await render(partial=True)
+        except asyncio.TimeoutError:
+            task.cancel()
+            self.metrics.inc('bot_timeouts_total', operation='search')
+            if session['results']:
+                session['complete'] = True
+                await render(partial=False)
+                return
+            self._drop_search_session(user_id, session)
+            await search_msg.edit_text(f"⏰ *Tiempo agotado*\n\n{timeout_text}")
+        except Exception as e:
+            self._drop_search_session(user_id, session)
+            await self.show_search_error(search_msg, e)
+        finally:
+            ready_waiter.cancel()
     
-    async def search_albums(self, query: str, max_results=200):
-        """Busca álbumes completos"""
-        search_queries = [
-            f"{query} full album",
-            f"{query} álbum completo",
-            f"{query} complete album",
-            f"{query} disco completo"
-        ]
+    async def show_search_error(self, search_msg, error):
+        """Avisa en search_msg por qué no se pudo completar la búsqueda"""
+        if isinstance(error, SearchBusyError):
+            await search_msg.edit_text(
+                "🚦 *Servidor ocupado*\n\n"
+                "Hay muchas búsquedas en curso.\n"
+                "Intenta de nuevo en unos segundos.",
+                parse_mode='Markdown'
+            )
+        elif isinstance(error, SearchCancelled):
+            await search_msg.edit_text("🚫 Búsqueda cancelada.")
+        else:
+            logger.error(f"Error: {error}")
+            await search_msg.edit_text(
+                "❌ *Error en la búsqueda*\n\n"
+                "Ocurrió un problema. Intenta de nuevo."
+            )
+    
+    async def _stream_variants(self, query, suffixes, per_query, label, owner=None):
+        """Lanza las variantes de búsqueda ("query sufijo") en paralelo y entrega lotes nuevos, sin duplicados"""
+        semaphore = asyncio.Semaphore(SEARCH_FANOUT)
+        queue = asyncio.Queue()
+        failed = []
+        
+        async def run_variant(suffix):
+            search_query = f"{query} {suffix}"
+            async with semaphore:
+                try:
+                    logger.info(f"Buscando {label}: {search_query}")
+                    # La métrica se etiqueta con el sufijo, nunca con el texto del usuario
+                    async for batch in self._iter_extract(
+                        f"ytsearch{per_query}:{search_query}", owner=owner, variant=suffix
+                    ):
+                        queue.put_nowait(batch)
+                except (SearchBusyError, SearchCancelled):
+                    raise
+                except Exception as e:
+                    logger.error(f"Error en búsqueda de {label}: {e}")
+                    failed.append(search_query)
+        
+        tasks = [asyncio.create_task(run_variant(suffix)) for suffix in suffixes]
+        variants = asyncio.gather(*tasks)
+        variants.add_done_callback(lambda _: queue.put_nowait(None))
         
-        all_results = []
         seen_ids = set()
+        try:
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    break
+                fresh = []
+                for entry in batch:
+                    if entry.id not in seen_ids and entry.duration >= 600:
+                        seen_ids.add(entry.id)
+                        fresh.append(entry)
+                if fresh:
+                    yield fresh
+            variants.result()
+            if failed:
+                raise SearchIncomplete(f"{len(failed)} de {len(suffixes)} variantes fallaron")
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    def stream_discography(self, artist: str, max_results=200, owner=None):
+        """Busca discografía completa de un artista, por lotes"""
+        suffixes = [
+            "discography full",
+            "all albums",
+            "complete discography",
+            "full album",
+            "álbum completo"
+        ]
         
-        for search_query in search_queries:
-            ydl_opts = {
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': True,
-                'default_search': f'ytsearch{max_results // len(search_queries)}',
-                'socket_timeout': 30,
-                'extractor_args': {'youtube': {'skip': ['hls', 'dash']}},
-                'no_check_certificate': True,
-                'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            }
-            
-            try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    logger.info(f"Buscando álbumes: {search_query}")
-                    results = ydl.extract_info(f"ytsearch{max_results // len(search_queries)}:{search_query}", download=False)
-                    entries = results.get('entries', []) if results else []
-                    
-                    for entry in entries:
-                        video_id = entry.get('id')
-                        duration = entry.get('duration', 0)
-                        
-                        if video_id and video_id not in seen_ids and duration >= 600:
-                            seen_ids.add(video_id)
-                            all_results.append(entry)
-                    
-                    await asyncio.sleep(1)
-            except Exception as e:
-                logger.error(f"Error en búsqueda de álbumes: {e}")
-                continue
+        return self._cached_stream(artist, "discography", max_results, lambda: self._stream_variants(
+            artist, suffixes, max_results // len(suffixes), "discografía", owner=owner
+        ))
+    
+    async def search_discography(self, artist: str, max_results=200, owner=None):
+        """Busca discografía completa de un artista"""
+        return await self._collect(self.stream_discography(artist, max_results, owner))
+    
+    def stream_albums(self, query: str, max_results=200, owner=None):
+        """Busca álbumes completos, por lotes"""
+        suffixes = [
+            "full album",
+            "álbum completo",
+            "complete album",
+            "disco completo"
+        ]
+        
+        return self._cached_stream(query, "albums", max_results, lambda: self._stream_variants(
+            query, suffixes, max_results // len(suffixes), "álbumes", owner=owner
+        ))
+    
+    async def search_albums(self, query: str, max_results=200, owner=None):
+        """Busca álbumes completos"""
+        return await self._collect(self.stream_albums(query, max_results, owner))
+    
+    def download_key(self, video_id, profile):
+        return video_id, AUDIO_PROFILES[profile]['cache_key']
+    
+    async def download_audio(self, url: str, user_id: int, timeout=DOWNLOAD_TIMEOUT, profile='mp3',
+                             video_id=None, on_progress=None, on_start=None):
+        """Descarga audio de YouTube; pedidos simultáneos del mismo video comparten la descarga.
         
-        logger.info(f"Total álbumes encontrados: {len(all_results)}")
-        return all_results
+        on_progress recibe los avisos de progreso mientras este pedido espera;
+        on_start se pasa al motor si este pedido es el que lanza la descarga.
+        """
+        key = self.download_key(video_id or url, profile)
+        listeners = self.download_listeners.setdefault(key, set())
+        if on_progress:
+            listeners.add(on_progress)
+        try:
+            with trace_span('download'):
+                return await self.download_flights.do(
+                    key, lambda: self._download_audio(
+                        url, user_id, timeout, profile, video_id or url, listeners, on_start
+                    )
+                )
+        finally:
+            listeners.discard(on_progress)
+            if not listeners and key not in self.download_flights:
+                self.download_listeners.pop(key, None)
     
-    async def download_audio(self, url: str, user_id: int):
-        """Descarga audio de YouTube con múltiples intentos"""
+    async def _download_audio(self, url, user_id, timeout, profile, video_id, listeners=(), on_start=None):
+        """Busca el audio en la cache de disco o lo descarga en el motor de procesos.
+        
+        Devuelve (bytes del audio, título)
+        """
+        cache_key = AUDIO_PROFILES[profile]['cache_key']
+        cached = await self.audio_cache.get(video_id, cache_key)
+        if cached:
+            logger.info(f"💽 Audio desde cache de disco: {video_id}")
+            return cached
+        
         output_path = os.path.join(self.download_folder, f"{user_id}_%(title)s.%(ext)s")
+        ext = AUDIO_PROFILES[profile]['ext']
+        # El worker deja aquí el audio terminado; por el pipe solo vuelve la ruta
+        output = os.path.join(self.download_folder, f"{user_id}_{secrets.token_hex(8)}.{ext}")
         
-        # Intentar primero con mejor calidad
-        ydl_opts = {
-            'format': 'bestaudio/best',
+        job = {
+            'url': url,
             'outtmpl': output_path,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'quiet': False,  # Cambiado para ver errores
-            'no_warnings': False,  # Ver advertencias
-            'max_filesize': 50 * 1024 * 1024,
-            'socket_timeout': 60,
-            'no_check_certificate': True,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            },
+            'output': output,
+            'ydl_opts': AUDIO_PROFILES[profile]['ydl_opts'],
+            'profile': profile,
+            'mode': DOWNLOAD_MODE,
+            'max_bytes': STREAM_MAX_BYTES,
         }
+        def on_progress(progress):
+            for listener in list(listeners):
+                listener(progress)
         
+        started = time.monotonic()
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                logger.info(f"🎵 Descargando: {url}")
-                info = ydl.extract_info(url, download=True)
-                
-                if not info:
-                    logger.error("❌ No se pudo obtener info del video")
-                    return None, None
-                
-                # Buscar el archivo descargado
-                filename = ydl.prepare_filename(info).rsplit('.', 1)[0] + '.mp3'
-                
-                logger.info(f"✅ Archivo generado: {filename}")
-                
-                # Verificar que el archivo existe
-                if os.path.exists(filename):
-                    file_size = os.path.getsize(filename)
-                    logger.info(f"✅ Archivo existe, tamaño: {file_size} bytes")
-                    return filename, info.get('title', 'Audio')
-                else:
-                    logger.error(f"❌ Archivo no existe: {filename}")
-                    return None, None
-                    
-        except yt_dlp.utils.DownloadError as e:
-            logger.error(f"❌ Error de descarga de yt-dlp: {e}")
+            path, title, stats = await self.download_engine.run(
+                job, timeout=timeout, on_progress=on_progress, on_start=on_start
+            )
+        except BaseException:
+            # Worker matado a mitad de camino: el archivo parcial no sirve.
+            # Se borra en un hilo; shield para que otra cancelación no lo deje a medias
+            await asyncio.shield(asyncio.to_thread(_remove_if_exists, output))
+            raise
+        if not stats:
+            self.download_metrics.failures += 1
             return None, None
-        except Exception as e:
-            logger.error(f"❌ Error general en descarga: {type(e).__name__}: {e}")
+        self.download_metrics.record(stats)
+        self.observe_download(stats, time.monotonic() - started)
+        data = await self.audio_cache.adopt(video_id, cache_key, ext, path, title)
+        return data, title
+    
+    def observe_download(self, stats, elapsed):
+        """Pasa las métricas de un trabajo del worker a los histogramas"""
+        labels = {'path': stats['path'], 'mode': stats['mode']}
+        self.metrics.observe('bot_download_seconds', stats['download_seconds'], **labels)
+        if stats['postprocess_seconds'] is not None:
+            self.metrics.observe('bot_postprocess_seconds', stats['postprocess_seconds'], path=stats['path'])
+        # Lo que no pasó dentro del worker fue espera en la cola del motor
+        self.metrics.observe('bot_download_queue_seconds', max(0, elapsed - stats['seconds']))
+        self.metrics.inc('bot_download_cpu_seconds_total', stats['cpu_seconds'], **labels)
+    
+    def prefetch_audio(self, user_id, selected):
+        """Empieza a preparar el audio del detalle abierto si hay capacidad de sobra"""
+        profile = AUDIO_PROFILE
+        cache_key = AUDIO_PROFILES[profile]['cache_key']
+        video_id = selected['id']
+        # Sin cache de disco el resultado se perdería; tampoco hace falta si ya está listo
+        if (not PREFETCH_ENABLED or not self.audio_cache.enabled
+                or self.file_id_cache.get(video_id, cache_key)
+                or self.audio_cache.contains(video_id, cache_key)):
+            return
+        key = self.download_key(video_id, profile)
+        if key not in self.download_flights and not self.download_engine.has_idle_worker():
+            return
+        self.prefetcher.start(
+            user_id, key,
+            lambda on_start: self._prefetch_download(selected, user_id, profile, on_start)
+        )
+    
+    async def _prefetch_download(self, selected, user_id, profile, on_start):
+        """Descarga de un prefetch; se cobra como una descarga, así pulsar el botón después no es gratis.
+        
+        Si se cancela antes de que un worker tome el trabajo, las fichas se devuelven.
+        """
+        cost = OPERATION_COSTS['download']
+        if await self.rate_limiter.check(user_id, cost):
             return None, None
+        started = False
+        
+        def mark_started():
+            nonlocal started
+            started = True
+            on_start()
+        
+        try:
+            return await self.download_audio(
+                selected['url'], user_id, profile=profile, video_id=selected['id'], on_start=mark_started
+            )
+        except asyncio.CancelledError:
+            if not started:
+                await self.rate_limiter.refund(user_id, cost)
+            raise
+    
+    async def send_cached_audio(self, query, selected, caption, keyboard, profile='mp3'):
+        """Reenvía un audio ya subido usando su file_id. Devuelve False si no está en cache"""
+        cache_key = AUDIO_PROFILES[profile]['cache_key']
+        cached = self.file_id_cache.get(selected['id'], cache_key)
+        if not cached:
+            return False
+        
+        try:
+            await query.message.reply_audio(
+                audio=cached['file_id'],
+                title=cached['title'],
+                caption=f"🐺🎵 *{cached['title'][:50]}*\n\n{caption}",
+                parse_mode='Markdown',
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            return True
+        except BadRequest as e:
+            # Otros BadRequest (p. ej. Markdown del título) no son culpa del file_id
+            if not FileIdCache.is_invalid_file_id(e):
+                raise
+            # file_id inválido o vencido: se descarta y se vuelve a descargar
+            logger.warning(f"file_id inválido para {selected['id']}: {e}")
+            await self.file_id_cache.discard(selected['id'], cache_key)
+            return False
+    
+    async def send_downloaded_audio(self, query, selected, audio_data, title, caption, keyboard, profile='mp3'):
+        """Envía el audio recién descargado.
+        
+        Los pedidos que compartieron la descarga terminan a la vez: el primero
+        sube los bytes y publica el file_id, y los demás esperan esa subida y
+        reenvían por file_id en vez de subir el mismo archivo otra vez.
+        """
+        key = self.download_key(selected['id'], profile)
+        upload = self.audio_uploads.get(key)
+        if upload is not None:
+            await asyncio.shield(upload)
+        if await self.send_cached_audio(query, selected, caption, keyboard, profile):
+            return
+        
+        owner = key not in self.audio_uploads
+        if owner:
+            upload = self.audio_uploads[key] = asyncio.get_running_loop().create_future()
+        file_id = None
+        try:
+            audio_msg = await query.message.reply_audio(
+                audio=audio_data,
+                filename=f"{title[:60]}.{AUDIO_PROFILES[profile]['ext']}",
+                title=title,
+                caption=f"🐺🎵 *{title[:50]}*\n\n{caption}",
+                parse_mode='Markdown',
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            if audio_msg.audio:
+                file_id = audio_msg.audio.file_id
+                await self.file_id_cache.set(selected['id'], AUDIO_PROFILES[profile]['cache_key'], file_id, title)
+        finally:
+            if owner:
+                # Si la subida falló, los que esperan suben por su cuenta
+                upload.set_result(file_id)
+                del self.audio_uploads[key]
     
-    def create_results_keyboard(self, results, page=0, results_per_page=10, search_type="normal"):
-        """Crea teclado con paginación para resultados"""
+    def create_results_keyboard(self, results, page=0, results_per_page=SEARCH_PAGE_SIZE, search_type="normal", complete=True):
+        """Crea teclado con paginación para resultados (complete=False: hay más por traer)"""
         start_idx = page * results_per_page
         end_idx = start_idx + results_per_page
         page_results = results[start_idx:end_idx]
@@ -393,9 +3470,9 @@ class MusicBot:
         
         for i, result in enumerate(page_results):
             global_idx = start_idx + i
-            title = result.get('title', 'Sin título')
-            channel = result.get('channel', result.get('uploader', ''))
-            duration = result.get('duration')
+            title = result.title
+            channel = result.channel
+            duration = result.duration
             duration_str = self.format_duration(duration)
             
             if search_type in ["discography", "albums"]:
@@ -421,9 +3498,10 @@ class MusicBot:
         if page > 0:
             nav_buttons.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"page_{search_type}_{page-1}"))
         
-        nav_buttons.append(InlineKeyboardButton(f"📄 {page+1}/{total_pages}", callback_data="page_info"))
+        total_label = f"{total_pages}" if complete else f"{total_pages}+"
+        nav_buttons.append(InlineKeyboardButton(f"📄 {page+1}/{total_label}", callback_data="page_info"))
         
-        if end_idx < len(results):
+        if end_idx < len(results) or not complete:
             nav_buttons.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"page_{search_type}_{page+1}"))
         
         keyboard.append(nav_buttons)
@@ -431,9 +3509,98 @@ class MusicBot:
         
         return keyboard
     
+    def snapshot_user(self, user_id):
+        """Serializa (búsqueda, playlist) de un usuario para Storage.
+        
+        Con backend compartido la playlist va como lista de cambios pendientes.
+        """
+        search = self.user_searches.peek(user_id)
+        playlist = self.user_playlists.peek(user_id)
+        
+        search_data = None
+        if search:
+            data = {k: search[k] for k in ('query', 'search_type', 'page', 'state', 'selected', 'complete') if k in search}
+            if 'results' in search:
+                data['results'] = [result.to_row() for result in search['results']]
+            if 'timestamp' in search:
+                data['timestamp'] = search['timestamp'].timestamp()
+            search_data = json.dumps(data, ensure_ascii=False)
+        
+        if self.state_backend.shared:
+            # Solo los cambios: el backend los aplica sobre lo que otras réplicas hayan agregado
+            playlist_data = self.playlist_changes.pop(user_id, None)
+        else:
+            playlist_data = json.dumps(playlist, ensure_ascii=False) if playlist is not None else None
+        return search_data, playlist_data
+    
+    def add_to_playlist(self, user_id, song):
+        """Agrega una canción al final de la playlist del usuario"""
+        playlist = self.user_playlists.get(user_id)
+        if playlist is None:
+            playlist = self.user_playlists[user_id] = []
+        playlist.append(song)
+        if self.state_backend.shared:
+            self.playlist_changes.setdefault(user_id, []).append(('append', song))
+    
+    def replace_playlist(self, user_id, songs):
+        """Reemplaza la playlist completa (crearla con un tema o borrarla)"""
+        self.user_playlists[user_id] = songs
+        if self.state_backend.shared:
+            self.playlist_changes[user_id] = [('replace', list(songs))]
+    
+    async def load_user_state(self, user_id):
+        """Trae del backend la sesión y playlist del usuario.
+        
+        Con backend local solo la primera vez que aparece; con backend
+        compartido en cada update, porque otra réplica pudo modificarlas.
+        """
+        shared = self.state_backend.shared
+        if not shared and user_id in self.loaded_users:
+            return
+        
+        try:
+            search_row, playlist_data = await self.storage.load_user(user_id)
+        except Exception as e:
+            logger.error(f"Error leyendo estado del usuario: {e}")
+            return
+        self.loaded_users[user_id] = True
+        
+        if shared:
+            # Una búsqueda que se sigue llenando en segundo plano es más nueva que la guardada:
+            # se conserva el mismo objeto y fill_search_results la guarda al terminar
+            if user_id not in self.search_fill_tasks:
+                self.user_searches.pop(user_id, None)
+            self.user_playlists.pop(user_id, None)
+        
+        if playlist_data is not None and user_id not in self.user_playlists:
+            self.user_playlists[user_id] = json.loads(playlist_data)
+        
+        if search_row is not None and user_id not in self.user_searches:
+            data, updated = search_row
+            if time.time() - updated < SESSION_IDLE_TTL:
+                search = json.loads(data)
+                if 'results' in search:
+                    search['results'] = [SearchResult.from_row(row) for row in search['results']]
+                if 'timestamp' in search:
+                    search['timestamp'] = datetime.fromtimestamp(search['timestamp'])
+                self.user_searches[user_id] = search
+    
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Maneja mensajes de texto (búsquedas)"""
         user_id = update.effective_user.id
+        with self.tracer.trace('message') as trace:
+            with trace_span('load_state'):
+                await self.load_user_state(user_id)
+            # La ruta es el estado en que el texto llega (qué búsqueda dispara)
+            trace.route = f"message:{(self.user_searches.peek(user_id) or {}).get('state') or 'idle'}"
+            try:
+                await self.dispatch_message(update, context)
+            finally:
+                await self.storage.release(user_id)
+    
+    async def dispatch_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Enruta el texto según el estado del usuario"""
+        user_id = update.effective_user.id
         query = update.message.text.strip()
         
         user_state = self.user_searches.get(user_id, {}).get('state')
@@ -458,9 +3625,13 @@ class MusicBot:
     async def process_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query: str, karaoke=False):
         """Procesa búsqueda de canciones o karaokes"""
         user_id = update.effective_user.id
+        search_type = "karaoke" if karaoke else "songs"
         
-        if not self.rate_limiter.is_allowed(user_id):
-            wait_time = self.rate_limiter.get_wait_time(user_id)
+        # Un resultado en cache no consulta YouTube: no cuenta para el límite
+        cost = OPERATION_COSTS['search']
+        full_cached = self.search_cache.contains(query, search_type, SEARCH_MAX_RESULTS)
+        wait_time = 0 if full_cached else await self.rate_limiter.check(user_id, cost)
+        if wait_time:
             await update.message.reply_text(
                 f"⏰ *Espera {wait_time} segundos*\n\n"
                 f"Has alcanzado el límite temporal.\n"
@@ -469,7 +3640,6 @@ class MusicBot:
             )
             return
         
-        search_type = "karaoke" if karaoke else "songs"
         icon = "🎤" if karaoke else "🎵"
         
         search_msg = await update.message.reply_text(
@@ -482,68 +3652,51 @@ class MusicBot:
             parse_mode='Markdown'
         )
         
-        try:
-            results = await asyncio.wait_for(
-                self.search_music(query, max_results=100, karaoke=karaoke),
-                timeout=60.0
-            )
-        except asyncio.TimeoutError:
-            await search_msg.edit_text(
-                "⏰ *Tiempo agotado*\n\n"
-                "La búsqueda tardó demasiado.\n"
-                "Intenta con un término más específico."
-            )
-            return
-        except Exception as e:
-            logger.error(f"Error: {e}")
-            await search_msg.edit_text(
-                "❌ *Error en la búsqueda*\n\n"
-                "Ocurrió un problema. Intenta de nuevo."
-            )
-            return
-        
-        if not results:
-            keyboard = [[InlineKeyboardButton("🏠 Volver al Menú", callback_data="back_to_main_menu")]]
-            await search_msg.edit_text(
-                f"😔 *Sin resultados*\n\n"
-                f"No encontré {'karaokes' if karaoke else 'canciones'}\n"
-                f"con el término: _{query}_\n\n"
-                f"💡 Intenta con otro término.",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-            return
-        
-        self.user_searches[user_id] = {
+        session = {
             'query': query,
-            'results': results,
+            'results': [],
             'timestamp': datetime.now(),
             'search_type': search_type,
-            'page': 0
+            'page': 0,
+            'complete': False
         }
+        noun = 'karaokes' if karaoke else 'resultados'
         
-        keyboard = self.create_results_keyboard(results, page=0, search_type=search_type)
+        def build_text(count, partial):
+            total = f"{count} {noun}… (buscando más)" if partial else f"{count} {noun}"
+            result_text = f"╔═══════════════════════════╗\n"
+            result_text += f"║  {icon} *RESULTADOS ENCONTRADOS* {icon}  ║\n"
+            result_text += f"╚═══════════════════════════╝\n\n"
+            result_text += f"🔍 *Búsqueda:* _{query}_\n"
+            result_text += f"✅ *Total:* {total}\n\n"
+            result_text += f"{MINI_SEP}\n"
+            result_text += f"👇 *Selecciona una opción:*"
+            return result_text
         
-        result_text = f"╔═══════════════════════════╗\n"
-        result_text += f"║  {icon} *RESULTADOS ENCONTRADOS* {icon}  ║\n"
-        result_text += f"╚═══════════════════════════╝\n\n"
-        result_text += f"🔍 *Búsqueda:* _{query}_\n"
-        result_text += f"✅ *Total:* {len(results)} {'karaokes' if karaoke else 'resultados'}\n\n"
-        result_text += f"{MINI_SEP}\n"
-        result_text += f"👇 *Selecciona una opción:*"
+        empty_text = (
+            f"😔 *Sin resultados*\n\n"
+            f"No encontré {'karaokes' if karaoke else 'canciones'}\n"
+            f"con el término: _{query}_\n\n"
+            f"💡 Intenta con otro término."
+        )
         
-        await search_msg.edit_text(
-            result_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
+        # Con paginado perezoso se responde con la primera página; el resto se agrega después
+        await self.run_search(
+            user_id, session, search_msg,
+            self.stream_music(query, karaoke=karaoke, owner=user_id),
+            build_text, empty_text, timeout=60.0,
+            timeout_text="La búsqueda tardó demasiado.\nIntenta con un término más específico.",
+            lazy=SEARCH_LAZY_PAGING
         )
     
     async def process_discography_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query: str):
         """Procesa búsqueda de discografía completa"""
         user_id = update.effective_user.id
         
-        if not self.rate_limiter.is_allowed(user_id):
-            wait_time = self.rate_limiter.get_wait_time(user_id)
+        # Un resultado en cache no consulta YouTube: no cuenta para el límite
+        cost = OPERATION_COSTS['discography']
+        wait_time = 0 if self.search_cache.contains(query, "discography", 200) else await self.rate_limiter.check(user_id, cost)
+        if wait_time:
             await update.message.reply_text(
                 f"⏰ *Espera {wait_time} segundos*\n\n"
                 f"Has alcanzado el límite temporal.\n"
@@ -563,69 +3716,49 @@ class MusicBot:
             parse_mode='Markdown'
         )
         
-        try:
-            results = await asyncio.wait_for(
-                self.search_discography(query, max_results=200),
-                timeout=120.0
-            )
-        except asyncio.TimeoutError:
-            await search_msg.edit_text(
-                "⏰ *Tiempo agotado*\n\n"
-                "La búsqueda de discografía tardó mucho.\n"
-                "Intenta de nuevo."
-            )
-            return
-        except Exception as e:
-            logger.error(f"Error: {e}")
-            await search_msg.edit_text(
-                "❌ *Error en la búsqueda*\n\n"
-                "Ocurrió un problema. Intenta de nuevo."
-            )
-            return
-        
-        if not results:
-            keyboard = [[InlineKeyboardButton("🏠 Volver al Menú", callback_data="back_to_main_menu")]]
-            await search_msg.edit_text(
-                f"😔 *Sin resultados*\n\n"
-                f"No encontré discografías de:\n"
-                f"🎸 _{query}_\n\n"
-                f"💡 Intenta con otro artista o grupo.",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-            return
-        
-        self.user_searches[user_id] = {
+        session = {
             'query': query,
-            'results': results,
+            'results': [],
             'timestamp': datetime.now(),
             'search_type': 'discography',
-            'page': 0
+            'page': 0,
+            'complete': False
         }
         
-        keyboard = self.create_results_keyboard(results, page=0, search_type='discography')
+        def build_text(count, partial):
+            total = f"{count} álbumes… (buscando más)" if partial else f"{count} álbumes"
+            result_text = f"╔═══════════════════════════════╗\n"
+            result_text += f"║  💿 *DISCOGRAFÍA COMPLETA* 💿  ║\n"
+            result_text += f"╚═══════════════════════════════╝\n\n"
+            result_text += f"🎸 *Artista:* _{query}_\n"
+            result_text += f"✅ *Total encontrado:* {total}\n"
+            result_text += f"📀 Incluye: Álbumes, compilaciones\n\n"
+            result_text += f"{MINI_SEP}\n"
+            result_text += f"👇 *Selecciona para ver detalles:*"
+            return result_text
         
-        result_text = f"╔═══════════════════════════════╗\n"
-        result_text += f"║  💿 *DISCOGRAFÍA COMPLETA* 💿  ║\n"
-        result_text += f"╚═══════════════════════════════╝\n\n"
-        result_text += f"🎸 *Artista:* _{query}_\n"
-        result_text += f"✅ *Total encontrado:* {len(results)} álbumes\n"
-        result_text += f"📀 Incluye: Álbumes, compilaciones\n\n"
-        result_text += f"{MINI_SEP}\n"
-        result_text += f"👇 *Selecciona para ver detalles:*"
+        empty_text = (
+            f"😔 *Sin resultados*\n\n"
+            f"No encontré discografías de:\n"
+            f"🎸 _{query}_\n\n"
+            f"💡 Intenta con otro artista o grupo."
+        )
         
-        await search_msg.edit_text(
-            result_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
+        await self.run_search(
+            user_id, session, search_msg,
+            self.stream_discography(query, owner=user_id),
+            build_text, empty_text, timeout=120.0,
+            timeout_text="La búsqueda de discografía tardó mucho.\nIntenta de nuevo."
         )
     
     async def process_albums_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query: str):
         """Procesa búsqueda de álbumes completos"""
         user_id = update.effective_user.id
         
-        if not self.rate_limiter.is_allowed(user_id):
-            wait_time = self.rate_limiter.get_wait_time(user_id)
+        # Un resultado en cache no consulta YouTube: no cuenta para el límite
+        cost = OPERATION_COSTS['albums']
+        wait_time = 0 if self.search_cache.contains(query, "albums", 200) else await self.rate_limiter.check(user_id, cost)
+        if wait_time:
             await update.message.reply_text(
                 f"⏰ *Espera {wait_time} segundos*\n\n"
                 f"Has alcanzado el límite temporal.\n"
@@ -645,61 +3778,39 @@ class MusicBot:
             parse_mode='Markdown'
         )
         
-        try:
-            results = await asyncio.wait_for(
-                self.search_albums(query, max_results=200),
-                timeout=120.0
-            )
-        except asyncio.TimeoutError:
-            await search_msg.edit_text(
-                "⏰ *Tiempo agotado*\n\n"
-                "La búsqueda de álbumes tardó mucho.\n"
-                "Intenta de nuevo."
-            )
-            return
-        except Exception as e:
-            logger.error(f"Error: {e}")
-            await search_msg.edit_text(
-                "❌ *Error en la búsqueda*\n\n"
-                "Ocurrió un problema. Intenta de nuevo."
-            )
-            return
-        
-        if not results:
-            keyboard = [[InlineKeyboardButton("🏠 Volver al Menú", callback_data="back_to_main_menu")]]
-            await search_msg.edit_text(
-                f"😔 *Sin resultados*\n\n"
-                f"No encontré álbumes con:\n"
-                f"🎼 _{query}_\n\n"
-                f"💡 Intenta con otro término.",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-            return
-        
-        self.user_searches[user_id] = {
+        session = {
             'query': query,
-            'results': results,
+            'results': [],
             'timestamp': datetime.now(),
             'search_type': 'albums',
-            'page': 0
+            'page': 0,
+            'complete': False
         }
         
-        keyboard = self.create_results_keyboard(results, page=0, search_type='albums')
+        def build_text(count, partial):
+            total = f"{count} álbumes… (buscando más)" if partial else f"{count} álbumes"
+            result_text = f"╔═══════════════════════════════╗\n"
+            result_text += f"║  📀 *ÁLBUMES COMPLETOS* 📀  ║\n"
+            result_text += f"╚═══════════════════════════════╝\n\n"
+            result_text += f"🎼 *Búsqueda:* _{query}_\n"
+            result_text += f"✅ *Total encontrado:* {total}\n"
+            result_text += f"🌍 De todo el mundo\n\n"
+            result_text += f"{MINI_SEP}\n"
+            result_text += f"👇 *Selecciona para ver detalles:*"
+            return result_text
         
-        result_text = f"╔═══════════════════════════════╗\n"
-        result_text += f"║  📀 *ÁLBUMES COMPLETOS* 📀  ║\n"
-        result_text += f"╚═══════════════════════════════╝\n\n"
-        result_text += f"🎼 *Búsqueda:* _{query}_\n"
-        result_text += f"✅ *Total encontrado:* {len(results)} álbumes\n"
-        result_text += f"🌍 De todo el mundo\n\n"
-        result_text += f"{MINI_SEP}\n"
-        result_text += f"👇 *Selecciona para ver detalles:*"
+        empty_text = (
+            f"😔 *Sin resultados*\n\n"
+            f"No encontré álbumes con:\n"
+            f"🎼 _{query}_\n\n"
+            f"💡 Intenta con otro término."
+        )
         
-        await search_msg.edit_text(
-            result_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
+        await self.run_search(
+            user_id, session, search_msg,
+            self.stream_albums(query, owner=user_id),
+            build_text, empty_text, timeout=120.0,
+            timeout_text="La búsqueda de álbumes tardó mucho.\nIntenta de nuevo."
         )
     
     async def process_playlist_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query: str):
@@ -714,14 +3825,11 @@ class MusicBot:
         
         try:
             results = await asyncio.wait_for(
-                self.search_music(query, max_results=20),
+                self.search_music(query, max_results=20, owner=user_id, mode="playlist"),
                 timeout=30.0
             )
         except Exception as e:
-            await search_msg.edit_text(
-                "❌ Error en búsqueda.\n"
-                "Intenta de nuevo."
-            )
+            await self.show_search_error(search_msg, e)
             return
         
         if not results:
@@ -733,6 +3841,7 @@ class MusicBot:
         
         self.user_searches[user_id]['results'] = results
         self.user_searches[user_id]['search_type'] = 'playlist'
+        self.user_searches[user_id]['timestamp'] = datetime.now()
         
         keyboard = self.create_results_keyboard(results, page=0, results_per_page=10, search_type="playlist")
         
@@ -745,6 +3854,25 @@ class MusicBot:
     
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Maneja callbacks de botones"""
+        user_id = update.effective_user.id
+        # Al pulsar un botón el usuario toma el control del mensaje: ya no se re-dibuja el progreso
+        self.search_progress.pop(user_id, None)
+        with self.tracer.trace(self.callback_route(update.callback_query.data)):
+            with trace_span('load_state'):
+                await self.load_user_state(user_id)
+            try:
+                await self.dispatch_callback(update, context)
+            finally:
+                await self.storage.release(user_id)
+    
+    @staticmethod
+    def callback_route(data):
+        """Ruta del botón sin el índice final: select_songs_12 -> select_songs (desconocida: 'other')"""
+        route = re.sub(r'_\d+$', '', data or '')
+        return route if route in CALLBACK_ROUTES else 'other'
+    
+    async def dispatch_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Enruta cada botón a su acción"""
         query = update.callback_query
         user_id = update.effective_user.id
         
@@ -755,10 +3883,20 @@ class MusicBot:
         
         data = query.data
         
+        # Cambiar de menú cancela las búsquedas en curso del usuario
+        if data == "back_to_main_menu" or data.startswith("menu_"):
+            self.search_executor.cancel_owner(user_id)
+            fill_task = self.search_fill_tasks.pop(user_id, None)
+            if fill_task:
+                fill_task.cancel()
+        
+        # Salir del detalle cancela el audio preparado por adelantado que aún no empezó
+        if data in ("back_to_main_menu", "back_to_results") or data.startswith("menu_"):
+            self.prefetcher.cancel_user(user_id)
+        
         # Menú principal
         if data == "back_to_main_menu":
-            if user_id in self.user_searches:
-                self.user_searches[user_id] = {}
+            self.user_searches.pop(user_id, None)
             await self.show_main_menu(query)
             return
         
@@ -964,9 +4102,28 @@ class MusicBot:
                 return
             
             user_data = self.user_searches[user_id]
+            if not user_data.get('complete', True) and page * SEARCH_PAGE_SIZE >= len(user_data['results']):
+                wait_time = await self.complete_search_results(user_id, user_data)
+                if wait_time:
+                    keyboard = [
+                        [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
+                        [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
+                    ]
+                    await query.edit_message_text(
+                        f"⏰ *Espera {wait_time} segundos*\n\n"
+                        f"Has alcanzado el límite temporal.\n"
+                        f"🐺 ¡Relájate un momento!",
+                        reply_markup=InlineKeyboardMarkup(keyboard),
+                        parse_mode='Markdown'
+                    )
+                    return
             results = user_data['results']
+            # Si la búsqueda completa trajo menos de lo esperado, se muestra la última página
+            page = max(0, min(page, (len(results) - 1) // SEARCH_PAGE_SIZE))
             
-            keyboard = self.create_results_keyboard(results, page=page, search_type=search_type)
+            keyboard = self.create_results_keyboard(
+                results, page=page, search_type=search_type, complete=user_data.get('complete', True)
+            )
             
             await query.edit_message_text(
                 f"📄 *Resultados* (página {page+1})\n\n"
@@ -994,11 +4151,11 @@ class MusicBot:
                 return
             
             selected = user_data['results'][idx]
-            video_id = selected.get('id')
-            title = selected.get('title', 'Audio')
-            artist = selected.get('channel', selected.get('uploader', 'Desconocido'))
+            video_id = selected.id
+            title = selected.title
+            artist = selected.channel or 'Desconocido'
             url = f"https://www.youtube.com/watch?v={video_id}"
-            duration = selected.get('duration', 0)
+            duration = selected.duration
             
             self.user_searches[user_id]['selected'] = {
                 'url': url,
@@ -1009,7 +4166,7 @@ class MusicBot:
             
             # Si es para playlist
             if search_type == "playlist":
-                self.user_playlists[user_id].append({
+                self.add_to_playlist(user_id, {
                     'title': title,
                     'artist': artist,
                     'url': url
@@ -1080,6 +4237,7 @@ class MusicBot:
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode='Markdown'
             )
+            self.prefetch_audio(user_id, self.user_searches[user_id]['selected'])
             return
         
         # Reproducir audio directamente (antes era solo "link")
@@ -1102,54 +4260,78 @@ class MusicBot:
             else:
                 content_type = "canción"
             
+            # Audio ya subido antes: se reenvía sin descargar
+            keyboard = [
+                [InlineKeyboardButton(f"➕ ¿Agregar a tu Playlist?", callback_data=f"add_to_playlist_from_link")],
+                [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
+                [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
+            ]
+            profile = AUDIO_PROFILE
+            caption = f"👤 {selected['artist'][:40]}\n"
+            caption += f"💾 Formato: {AUDIO_PROFILES[profile]['label']}\n"
+            caption += f"🐺 ¡Disfruta! 💕"
+            
+            if await self.send_cached_audio(query, selected, caption, keyboard, profile):
+                await query.edit_message_text(
+                    "✅ ¡Audio reproduciendo abajo! 🎵",
+                    parse_mode='Markdown'
+                )
+                return
+            
+            # Sumarse a una descarga en curso o leer de la cache de disco no consume fichas
+            if (self.download_key(selected['id'], profile) in self.download_flights
+                    or self.audio_cache.contains(selected['id'], AUDIO_PROFILES[profile]['cache_key'])):
+                wait_time = 0
+            else:
+                wait_time = await self.rate_limiter.check(user_id, OPERATION_COSTS['download'])
+            if wait_time:
+                keyboard = [
+                    [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
+                    [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
+                ]
+                await query.edit_message_text(
+                    f"⏰ *Espera {wait_time} segundos*\n\n"
+                    f"Has alcanzado el límite de descargas.\n"
+                    f"🐺 ¡Relájate un momento!",
+                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    parse_mode='Markdown'
+                )
+                return
+            
             # Mostrar mensaje de carga
-            await query.edit_message_text(
-                f"🎵 *Reproduciendo...*\n\n"
-                f"⏳ Preparando el audio de:\n"
-                f"_{selected['title'][:40]}_\n\n"
-                f"🐺 Un momento por favor...",
-                parse_mode='Markdown'
+            with outbound_priority(PRIORITY_LOW):
+                await query.edit_message_text(
+                    f"🎵 *Reproduciendo...*\n\n"
+                    f"⏳ Preparando el audio de:\n"
+                    f"_{selected['title'][:40]}_\n\n"
+                    f"🐺 Un momento por favor...",
+                    parse_mode='Markdown'
+                )
+            
+            progress_message = self.download_progress_message(
+                query, f"🎵 *Reproduciendo...*\n\n_{selected['title'][:40]}_"
             )
             
             # Intentar descargar y reproducir
             try:
-                filename, title = await asyncio.wait_for(
-                    self.download_audio(selected['url'], user_id),
-                    timeout=120.0
-                )
+                try:
+                    audio_data, title = await self.download_audio(
+                        selected['url'], user_id, profile=profile, video_id=selected['id'],
+                        on_progress=progress_message.update
+                    )
+                finally:
+                    progress_message.close()
                 
-                if filename and os.path.exists(filename):
-                    # Botones para el audio
-                    keyboard = [
-                        [InlineKeyboardButton(f"➕ ¿Agregar a tu Playlist?", callback_data=f"add_to_playlist_from_link")],
-                        [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
-                        [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
-                    ]
-                    
-                    with open(filename, 'rb') as audio_file:
-                        caption = f"🐺🎵 *{title[:50]}*\n\n"
-                        caption += f"👤 {selected['artist'][:40]}\n"
-                        caption += f"💾 Formato: MP3 HD\n"
-                        caption += f"🐺 ¡Disfruta! 💕"
-                        
-                        await query.message.reply_audio(
-                            audio=audio_file,
-                            title=title,
-                            caption=caption,
-                            parse_mode='Markdown',
-                            reply_markup=InlineKeyboardMarkup(keyboard)
-                        )
+                if audio_data:
+                    await self.send_downloaded_audio(
+                        query, selected, audio_data, title, caption, keyboard, profile
+                    )
                     
                     # Actualizar mensaje
                     await query.edit_message_text(
                         "✅ ¡Audio reproduciendo abajo! 🎵",
                         parse_mode='Markdown'
                     )
-                    
-                    try:
-                        os.remove(filename)
-                    except:
-                        pass
                 else:
                     # Si no se pudo descargar, mostrar botón directo a YouTube
                     keyboard = [
@@ -1177,8 +4359,23 @@ class MusicBot:
                         parse_mode='Markdown'
                     )
                     
+            except DownloadBusyError:
+                keyboard = [
+                    [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
+                    [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
+                ]
+                
+                await query.edit_message_text(
+                    "🚦 *Servidor ocupado*\n\n"
+                    "Hay muchas descargas en curso.\n"
+                    "Intenta de nuevo en unos segundos.",
+                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    parse_mode='Markdown'
+                )
             except asyncio.TimeoutError:
                 # Timeout - material no disponible
+                self.metrics.inc('bot_timeouts_total', operation='download')
+                self.metrics.inc('bot_unavailable_total', action='play', reason='timeout')
                 keyboard = [
                     [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
                     [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
@@ -1203,6 +4400,7 @@ class MusicBot:
                 
             except Exception as e:
                 logger.error(f"Error al reproducir: {e}")
+                self.metrics.inc('bot_unavailable_total', action='play', reason='error')
                 # Error general - material no disponible
                 keyboard = [
                     [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
@@ -1247,6 +4445,45 @@ class MusicBot:
             else:
                 content_type = "canción"
             
+            # Audio ya subido antes: se reenvía sin descargar
+            keyboard = [
+                [InlineKeyboardButton(f"➕ ¿Agregar a tu Playlist?", callback_data=f"add_to_playlist_from_download")],
+                [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
+                [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
+            ]
+            # La descarga siempre es MP3, compatible con cualquier reproductor
+            profile = 'mp3'
+            caption = f"💾 Formato: {AUDIO_PROFILES[profile]['label']}\n"
+            caption += f"✅ Descargado exitosamente\n"
+            caption += f"🐺 ¡Disfruta! 💕"
+            
+            if await self.send_cached_audio(query, selected, caption, keyboard, profile):
+                await query.edit_message_text(
+                    "✅ ¡Audio enviado abajo! 🎵",
+                    parse_mode='Markdown'
+                )
+                return
+            
+            # Sumarse a una descarga en curso o leer de la cache de disco no consume fichas
+            if (self.download_key(selected['id'], profile) in self.download_flights
+                    or self.audio_cache.contains(selected['id'], AUDIO_PROFILES[profile]['cache_key'])):
+                wait_time = 0
+            else:
+                wait_time = await self.rate_limiter.check(user_id, OPERATION_COSTS['download'])
+            if wait_time:
+                keyboard = [
+                    [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
+                    [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
+                ]
+                await query.edit_message_text(
+                    f"⏰ *Espera {wait_time} segundos*\n\n"
+                    f"Has alcanzado el límite de descargas.\n"
+                    f"🐺 ¡Relájate un momento!",
+                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    parse_mode='Markdown'
+                )
+                return
+            
             download_text = f"╔═══════════════════════════════╗\n"
             download_text += f"║  ⬇️ *DESCARGANDO...* ⬇️  ║\n"
             download_text += f"╚═══════════════════════════════╝\n\n"
@@ -1254,48 +4491,39 @@ class MusicBot:
             download_text += f"⏳ Esto puede tardar un momento...\n"
             download_text += f"🐺 Preparando tu MP3 HD..."
             
-            await query.edit_message_text(download_text, parse_mode='Markdown')
+            with outbound_priority(PRIORITY_LOW):
+                await query.edit_message_text(download_text, parse_mode='Markdown')
+            
+            progress_message = self.download_progress_message(
+                query,
+                f"╔═══════════════════════════════╗\n"
+                f"║  ⬇️ *DESCARGANDO...* ⬇️  ║\n"
+                f"╚═══════════════════════════════╝\n\n"
+                f"🎵 {selected['title'][:40]}"
+            )
             
             try:
-                filename, title = await asyncio.wait_for(
-                    self.download_audio(selected['url'], user_id),
-                    timeout=120.0
-                )
+                try:
+                    audio_data, title = await self.download_audio(
+                        selected['url'], user_id, profile=profile, video_id=selected['id'],
+                        on_progress=progress_message.update
+                    )
+                finally:
+                    progress_message.close()
                 
-                if filename and os.path.exists(filename):
-                    # Botones para el mensaje del audio
-                    keyboard = [
-                        [InlineKeyboardButton(f"➕ ¿Agregar a tu Playlist?", callback_data=f"add_to_playlist_from_download")],
-                        [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
-                        [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
-                    ]
-                    
-                    with open(filename, 'rb') as audio_file:
-                        caption = f"🐺🎵 *{title[:50]}*\n\n"
-                        caption += f"💾 Formato: MP3 HD\n"
-                        caption += f"✅ Descargado exitosamente\n"
-                        caption += f"🐺 ¡Disfruta! 💕"
-                        
-                        await query.message.reply_audio(
-                            audio=audio_file,
-                            title=title,
-                            caption=caption,
-                            parse_mode='Markdown',
-                            reply_markup=InlineKeyboardMarkup(keyboard)
-                        )
+                if audio_data:
+                    await self.send_downloaded_audio(
+                        query, selected, audio_data, title, caption, keyboard, profile
+                    )
                     
                     # Actualizar mensaje anterior
                     await query.edit_message_text(
                         "✅ ¡Audio enviado abajo! 🎵",
                         parse_mode='Markdown'
                     )
-                    
-                    try:
-                        os.remove(filename)
-                    except:
-                        pass
                 else:
                     # No se pudo descargar - material no disponible
+                    self.metrics.inc('bot_unavailable_total', action='download', reason='failed')
                     keyboard = [
                         [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
                         [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
@@ -1317,8 +4545,23 @@ class MusicBot:
                         reply_markup=InlineKeyboardMarkup(keyboard),
                         parse_mode='Markdown'
                     )
+            except DownloadBusyError:
+                keyboard = [
+                    [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
+                    [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
+                ]
+                
+                await query.edit_message_text(
+                    "🚦 *Servidor ocupado*\n\n"
+                    "Hay muchas descargas en curso.\n"
+                    "Intenta de nuevo en unos segundos.",
+                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    parse_mode='Markdown'
+                )
             except asyncio.TimeoutError:
                 # Timeout - material no disponible
+                self.metrics.inc('bot_timeouts_total', operation='download')
+                self.metrics.inc('bot_unavailable_total', action='download', reason='timeout')
                 keyboard = [
                     [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
                     [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
@@ -1342,6 +4585,7 @@ class MusicBot:
                 )
             except Exception as e:
                 logger.error(f"Error descarga: {e}")
+                self.metrics.inc('bot_unavailable_total', action='download', reason='error')
                 keyboard = [
                     [InlineKeyboardButton("🔙 Volver a Resultados", callback_data="back_to_results")],
                     [InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]
@@ -1376,7 +4620,9 @@ class MusicBot:
             search_type = user_data.get('search_type', 'songs')
             page = user_data.get('page', 0)
             
-            keyboard = self.create_results_keyboard(results, page=page, search_type=search_type)
+            keyboard = self.create_results_keyboard(
+                results, page=page, search_type=search_type, complete=user_data.get('complete', True)
+            )
             
             await query.edit_message_text(
                 f"🔍 *Búsqueda:* {user_data['query']}\n\n"
@@ -1422,7 +4668,7 @@ class MusicBot:
         # Borrar playlist
         if data == "playlist_clear":
             if user_id in self.user_playlists:
-                self.user_playlists[user_id] = []
+                self.replace_playlist(user_id, [])
             
             keyboard = [[InlineKeyboardButton("🏠 Menú Principal", callback_data="back_to_main_menu")]]
             
@@ -1513,7 +4759,7 @@ class MusicBot:
                     return
                 
                 # Agregar a la playlist
-                self.user_playlists[user_id].append({
+                self.add_to_playlist(user_id, {
                     'title': selected['title'],
                     'artist': selected['artist'],
                     'url': selected['url']
@@ -1564,11 +4810,11 @@ class MusicBot:
                 content_type = "canción"
             
             # Crear la playlist con el primer elemento
-            self.user_playlists[user_id] = [{
+            self.replace_playlist(user_id, [{
                 'title': selected['title'],
                 'artist': selected['artist'],
                 'url': selected['url']
-            }]
+            }])
             
             keyboard = [
                 [InlineKeyboardButton("➕ Agregar otra", callback_data="back_to_results")],
@@ -1599,8 +4845,47 @@ class MusicBot:
             )
             return
     
+    async def sweep_sessions(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job periódico: libera sesiones y playlists inactivas"""
+        removed_searches = self.user_searches.sweep()
+        removed_playlists = self.user_playlists.sweep()
+        self.rate_limiter.evict_idle()
+        if removed_searches or removed_playlists:
+            logger.info(
+                f"🧹 Sesiones liberadas: {removed_searches} búsquedas, {removed_playlists} playlists "
+                f"(activas: {len(self.user_searches)} búsquedas, {len(self.user_playlists)} playlists)"
+            )
+    
+    async def post_init(self, application: Application):
+        """Arranca los procesos de descarga y pre-calienta las instancias de yt-dlp"""
+        await self.storage.start()
+        if METRICS_PORT:
+            self.metrics_server = MetricsServer(self.metrics)
+            await self.metrics_server.start(METRICS_LISTEN, METRICS_PORT)
+        await asyncio.to_thread(self.audio_cache.rebuild)
+        self.download_engine.start()
+        self.tracer.start()
+        await asyncio.to_thread(self.search_ydl_pool.warm, SEARCH_WORKERS)
+    
+    async def shutdown(self, application: Application):
+        """Libera los pools de trabajo al detener la aplicación"""
+        self.search_executor.shutdown()
+        self.tracer.stop()
+        self.prefetcher.shutdown()
+        self.download_engine.shutdown()
+        self.search_ydl_pool.close()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        await self.storage.close()
+        self.file_id_cache.close()
+    
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Maneja errores globales"""
+        if isinstance(context.error, RetryAfter):
+            # Responder otro mensaje solo agravaría el flood
+            logger.warning(f"⏳ Flood de Telegram, envío descartado: {context.error}")
+            return
+        
         logger.error(f"Error: {context.error}")
         
         try:
@@ -1618,6 +4903,249 @@ class MusicBot:
             pass
 
 
+class HttpRequestError(Exception):
+    """Petición HTTP mal formada o demasiado grande"""
+
+
+async def _read_http_line(reader):
+    try:
+        return await reader.readline()
+    except (ValueError, asyncio.LimitOverrunError):
+        # Línea más larga que el buffer del StreamReader
+        raise HttpRequestError('línea demasiado larga')
+
+
+async def read_http_request(reader, max_body=1024 * 1024):
+    """Lee una petición HTTP/1.1; devuelve (método, ruta, headers, body) o None si se cerró.
+    
+    Cualquier petición mal formada termina en HttpRequestError (400).
+    """
+    request_line = await _read_http_line(reader)
+    if not request_line:
+        return None
+    try:
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise HttpRequestError('request line inválida')
+    
+    headers = {}
+    while True:
+        line = await _read_http_line(reader)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) > 100:
+            raise HttpRequestError('demasiados headers')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise HttpRequestError('content-length inválido')
+    if length < 0:
+        raise HttpRequestError('content-length inválido')
+    if length > max_body:
+        raise HttpRequestError('body demasiado grande')
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+async def write_http_response(writer, status, body=b'', content_type='text/plain; charset=utf-8', keep_alive=True):
+    reasons = {
+        200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+        413: 'Payload Too Large', 429: 'Too Many Requests', 503: 'Service Unavailable',
+    }
+    head = (
+        f"HTTP/1.1 {status} {reasons.get(status, 'OK')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+
+class MetricsServer:
+    """Servidor HTTP mínimo que responde GET /metrics con Metrics.render()"""
+    def __init__(self, metrics, path='/metrics'):
+        self.metrics = metrics
+        self.path = path
+        self._server = None
+        self._writers = set()
+    
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"📈 Métricas en {host}:{port}{self.path}")
+    
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    request = await read_http_request(reader, max_body=0)
+                except HttpRequestError:
+                    await write_http_response(writer, 400, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, _ = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if method == 'GET' and path.split('?', 1)[0] == self.path:
+                    await write_http_response(
+                        writer, 200, self.metrics.render().encode(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8', keep_alive=keep_alive
+                    )
+                else:
+                    await write_http_response(writer, 404, keep_alive=keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+    
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+
+
+class WebhookServer:
+    """Recibe updates de Telegram por webhook con un servidor HTTP asyncio.
+    
+    Valida el header X-Telegram-Bot-Api-Secret-Token, encola cada update en
+    una cola acotada y la vacían `consumers` tareas. Si la cola está llena
+    se responde 503 sin encolar: Telegram guarda el update y lo reintenta
+    más tarde, en vez de perderlo.
+    """
+    def __init__(self, application, path, secret, max_queue=1000, consumers=64):
+        self.application = application
+        self.path = path
+        self.secret = secret
+        self.consumers = consumers
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.received = 0
+        self.shed = 0
+        self._server = None
+        self._tasks = []
+        self._writers = set()
+    
+    async def start(self, host, port):
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.consumers)]
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"🌐 Webhook escuchando en {host}:{port}{self.path}")
+    
+    async def _consume(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"Error procesando update del webhook: {e}")
+            finally:
+                self.queue.task_done()
+    
+    def _accept(self, method, path, headers, body):
+        if method != 'POST' or path != self.path:
+            return 404
+        # Como bytes: compare_digest rechaza str con caracteres no ASCII (los headers llegan en latin-1)
+        token = headers.get('x-telegram-bot-api-secret-token', '').encode('latin-1')
+        if not hmac.compare_digest(token, self.secret.encode()):
+            return 403
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                return 400
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return 400
+        
+        self.received += 1
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.shed += 1
+            logger.warning(f"⚠️ Cola del webhook llena: update {update.update_id} devuelto a Telegram")
+            return 503
+        return 200
+    
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    request = await read_http_request(reader)
+                except HttpRequestError:
+                    await write_http_response(writer, 400, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                status = self._accept(*request)
+                keep_alive = request[2].get('connection', '').lower() != 'close'
+                await write_http_response(writer, status, keep_alive=keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+    
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            # Las conexiones keep-alive abiertas impiden que wait_closed termine
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+        # Terminar lo que ya estaba encolado antes de apagar
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout=30)
+            except asyncio.TimeoutError:
+                logger.warning(f"⚠️ {self.queue.qsize()} updates sin procesar al apagar")
+        for task in self._tasks:
+            task.cancel()
+
+
+async def run_webhook(app):
+    """Ciclo de vida de la aplicación en modo webhook"""
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = WebhookServer(
+        app, WEBHOOK_PATH, secret, max_queue=WEBHOOK_QUEUE_MAX, consumers=CONCURRENT_UPDATES
+    )
+    
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    try:
+        await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+        await app.bot.set_webhook(
+            url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=secret,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+            max_connections=min(100, max(1, CONCURRENT_UPDATES))
+        )
+        
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+        await stop_event.wait()
+    finally:
+        # El webhook queda registrado: Telegram guarda los updates mientras reiniciamos
+        await server.stop()
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
 def main():
     """Función principal"""
     logger.info("╔═══════════════════════════════════╗")
@@ -1625,19 +5153,41 @@ def main():
     logger.info("╚═══════════════════════════════════╝")
     
     bot = MusicBot()
-    app = Application.builder().token(TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .rate_limiter(OutboundScheduler(
+            per_second=OUTBOUND_PER_SECOND,
+            chat_per_second=OUTBOUND_CHAT_PER_SECOND,
+            chat_burst=OUTBOUND_CHAT_BURST,
+            group_per_minute=OUTBOUND_GROUP_PER_MINUTE,
+            max_retries=OUTBOUND_MAX_RETRIES,
+            headroom=OUTBOUND_HEADROOM,
+            metrics=bot.metrics,
+        ))
+        .post_init(bot.post_init)
+        .post_shutdown(bot.shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_BASE_URL}/bot").base_file_url(f"{TELEGRAM_BASE_URL}/file/bot")
+    app = builder.build()
     
     app.add_handler(CommandHandler("start", bot.start))
     app.add_handler(CommandHandler("help", bot.help_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_message))
     app.add_handler(CallbackQueryHandler(bot.handle_callback))
     app.add_error_handler(bot.error_handler)
+    app.job_queue.run_repeating(bot.sweep_sessions, interval=SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL)
     
     logger.info("✅ Bot iniciado correctamente")
     logger.info("🐺 Bot Musical Veronica activo")
     logger.info("⏹️ Presiona Ctrl+C para detener")
     
-    app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling(allowed_updates=ALLOWED_UPDATES, drop_pending_updates=DROP_PENDING_UPDATES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,16 @@
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+# bot_musical lee la configuración al importarse: las pruebas no tocan Telegram ni data/
+DATA_DIR = tempfile.mkdtemp(prefix='capelu-tests-')
+atexit.register(shutil.rmtree, DATA_DIR, ignore_errors=True)
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:offline')
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('DATA_DIR', DATA_DIR)
@@ -0,0 +1,21 @@
+"""Corre cada benchmark de tools/bench.py una vez, para que no se rompan sin que nadie lo note"""
+import asyncio
+import argparse
+
+import yt_dlp
+
+import bench
+import bot_musical
+
+
+def test_every_benchmark_runs():
+    youtube_dl = yt_dlp.YoutubeDL
+    rate_limit = bot_musical.RATE_LIMIT_PER_MINUTE
+    results = asyncio.run(bench.run(argparse.Namespace(filter=None, min_time=0)))
+    # build_benchmarks solo necesita el bot para cerrar sobre él
+    assert set(results) == set(bench.build_benchmarks(None))
+    for stats in results.values():
+        assert stats['iterations'] >= 1
+    # La corrida no deja el yt-dlp falso ni su configuración para las pruebas siguientes
+    assert yt_dlp.YoutubeDL is youtube_dl
+    assert bot_musical.RATE_LIMIT_PER_MINUTE == rate_limit
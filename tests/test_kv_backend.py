@@ -0,0 +1,152 @@
+"""KVBackend y el token bucket compartido.
+
+Cada prueba corre contra tools/fake_kv_server.py y, si TEST_REDIS_URL apunta
+a un Redis real (p. ej. redis://localhost:6379/15), también contra él: así
+TOKEN_BUCKET_SCRIPT se ejecuta de verdad y el servidor de prueba no puede
+divergir del script sin que falle alguna prueba. La base de TEST_REDIS_URL
+se vacía con FLUSHDB.
+"""
+import os
+import json
+import asyncio
+
+import pytest
+
+from bot_musical import KVBackend, KVError, SharedRateLimiter, TOKEN_BUCKET_SHA
+from fake_kv_server import FakeKVServer
+
+TEST_REDIS_URL = os.getenv('TEST_REDIS_URL')
+
+
+@pytest.fixture(params=['fake', 'redis'])
+def run(request):
+    """Ejecuta un escenario async(backend_factory) contra cada servidor"""
+    if request.param == 'redis' and not TEST_REDIS_URL:
+        pytest.skip('TEST_REDIS_URL no configurado')
+
+    def runner(scenario):
+        async def main():
+            server = None
+            if request.param == 'fake':
+                server = FakeKVServer()
+                url = f"redis://127.0.0.1:{await server.start(port=0)}/0"
+            else:
+                url = TEST_REDIS_URL
+            backends = []
+
+            def factory():
+                backend = KVBackend(url, session_ttl=60)
+                backends.append(backend)
+                return backend
+
+            admin = factory()
+            await admin.client.execute('FLUSHDB')
+            try:
+                return await scenario(factory)
+            finally:
+                await admin.client.execute('FLUSHDB')
+                for backend in backends:
+                    await backend.close()
+                if server:
+                    await server.stop()
+        return asyncio.run(main())
+    return runner
+
+
+def test_token_bucket_allows_capacity_then_waits(run):
+    async def scenario(factory):
+        backend = factory()
+        waits = [await backend.take_tokens(1, 1, 3, 3 / 60, 100, 100 / 60) for _ in range(4)]
+        assert waits[:3] == [0, 0, 0]
+        # Sin fichas: la espera es lo que tarda en recargarse una (60 / 3 s)
+        assert 19 < waits[3] <= 20
+    run(scenario)
+
+
+def test_token_bucket_global_limit_spans_users(run):
+    async def scenario(factory):
+        backend = factory()
+        waits = [await backend.take_tokens(user_id, 1, 5, 5 / 60, 2, 2 / 60) for user_id in range(3)]
+        assert waits[:2] == [0, 0]
+        assert waits[2] > 0
+    run(scenario)
+
+
+def test_token_bucket_loads_script_on_noscript(run):
+    async def scenario(factory):
+        backend = factory()
+        try:
+            await backend.client.execute('SCRIPT', 'FLUSH')
+        except KVError:
+            pass  # el servidor de prueba no cachea scripts: EVALSHA siempre lo conoce
+        assert await backend.take_tokens(7, 1, 1, 1, 10, 1) == 0
+        # Tras el EVAL de respaldo el script queda cacheado y EVALSHA funciona
+        assert float(await backend.client.execute(
+            'EVALSHA', TOKEN_BUCKET_SHA, 2, 'bucket:8', 'bucket:__global__', 1, 1, 1, 10, 1, 1000
+        )) == 0
+    run(scenario)
+
+
+def test_shared_rate_limiter_rounds_wait_up(run):
+    async def scenario(factory):
+        limiter = SharedRateLimiter(factory(), max_requests=2, window_seconds=60)
+        assert [await limiter.check(1) for _ in range(2)] == [0, 0]
+        assert await limiter.check(1) == 30
+    run(scenario)
+
+
+def test_shared_rate_limiter_clamps_cost_to_capacity(run):
+    async def scenario(factory):
+        limiter = SharedRateLimiter(factory(), max_requests=4, window_seconds=60)
+        assert await limiter.check(1, 5) == 0
+        assert await limiter.check(1, 5) == 60
+    run(scenario)
+
+
+def test_shared_rate_limiter_refund_restores_tokens(run):
+    async def scenario(factory):
+        limiter = SharedRateLimiter(factory(), max_requests=3, window_seconds=60)
+        assert await limiter.check(1, 3) == 0
+        await limiter.refund(1, 3)
+        await limiter.refund(1, 3)
+        assert await limiter.check(1, 3) == 0
+        assert await limiter.check(1) > 0
+    run(scenario)
+
+
+def test_session_save_load_and_delete(run):
+    async def scenario(factory):
+        backend = factory()
+        await backend.save_users([(1, '{"query": "queen"}', None)])
+        search, playlist = await backend.load_user(1)
+        assert search[0] == '{"query": "queen"}'
+        assert playlist is None
+        await backend.save_users([(1, None, None)])
+        assert await backend.load_user(1) == (None, None)
+    run(scenario)
+
+
+def test_concurrent_playlist_appends_are_all_kept(run):
+    async def scenario(factory):
+        replicas = [factory(), factory()]
+        await asyncio.gather(*(
+            replica.save_users([(1, None, [('append', {'id': f"{index}-{n}"})])])
+            for index, replica in enumerate(replicas) for n in range(10)
+        ))
+        _, playlist = await replicas[0].load_user(1)
+        assert sorted(song['id'] for song in json.loads(playlist)) == sorted(
+            f"{index}-{n}" for index in range(2) for n in range(10)
+        )
+    run(scenario)
+
+
+def test_playlist_replace_and_clear(run):
+    async def scenario(factory):
+        backend = factory()
+        await backend.save_users([(1, None, [('append', {'id': 'a'}), ('append', {'id': 'b'})])])
+        await backend.save_users([(1, None, [('replace', [{'id': 'c'}]), ('append', {'id': 'd'})])])
+        _, playlist = await backend.load_user(1)
+        assert json.loads(playlist) == [{'id': 'c'}, {'id': 'd'}]
+        await backend.save_users([(1, None, [('replace', [])])])
+        assert await backend.load_user(1) == (None, None)
+    run(scenario)
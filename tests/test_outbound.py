@@ -0,0 +1,56 @@
+"""OutboundScheduler: RetryAfter sin chat y cierre con envíos en vuelo."""
+import asyncio
+
+from telegram.error import RetryAfter
+
+from bot_musical import OutboundScheduler
+
+
+def test_chatless_retry_after_pauses_globally_without_parking():
+    async def main():
+        scheduler = OutboundScheduler()
+        calls = []
+
+        async def answer():
+            calls.append(('answer', asyncio.get_running_loop().time()))
+            if len(calls) == 1:
+                raise RetryAfter(1)
+            return 'answered'
+
+        async def send():
+            calls.append(('send', asyncio.get_running_loop().time()))
+            return 'sent'
+
+        first = asyncio.create_task(
+            scheduler.process_request(answer, (), {}, 'answerCallbackQuery', {}, None)
+        )
+        await asyncio.sleep(0.05)
+        assert None not in scheduler.parked
+        assert scheduler.global_paused_until > 0
+        second = asyncio.create_task(
+            scheduler.process_request(send, (), {}, 'sendMessage', {'chat_id': 5}, None)
+        )
+        assert await asyncio.gather(first, second) == ['answered', 'sent']
+        # El envío a otro chat también esperó la pausa global
+        assert calls[-1][1] - calls[0][1] >= 0.9
+        await scheduler.shutdown()
+    asyncio.run(main())
+
+
+def test_shutdown_waits_for_sends_in_flight():
+    async def main():
+        scheduler = OutboundScheduler()
+
+        async def slow_send():
+            await asyncio.sleep(0.1)
+            return 'sent'
+
+        request = asyncio.create_task(
+            scheduler.process_request(slow_send, (), {}, 'sendMessage', {'chat_id': 1}, None)
+        )
+        await asyncio.sleep(0.02)
+        assert scheduler._sending
+        await scheduler.shutdown()
+        assert not scheduler._sending
+        assert await request == 'sent'
+    asyncio.run(main())
@@ -0,0 +1,14 @@
+"""RateLimiter en memoria."""
+import asyncio
+
+from bot_musical import RateLimiter
+
+
+def test_cost_above_capacity_is_charged_as_full_bucket():
+    async def main():
+        limiter = RateLimiter(max_requests=4, window_seconds=60, global_max_requests=600)
+        assert await limiter.check(1, 5) == 0
+        assert await limiter.check(1, 5) == 60
+        await limiter.refund(1, 5)
+        assert await limiter.check(1, 5) == 0
+    asyncio.run(main())
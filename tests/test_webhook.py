@@ -0,0 +1,60 @@
+"""WebhookServer: respuestas a pedidos válidos y malformados"""
+import json
+import types
+import asyncio
+
+from bot_musical import WebhookServer
+
+SECRET = 'secreto'
+
+
+async def post(port, secret_header, body=b'{"update_id": 1}'):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(
+        b"POST /webhook HTTP/1.1\r\n"
+        b"Host: localhost\r\n"
+        b"X-Telegram-Bot-Api-Secret-Token: " + secret_header + b"\r\n"
+        b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+        b"Connection: close\r\n\r\n" + body
+    )
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1])
+
+
+def run_webhook(scenario):
+    async def main():
+        processed = []
+
+        async def process_update(update):
+            processed.append(update)
+
+        application = types.SimpleNamespace(bot=None, process_update=process_update)
+        server = WebhookServer(application, '/webhook', SECRET, consumers=1)
+        await server.start('127.0.0.1', 0)
+        port = server._server.sockets[0].getsockname()[1]
+        try:
+            return await scenario(port, processed)
+        finally:
+            await server.stop()
+    return asyncio.run(main())
+
+
+def test_wrong_and_non_ascii_secrets_are_forbidden():
+    async def scenario(port, processed):
+        assert await post(port, b'otro') == 403
+        assert await post(port, 'secr\xe9to'.encode('latin-1')) == 403
+        assert await post(port, b'\xff\xfe') == 403
+        assert processed == []
+    run_webhook(scenario)
+
+
+def test_valid_update_is_queued_and_bad_json_rejected():
+    async def scenario(port, processed):
+        assert await post(port, SECRET.encode()) == 200
+        assert await post(port, SECRET.encode(), body=b'[1, 2]') == 400
+        assert await post(port, SECRET.encode(), body=json.dumps({'update_id': 'x'}).encode()[:-2]) == 400
+        await asyncio.sleep(0.05)
+        assert [update.update_id for update in processed] == [1]
+    run_webhook(scenario)
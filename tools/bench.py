@@ -0,0 +1,314 @@
+"""Micro-benchmarks sin red de las partes calientes del bot.
+
+yt-dlp se reemplaza por tools/fake_ytdlp.py y los Update/CallbackQuery de
+Telegram por objetos mínimos que no hacen llamadas. De cada benchmark se
+informan ops/s, microsegundos por operación, el pico de memoria asignada
+dentro de una operación (tracemalloc) y los bloques de memoria que quedan
+retenidos por operación. Los resultados se guardan en JSON para comparar
+corridas:
+
+    python tools/bench.py                          # todo, guarda en bench-results/
+    python tools/bench.py -k callback -k keyboard  # solo los que contienen esos textos
+    python tools/bench.py --output antes.json
+    python tools/bench.py --compare antes.json     # muestra la diferencia con otra corrida
+"""
+import os
+import sys
+import gc
+import json
+import time
+import atexit
+import shutil
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+if __name__ == '__main__':
+    # bot_musical lee la configuración al importarse. Importado desde las
+    # pruebas el entorno lo pone tests/conftest.py y aquí no se toca nada.
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:offline')
+    if 'DATA_DIR' not in os.environ:
+        # Carpeta de datos desechable: se borra al salir
+        os.environ['DATA_DIR'] = tempfile.mkdtemp(prefix='bench-')
+        atexit.register(shutil.rmtree, os.environ['DATA_DIR'], ignore_errors=True)
+    os.environ.setdefault('STATE_BACKEND', 'memory')
+
+import fake_ytdlp  # noqa: E402
+import bot_musical as bm  # noqa: E402
+
+USER_ID = 1000
+# Sin límites de uso ni paginado perezoso: cada operación hace el trabajo completo
+BENCH_SETTINGS = {
+    'RATE_LIMIT_PER_MINUTE': 10 ** 8,
+    'RATE_LIMIT_GLOBAL_PER_MINUTE': 10 ** 8,
+    'SEARCH_LAZY_PAGING': False,
+}
+
+
+@contextlib.contextmanager
+def bench_settings():
+    """Aplica BENCH_SETTINGS y el yt-dlp falso mientras dura la corrida; al salir restaura todo"""
+    saved = {name: getattr(bm, name) for name in BENCH_SETTINGS}
+    youtube_dl = bm.yt_dlp.YoutubeDL
+    for name, value in BENCH_SETTINGS.items():
+        setattr(bm, name, value)
+    fake_ytdlp.install()
+    try:
+        yield
+    finally:
+        bm.yt_dlp.YoutubeDL = youtube_dl
+        for name, value in saved.items():
+            setattr(bm, name, value)
+
+
+class StubMessage:
+    """Message que guarda el último texto en lugar de llamar a la Bot API"""
+    def __init__(self, chat_id, message_id=1, text=''):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.audio = None
+
+    async def reply_text(self, text, **kwargs):
+        return StubMessage(self.chat_id, self.message_id + 1, text)
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        return self
+
+    async def reply_audio(self, **kwargs):
+        return StubMessage(self.chat_id, self.message_id + 1)
+
+
+class StubCallbackQuery:
+    def __init__(self, data, message):
+        self.data = data
+        self.message = message
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+    async def edit_message_text(self, text, **kwargs):
+        return await self.message.edit_text(text, **kwargs)
+
+
+class StubUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.first_name = 'Bench'
+
+
+class StubUpdate:
+    def __init__(self, user_id, text=None, callback_data=None):
+        self.effective_user = StubUser(user_id)
+        self.message = StubMessage(user_id, text=text or '')
+        self.callback_query = StubCallbackQuery(callback_data, self.message) if callback_data else None
+        self.effective_message = self.message
+
+
+def search_session(query='bench', count=bm.SEARCH_MAX_RESULTS, search_type='songs'):
+    return {
+        'query': query,
+        'results': [bm.SearchResult.from_entry(fake_ytdlp.search_entry(query, i)) for i in range(count)],
+        'timestamp': datetime.now(),
+        'search_type': search_type,
+        'page': 0,
+        'complete': True,
+    }
+
+
+def build_benchmarks(bot):
+    """Devuelve {nombre: función}; las funciones async se esperan en el loop"""
+    entries = [fake_ytdlp.search_entry('ingest', i) for i in range(100)]
+    results = search_session()['results']
+    limiter = bm.RateLimiter(max_requests=20, window_seconds=60, global_max_requests=10 ** 9)
+    counter = {'n': 0}
+
+    def from_entry():
+        return [bm.SearchResult.from_entry(entry) for entry in entries]
+
+    def keyboard():
+        return bot.create_results_keyboard(results, page=3, search_type='songs')
+
+    async def rate_limit():
+        counter['n'] += 1
+        return await limiter.check(counter['n'] % 10000)
+
+    async def search_stream():
+        counter['n'] += 1
+        return await bot.search_music(f"stream {counter['n']}")
+
+    def callback(data):
+        async def run():
+            if USER_ID not in bot.user_searches:
+                bot.user_searches[USER_ID] = search_session()
+            await bot.handle_callback(StubUpdate(USER_ID, callback_data=data), None)
+        return run
+
+    def search_message(cached):
+        async def run():
+            counter['n'] += 1
+            bot.user_searches[USER_ID] = {'state': 'waiting_search'}
+            query = 'cached' if cached else f"cold {counter['n']}"
+            await bot.handle_message(StubUpdate(USER_ID, text=query), None)
+        return run
+
+    def observe():
+        bot.metrics.observe('bot_search_seconds', 0.42, variant='songs')
+
+    return {
+        'ingest.from_entry_x100': from_entry,
+        'ingest.search_stream': search_stream,
+        'keyboard.results_page': keyboard,
+        'rate_limiter.check': rate_limit,
+        'callback.page': callback('page_songs_2'),
+        'callback.select': callback('select_songs_5'),
+        'callback.back_to_results': callback('back_to_results'),
+        'callback.menu_info': callback('menu_info'),
+        'message.search_cold': search_message(cached=False),
+        'message.search_cached': search_message(cached=True),
+        'metrics.observe': observe,
+    }
+
+
+async def call(fn):
+    result = fn()
+    if asyncio.iscoroutine(result):
+        result = await result
+    return result
+
+
+async def run_batch(fn, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await call(fn)
+    return time.perf_counter() - started
+
+
+async def measure(fn, min_time, alloc_iterations=100):
+    """Calibra las iteraciones para durar ~min_time, mide el tiempo y luego la memoria aparte"""
+    await call(fn)
+    iterations = 1
+    while True:
+        elapsed = await run_batch(fn, iterations)
+        if elapsed >= min_time / 10 or iterations >= 1 << 20:
+            break
+        iterations *= 2
+    iterations = max(1, int(iterations * min_time / max(elapsed, 1e-9)))
+
+    gc.collect()
+    elapsed = await run_batch(fn, iterations)
+
+    # tracemalloc frena mucho: la memoria se mide en una pasada aparte y más corta
+    alloc_iterations = min(alloc_iterations, iterations)
+    gc.collect()
+    tracemalloc.start()
+    blocks_before = sys.getallocatedblocks()
+    peak_total = 0
+    for _ in range(alloc_iterations):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        await call(fn)
+        peak_total += tracemalloc.get_traced_memory()[1] - current
+    blocks_after = sys.getallocatedblocks()
+    tracemalloc.stop()
+
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / elapsed,
+        'us_per_op': elapsed * 1e6 / iterations,
+        'peak_bytes_per_op': peak_total // alloc_iterations,
+        'blocks_per_op': (blocks_after - blocks_before) / alloc_iterations,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def run(options):
+    with bench_settings():
+        return await _run(options)
+
+
+async def _run(options):
+    bot = bm.MusicBot()
+    await bot.storage.start()
+    try:
+        benchmarks = build_benchmarks(bot)
+        selected = {
+            name: fn for name, fn in benchmarks.items()
+            if not options.filter or any(text in name for text in options.filter)
+        }
+        results = {}
+        for name, fn in selected.items():
+            results[name] = stats = await measure(fn, options.min_time)
+            print(
+                f"{name:<28} {stats['ops_per_sec']:>12,.0f} ops/s {stats['us_per_op']:>10.1f} µs/op "
+                f"{stats['peak_bytes_per_op']:>10,} B pico {stats['blocks_per_op']:>8.2f} bloques/op"
+            )
+    finally:
+        bot.search_executor.shutdown()
+        bot.search_ydl_pool.close()
+        bot.file_id_cache.close()
+        await bot.storage.close()
+    return results
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)['benchmarks']
+    print(f"\nComparación con {baseline_path} (ops/s):")
+    for name, stats in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        change = (stats['ops_per_sec'] / previous['ops_per_sec'] - 1) * 100
+        print(f"{name:<28} {previous['ops_per_sec']:>12,.0f} -> {stats['ops_per_sec']:>12,.0f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='filter', action='append', help='solo benchmarks que contengan este texto')
+    parser.add_argument('--min-time', type=float, default=0.5, help='segundos de medición por benchmark')
+    parser.add_argument('--output', help='archivo JSON de resultados (por defecto bench-results/<fecha>.json)')
+    parser.add_argument('--compare', help='JSON de una corrida anterior para comparar')
+    options = parser.parse_args()
+
+    logging.getLogger('bot_musical').setLevel(logging.WARNING)
+    results = asyncio.run(run(options))
+
+    output = options.output or os.path.join('bench-results', f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump({
+            'meta': {
+                'date': datetime.now().isoformat(timespec='seconds'),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'min_time': options.min_time,
+            },
+            'benchmarks': results,
+        }, output_file, indent=2)
+    print(f"\nResultados en {output}")
+
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == '__main__':
+    main()
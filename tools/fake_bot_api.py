@@ -0,0 +1,285 @@
+"""Bot API de Telegram local para probar el bot sin conexión.
+
+Responde los métodos que usa el bot (getMe, getUpdates, sendMessage,
+editMessageText, sendAudio, answerCallbackQuery, ...), guarda en memoria
+los mensajes enviados y aplica límites de flood como los de Telegram:
+por encima de --chat-rate mensajes/s en un chat o --global-rate en total
+responde 429 con retry_after. Uso:
+
+    python tools/fake_bot_api.py --port 8081
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081 python bot_musical.py
+
+Los updates se inyectan con POST /updates (un update JSON por petición) y
+GET /stats devuelve los contadores.
+"""
+import os
+import sys
+import json
+import time
+import email
+import email.policy
+import asyncio
+import argparse
+import urllib.parse
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:offline')
+
+from bot_musical import HttpRequestError, read_http_request, write_http_response  # noqa: E402
+
+
+class BotApiError(Exception):
+    def __init__(self, code, description, retry_after=None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+def parse_params(headers, body):
+    """Parámetros de la petición; los valores vienen codificados en JSON salvo los strings"""
+    content_type = headers.get('content-type', '')
+    params = {}
+    if content_type.startswith('multipart/form-data'):
+        message = email.message_from_bytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + body, policy=email.policy.HTTP
+        )
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True) or b''
+            if part.get_filename():
+                params[name] = {'filename': part.get_filename(), 'size': len(payload)}
+            else:
+                params[name] = payload.decode()
+    elif body:
+        params = dict(urllib.parse.parse_qsl(body.decode(), keep_blank_values=True))
+
+    for name, value in params.items():
+        if isinstance(value, str):
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                pass
+    return params
+
+
+class FakeBotApi:
+    """Estado en memoria de la Bot API: chats, mensajes, cola de updates y límites"""
+    def __init__(self, chat_rate=1.0, chat_burst=3, global_rate=30.0, retry_after=1):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_rate = global_rate
+        self.retry_after = retry_after
+        self.messages = {}
+        self.updates = asyncio.Queue()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.calls = defaultdict(int)
+        self.flood_errors = 0
+        self.audio_bytes = 0
+        self.edits_not_modified = 0
+        # Funciones llamadas con (método, chat_id, mensaje) tras cada envío o edición
+        self.listeners = []
+        self._buckets = {}
+        self._server = None
+        self._handlers = {}
+
+    def _take(self, key, capacity, rate):
+        now = time.monotonic()
+        tokens, ts = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - ts) * rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            raise BotApiError(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+        self._buckets[key] = (tokens - 1, now)
+
+    def _check_flood(self, chat_id):
+        if self.global_rate:
+            self._take(None, self.global_rate, self.global_rate)
+        if self.chat_rate and chat_id is not None:
+            self._take(chat_id, self.chat_burst, self.chat_rate)
+
+    def push_update(self, update):
+        """Encola un update (dict de la Bot API) para el próximo getUpdates"""
+        update = dict(update, update_id=self.next_update_id)
+        self.next_update_id += 1
+        self.updates.put_nowait(update)
+        return update['update_id']
+
+    def new_message_id(self):
+        self.next_message_id += 1
+        return self.next_message_id - 1
+
+    def _notify(self, method, chat_id, message):
+        for listener in self.listeners:
+            listener(method, chat_id, message)
+        return message
+
+    def _message(self, chat_id, **fields):
+        message = {
+            'message_id': self.new_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'from': self.me(),
+            **fields,
+        }
+        self.messages[(chat_id, message['message_id'])] = message
+        return message
+
+    @staticmethod
+    def me():
+        return {'id': 1, 'is_bot': True, 'first_name': 'Veronica', 'username': 'fake_music_bot'}
+
+    async def _get_updates(self, params):
+        offset = params.get('offset') or 0
+        timeout = float(params.get('timeout') or 0)
+        limit = params.get('limit') or 100
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout) if timeout else self.updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        while len(updates) < limit and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return [update for update in updates if update['update_id'] >= offset]
+
+    async def call(self, method, params):
+        self.calls[method] += 1
+        chat_id = params.get('chat_id')
+
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if method == 'getMe':
+            return self.me()
+        if method in ('deleteWebhook', 'setWebhook', 'setMyCommands', 'close', 'logOut'):
+            return True
+        if method == 'answerCallbackQuery':
+            self._check_flood(None)
+            return True
+
+        if chat_id is None:
+            raise BotApiError(400, 'Bad Request: chat_id is empty')
+        self._check_flood(chat_id)
+
+        if method == 'sendMessage':
+            message = self._message(chat_id, text=params.get('text', ''), reply_markup=params.get('reply_markup'))
+            return self._notify(method, chat_id, message)
+        if method == 'sendAudio':
+            audio = params.get('audio')
+            size = audio['size'] if isinstance(audio, dict) else 0
+            self.audio_bytes += size
+            message = self._message(chat_id, caption=params.get('caption', ''), reply_markup=params.get('reply_markup'), audio={
+                'file_id': f"audio-{self.next_message_id}",
+                'file_unique_id': f"u{self.next_message_id}",
+                'duration': 0,
+                'title': params.get('title', ''),
+                'file_size': size,
+            })
+            return self._notify(method, chat_id, message)
+        if method == 'editMessageText':
+            message = self.messages.get((chat_id, params.get('message_id')))
+            if message is None:
+                raise BotApiError(400, 'Bad Request: message to edit not found')
+            if 'text' not in message:
+                raise BotApiError(400, 'Bad Request: there is no text in the message to edit')
+            text = params.get('text', '')
+            markup = params.get('reply_markup')
+            if message.get('text') == text and message.get('reply_markup') == markup:
+                self.edits_not_modified += 1
+                raise BotApiError(400, 'Bad Request: message is not modified')
+            message['text'] = text
+            message['reply_markup'] = markup
+            message['edit_date'] = int(time.time())
+            return self._notify(method, chat_id, message)
+        raise BotApiError(404, 'Not Found: method not found')
+
+    def stats(self):
+        return {
+            'calls': dict(self.calls),
+            'flood_errors': self.flood_errors,
+            'messages': len(self.messages),
+            'audio_bytes': self.audio_bytes,
+            'edits_not_modified': self.edits_not_modified,
+            'pending_updates': self.updates.qsize(),
+        }
+
+    async def _respond(self, method, path, headers, body):
+        if path == '/updates' and method == 'POST':
+            return 200, {'ok': True, 'result': self.push_update(json.loads(body))}
+        if path == '/stats':
+            return 200, self.stats()
+
+        parts = path.split('?', 1)[0].strip('/').split('/')
+        if len(parts) != 2 or not parts[0].startswith('bot'):
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+        try:
+            params = parse_params(headers, body)
+            return 200, {'ok': True, 'result': await self.call(parts[1], params)}
+        except BotApiError as e:
+            response = {'ok': False, 'error_code': e.code, 'description': e.description}
+            if e.retry_after is not None:
+                self.flood_errors += 1
+                response['parameters'] = {'retry_after': e.retry_after}
+            return e.code, response
+
+    async def _handle_connection(self, reader, writer):
+        self._handlers[asyncio.current_task()] = writer
+        try:
+            while True:
+                try:
+                    request = await read_http_request(reader, max_body=64 * 1024 * 1024)
+                except HttpRequestError:
+                    await write_http_response(writer, 400, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                status, payload = await self._respond(*request)
+                await write_http_response(
+                    writer, status, json.dumps(payload).encode(), content_type='application/json'
+                )
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # stop() cancela las conexiones en espera; terminar sin error evita el log de asyncio
+            pass
+        finally:
+            self._handlers.pop(asyncio.current_task(), None)
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8081):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            handlers = list(self._handlers.items())
+            for task, writer in handlers:
+                writer.close()
+                # Los getUpdates con long polling quedan esperando updates: se cancelan
+                task.cancel()
+            await asyncio.gather(*(task for task, _ in handlers), return_exceptions=True)
+            await self._server.wait_closed()
+
+
+async def serve(options):
+    api = FakeBotApi(options.chat_rate, options.chat_burst, options.global_rate, options.retry_after)
+    port = await api.start(options.host, options.port)
+    print(f"Bot API de prueba en http://{options.host}:{port}")
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--chat-rate', type=float, default=1.0, help='mensajes/s por chat (0 sin límite)')
+    parser.add_argument('--chat-burst', type=int, default=3)
+    parser.add_argument('--global-rate', type=float, default=30.0, help='mensajes/s en total (0 sin límite)')
+    parser.add_argument('--retry-after', type=int, default=1)
+    options = parser.parse_args()
+    try:
+        asyncio.run(serve(options))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,229 @@
+"""Servidor clave-valor local que imita a Redis para probar STATE_BACKEND=redis.
+
+Implementa solo los comandos que usa el bot (PING, AUTH, SELECT, TIME, GET,
+SET, DEL, RPUSH, LRANGE, HMGET, HSET, PEXPIRE, MULTI/EXEC, EVALSHA/EVAL del
+token bucket, FLUSHALL/FLUSHDB), todo en memoria. Uso:
+
+    python tools/fake_kv_server.py --port 6390
+    STATE_BACKEND=redis STATE_URL=redis://127.0.0.1:6390/0 python bot_musical.py
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:offline')
+
+from bot_musical import TOKEN_BUCKET_SCRIPT, TOKEN_BUCKET_SHA  # noqa: E402
+
+
+class FakeKVServer:
+    """Servidor RESP en memoria; cada valor guarda su expiración opcional"""
+    def __init__(self):
+        self.data = {}
+        self.commands = 0
+        self._server = None
+        self._handlers = {}
+
+    def _get(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del self.data[key]
+            return None
+        return value
+
+    def _hash(self, key):
+        value = self._get(key)
+        if value is None:
+            value = {}
+            self.data[key] = (value, None)
+        return value
+
+    def _token_bucket(self, keys, args):
+        """Equivalente en Python de TOKEN_BUCKET_SCRIPT"""
+        cost, capacity, rate, global_capacity, global_rate = (float(arg) for arg in args[:5])
+        ttl_ms = int(args[5])
+        # Como redis.call('TIME'): la hora la pone el servidor
+        now = time.time()
+
+        def level(key, capacity, rate):
+            bucket = self._get(key) or {}
+            tokens = float(bucket.get('tokens', capacity))
+            ts = float(bucket.get('ts', now))
+            return min(capacity, tokens + max(0, now - ts) * rate)
+
+        tokens = level(keys[0], capacity, rate)
+        global_tokens = level(keys[1], global_capacity, global_rate)
+        wait = max((cost - tokens) / rate, (cost - global_tokens) / global_rate, 0)
+        if wait == 0:
+            tokens -= cost
+            global_tokens -= cost
+        self.data[keys[0]] = ({'tokens': str(tokens), 'ts': str(now)}, time.monotonic() + ttl_ms / 1000)
+        self._hash(keys[1]).update({'tokens': str(global_tokens), 'ts': str(now)})
+        return str(wait)
+
+    def execute(self, command):
+        name = command[0].upper()
+        args = command[1:]
+        self.commands += 1
+
+        if name == 'PING':
+            return 'PONG'
+        if name in ('AUTH', 'SELECT'):
+            return 'OK'
+        if name == 'TIME':
+            now = time.time()
+            return [str(int(now)), str(int(now % 1 * 1000000))]
+        if name in ('FLUSHALL', 'FLUSHDB'):
+            self.data.clear()
+            return 'OK'
+        if name == 'GET':
+            value = self._get(args[0])
+            return value if value is None or isinstance(value, str) else Exception('WRONGTYPE')
+        if name == 'SET':
+            expires_at = None
+            options = [arg.upper() for arg in args[2:]]
+            if 'PX' in options:
+                expires_at = time.monotonic() + int(args[2 + options.index('PX') + 1]) / 1000
+            elif 'EX' in options:
+                expires_at = time.monotonic() + int(args[2 + options.index('EX') + 1])
+            self.data[args[0]] = (args[1], expires_at)
+            return 'OK'
+        if name == 'DEL':
+            return sum(1 for key in args if self.data.pop(key, None) is not None)
+        if name == 'RPUSH':
+            items = self._get(args[0])
+            if items is None:
+                items = []
+                self.data[args[0]] = (items, None)
+            elif not isinstance(items, list):
+                return Exception('WRONGTYPE')
+            items.extend(args[1:])
+            return len(items)
+        if name == 'LRANGE':
+            items = self._get(args[0]) or []
+            if not isinstance(items, list):
+                return Exception('WRONGTYPE')
+            start, stop = int(args[1]), int(args[2])
+            start = max(0, start + len(items) if start < 0 else start)
+            stop = stop + len(items) if stop < 0 else stop
+            return items[start:stop + 1]
+        if name == 'HSET':
+            bucket = self._hash(args[0])
+            pairs = dict(zip(args[1::2], args[2::2]))
+            added = len(set(pairs) - set(bucket))
+            bucket.update(pairs)
+            return added
+        if name == 'HMGET':
+            bucket = self._get(args[0]) or {}
+            return [bucket.get(field) for field in args[1:]]
+        if name == 'PEXPIRE':
+            value = self._get(args[0])
+            if value is None:
+                return 0
+            self.data[args[0]] = (value, time.monotonic() + int(args[1]) / 1000)
+            return 1
+        if name in ('EVALSHA', 'EVAL'):
+            script = args[0]
+            known = script == TOKEN_BUCKET_SHA if name == 'EVALSHA' else script == TOKEN_BUCKET_SCRIPT
+            if not known:
+                return Exception('NOSCRIPT No matching script (el servidor de prueba solo conoce el token bucket)')
+            num_keys = int(args[1])
+            return self._token_bucket(args[2:2 + num_keys], args[2 + num_keys:])
+        return Exception(f"ERR unknown command '{command[0]}'")
+
+    @staticmethod
+    def encode(reply):
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, Exception):
+            return f"-{reply}\r\n".encode()
+        if isinstance(reply, int):
+            return f":{reply}\r\n".encode()
+        if isinstance(reply, list):
+            return f"*{len(reply)}\r\n".encode() + b''.join(FakeKVServer.encode(item) for item in reply)
+        if reply in ('OK', 'PONG', 'QUEUED'):
+            return f"+{reply}\r\n".encode()
+        data = reply.encode()
+        return f"${len(data)}\r\n".encode() + data + b'\r\n'
+
+    async def _read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.decode().split()
+        command = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            command.append((await reader.readexactly(size + 2))[:-2].decode())
+        return command
+
+    async def _handle(self, reader, writer):
+        self._handlers[asyncio.current_task()] = writer
+        # Comandos encolados entre MULTI y EXEC en esta conexión
+        queued = None
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if command is None:
+                    break
+                name = command[0].upper()
+                if name == 'MULTI':
+                    queued, reply = [], 'OK'
+                elif name == 'EXEC':
+                    # execute() no cede el loop: la transacción es atómica
+                    reply = [self.execute(queued_command) for queued_command in queued] if queued is not None \
+                        else Exception('ERR EXEC without MULTI')
+                    queued = None
+                elif queued is not None:
+                    queued.append(command)
+                    reply = 'QUEUED'
+                else:
+                    reply = self.execute(command)
+                writer.write(self.encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Cancelada al cerrar el loop; terminar sin error evita el log de asyncio
+            pass
+        finally:
+            self._handlers.pop(asyncio.current_task(), None)
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=6390):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            handlers = list(self._handlers.items())
+            for _, writer in handlers:
+                writer.close()
+            await asyncio.gather(*(task for task, _ in handlers), return_exceptions=True)
+            await self._server.wait_closed()
+
+
+async def serve(host, port):
+    server = FakeKVServer()
+    port = await server.start(host, port)
+    print(f"Servidor KV de prueba en redis://{host}:{port}/0")
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    options = parser.parse_args()
+    try:
+        asyncio.run(serve(options.host, options.port))
+    except KeyboardInterrupt:
+        pass
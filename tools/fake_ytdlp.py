@@ -0,0 +1,115 @@
+"""Sustituto determinista de yt_dlp.YoutubeDL para benchmarks y pruebas de carga sin red.
+
+Las búsquedas ("ytsearchN:texto") devuelven N entradas fijas derivadas del
+texto, y las descargas escriben un audio falso del tamaño pedido, llamando
+a los progress/postprocessor hooks igual que yt-dlp. La latencia se
+configura por variables de entorno para que la hereden los procesos de
+descarga:
+
+    FAKE_YTDLP_SEARCH_LATENCY    segundos por búsqueda (0)
+    FAKE_YTDLP_ENTRY_LATENCY     segundos por resultado entregado (0)
+    FAKE_YTDLP_DOWNLOAD_LATENCY  segundos por descarga (0)
+    FAKE_YTDLP_AUDIO_BYTES       tamaño del audio falso (262144)
+
+Uso: install() antes de crear el bot (o de que arranquen los workers).
+"""
+import os
+import re
+import time
+import hashlib
+
+SEARCH_LATENCY = float(os.getenv('FAKE_YTDLP_SEARCH_LATENCY', '0'))
+ENTRY_LATENCY = float(os.getenv('FAKE_YTDLP_ENTRY_LATENCY', '0'))
+DOWNLOAD_LATENCY = float(os.getenv('FAKE_YTDLP_DOWNLOAD_LATENCY', '0'))
+AUDIO_BYTES = int(os.getenv('FAKE_YTDLP_AUDIO_BYTES', str(256 * 1024)))
+
+
+def video_id(query, index):
+    """Id estable de 11 caracteres, como los de YouTube"""
+    return hashlib.sha1(f"{query}:{index}".encode()).hexdigest()[:11]
+
+
+def search_entry(query, index):
+    """Entrada "flat" de una búsqueda; un tercio dura más de 10 minutos (álbumes completos)"""
+    return {
+        'id': video_id(query, index),
+        'title': f"{query} - Tema {index + 1}",
+        'channel': f"Canal {index % 7}",
+        'duration': 600 + index * 13 if index % 3 == 0 else 120 + index * 7,
+        'url': f"https://www.youtube.com/watch?v={video_id(query, index)}",
+    }
+
+
+class FakeYoutubeDL:
+    """Implementa solo lo que usa el bot: extract_info, prepare_filename y close"""
+    def __init__(self, params=None):
+        self.params = dict(params or {})
+        outtmpl = self.params.get('outtmpl') or '%(title)s.%(ext)s'
+        self.params['outtmpl'] = outtmpl if isinstance(outtmpl, dict) else {'default': outtmpl}
+
+    def _search(self, count, query, process):
+        time.sleep(SEARCH_LATENCY)
+
+        def entries():
+            for index in range(count):
+                if ENTRY_LATENCY:
+                    time.sleep(ENTRY_LATENCY)
+                yield search_entry(query, index)
+
+        return {'_type': 'playlist', 'id': query, 'entries': list(entries()) if process else entries()}
+
+    def _ext(self):
+        for postprocessor in self.params.get('postprocessors') or []:
+            if postprocessor.get('key') == 'FFmpegExtractAudio':
+                return postprocessor.get('preferredcodec', 'mp3')
+        return 'webm'
+
+    def _hooks(self, name, status):
+        for hook in self.params.get(name) or []:
+            hook(status)
+
+    def _download(self, info):
+        steps = 4
+        for step in range(1, steps + 1):
+            time.sleep(DOWNLOAD_LATENCY / steps)
+            self._hooks('progress_hooks', {
+                'status': 'downloading', 'downloaded_bytes': AUDIO_BYTES * step // steps,
+                'total_bytes': AUDIO_BYTES, 'speed': AUDIO_BYTES / max(DOWNLOAD_LATENCY, 0.001), 'eta': 0,
+            })
+        self._hooks('postprocessor_hooks', {'status': 'started', 'postprocessor': 'ExtractAudio'})
+        path = self.prepare_filename(info).rsplit('.', 1)[0] + '.' + self._ext()
+        with open(path, 'wb') as audio:
+            audio.write(b'\0' * AUDIO_BYTES)
+        self._hooks('postprocessor_hooks', {'status': 'finished', 'postprocessor': 'ExtractAudio'})
+
+    def extract_info(self, url, download=True, process=True):
+        match = re.match(r'ytsearch(\d+):(.*)', url)
+        if match:
+            return self._search(int(match.group(1)), match.group(2), process)
+
+        video = url.rsplit('=', 1)[-1]
+        info = {
+            'id': video,
+            'title': f"Audio {video}",
+            'ext': 'webm',
+            'acodec': 'opus',
+            'duration': 180,
+            # Protocolo propio: el modo direct no aplica y se usa la descarga a archivo
+            'protocol': 'fake',
+            'url': f"fake://{video}",
+        }
+        if download:
+            self._download(info)
+        return info
+
+    def prepare_filename(self, info):
+        return self.params['outtmpl']['default'] % {'title': info['title'], 'ext': info['ext'], 'id': info['id']}
+
+    def close(self):
+        pass
+
+
+def install():
+    """Reemplaza yt_dlp.YoutubeDL en este proceso"""
+    import yt_dlp
+    yt_dlp.YoutubeDL = FakeYoutubeDL
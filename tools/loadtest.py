@@ -0,0 +1,434 @@
+"""Prueba de carga de punta a punta contra una Bot API y un yt-dlp falsos.
+
+Levanta tools/fake_bot_api.py en este proceso y el bot real en un
+subproceso apuntado a ella (TELEGRAM_BASE_URL), con yt-dlp reemplazado por
+tools/fake_ytdlp.py también en los workers de descarga. Cada sesión simula
+un usuario que recorre el flujo completo con updates reales de Telegram:
+
+    /start -> Canciones -> búsqueda -> página 2 -> elegir tema -> descargar
+           -> /start -> Crear playlist -> búsqueda -> agregar a la playlist
+
+Al final informa sesiones/s, percentiles de latencia por paso (desde que
+se entrega el update hasta que llega la respuesta que espera el usuario),
+fallas y la memoria (RSS) del bot y sus workers a lo largo de la corrida:
+
+    python tools/loadtest.py --sessions 2000 --concurrency 200
+    python tools/loadtest.py --sessions 500 --download-latency 3 --output carga.json
+    python tools/loadtest.py --no-flood-limits    # sin los límites de envío de Telegram
+
+El log del bot queda en <tmp>/bot.log (la ruta se muestra al terminar).
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:offline')
+
+# A nivel de módulo: los workers de descarga (spawn) re-importan este script y heredan el reemplazo
+import fake_ytdlp  # noqa: E402
+fake_ytdlp.install()
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+BASE_USER_ID = 10_000_000
+STEPS = ('start', 'menu', 'search', 'page', 'select', 'download', 'playlist_menu', 'playlist_search', 'playlist_add')
+# Textos con los que el bot avisa que no pudo completar la acción
+FAILURE_MARKERS = ('MATERIAL NO DISPONIBLE', 'Servidor ocupado', 'Búsqueda expirada', 'No encontré', '⏰', '❌')
+
+
+class StepFailed(Exception):
+    pass
+
+
+def buttons(message):
+    markup = (message or {}).get('reply_markup') or {}
+    return [button.get('callback_data') for row in markup.get('inline_keyboard', []) for button in row]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def process_rss(pid):
+    """RSS en bytes de un proceso (0 si ya terminó)"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def child_pids(pid):
+    """Descendientes de un proceso según /proc/<pid>/task/*/children"""
+    found = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return found
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as children:
+                for child in children.read().split():
+                    found.append(int(child))
+                    found.extend(child_pids(int(child)))
+        except OSError:
+            continue
+    return found
+
+
+class LoadDriver:
+    """Inyecta los updates de cada sesión y espera las respuestas del bot en la Bot API falsa"""
+    def __init__(self, api, step_timeout):
+        self.api = api
+        self.step_timeout = step_timeout
+        self.inboxes = {}
+        self.next_callback_id = 1
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.failure_reasons = defaultdict(int)
+        self.completed = 0
+        self.failed = 0
+        api.listeners.append(self._on_event)
+
+    def _on_event(self, method, chat_id, message):
+        inbox = self.inboxes.get(chat_id)
+        if inbox is not None:
+            # Copia: los mensajes editados después no deben cambiar lo que ya se recibió
+            inbox.put_nowait((method, json.loads(json.dumps(message))))
+
+    @staticmethod
+    def user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"Carga {user_id - BASE_USER_ID}", 'language_code': 'es'}
+
+    def send_text(self, user_id, text):
+        message = {
+            'message_id': self.api.new_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self.user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        self.api.push_update({'message': message})
+
+    def press(self, user_id, message, data):
+        if data not in buttons(message):
+            raise StepFailed(f"sin botón {data}")
+        self.next_callback_id += 1
+        self.api.push_update({'callback_query': {
+            'id': str(self.next_callback_id),
+            'from': self.user(user_id),
+            'message': message,
+            'chat_instance': str(user_id),
+            'data': data,
+        }})
+
+    async def expect(self, user_id, predicate):
+        """Primer mensaje enviado o editado en el chat que cumple predicate(método, mensaje)"""
+        inbox = self.inboxes[user_id]
+        deadline = time.monotonic() + self.step_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise StepFailed('timeout')
+            try:
+                method, message = await asyncio.wait_for(inbox.get(), remaining)
+            except asyncio.TimeoutError:
+                raise StepFailed('timeout')
+            if predicate(method, message):
+                return message
+            text = message.get('text') or ''
+            for marker in FAILURE_MARKERS:
+                if marker in text:
+                    raise StepFailed(marker)
+
+    async def step(self, name, user_id, action, predicate):
+        started = time.monotonic()
+        action()
+        message = await self.expect(user_id, predicate)
+        self.latencies[name].append(time.monotonic() - started)
+        return message
+
+    async def run_session(self, user_id, query):
+        self.inboxes[user_id] = asyncio.Queue()
+        name = None
+        try:
+            name = 'start'
+            menu = await self.step(name, user_id, lambda: self.send_text(user_id, '/start'),
+                                   lambda method, m: 'menu_search_songs' in buttons(m))
+
+            name = 'menu'
+            await self.step(name, user_id, lambda: self.press(user_id, menu, 'menu_search_songs'),
+                            lambda method, m: m['message_id'] == menu['message_id'] and 'BUSCAR' in m.get('text', ''))
+
+            name = 'search'
+            results = await self.step(name, user_id, lambda: self.send_text(user_id, query),
+                                      lambda method, m: 'select_songs_0' in buttons(m))
+
+            name = 'page'
+            page = await self.step(name, user_id, lambda: self.press(user_id, results, 'page_songs_1'),
+                                   lambda method, m: m['message_id'] == results['message_id']
+                                   and 'select_songs_10' in buttons(m))
+
+            pick = 10 + user_id % 10
+            name = 'select'
+            detail = await self.step(name, user_id, lambda: self.press(user_id, page, f"select_songs_{pick}"),
+                                     lambda method, m: f"download_{pick}" in buttons(m))
+
+            name = 'download'
+            await self.step(name, user_id, lambda: self.press(user_id, detail, f"download_{pick}"),
+                            lambda method, m: method == 'sendAudio')
+            detail = await self.expect(user_id, lambda method, m: m['message_id'] == detail['message_id']
+                                       and 'enviado' in m.get('text', ''))
+
+            # El detalle ya no tiene botones: la playlist se arma desde un /start nuevo
+            name = 'start'
+            menu = await self.step(name, user_id, lambda: self.send_text(user_id, '/start'),
+                                   lambda method, m: 'menu_create_playlist' in buttons(m))
+
+            name = 'playlist_menu'
+            await self.step(name, user_id, lambda: self.press(user_id, menu, 'menu_create_playlist'),
+                            lambda method, m: 'CREAR PLAYLIST' in m.get('text', ''))
+
+            name = 'playlist_search'
+            results = await self.step(name, user_id, lambda: self.send_text(user_id, f"{query} playlist"),
+                                      lambda method, m: 'select_playlist_0' in buttons(m))
+
+            name = 'playlist_add'
+            await self.step(name, user_id, lambda: self.press(user_id, results, 'select_playlist_0'),
+                            lambda method, m: 'AGREGADO A PLAYLIST' in m.get('text', ''))
+            self.completed += 1
+        except StepFailed as e:
+            self.failed += 1
+            self.failures[name] += 1
+            self.failure_reasons[f"{name}: {e}"] += 1
+        finally:
+            del self.inboxes[user_id]
+
+
+class MemorySampler:
+    """Muestrea cada cierto tiempo la RSS del bot y de sus procesos hijos"""
+    def __init__(self, pid, driver, interval):
+        self.pid = pid
+        self.driver = driver
+        self.interval = interval
+        self.samples = []
+        self._started = time.monotonic()
+
+    def sample(self):
+        children = child_pids(self.pid)
+        main = process_rss(self.pid)
+        self.samples.append({
+            'elapsed': round(time.monotonic() - self._started, 2),
+            'sessions': self.driver.completed + self.driver.failed,
+            'bot_rss': main,
+            'total_rss': main + sum(process_rss(pid) for pid in children),
+            'processes': 1 + len(children),
+        })
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+
+def bot_environment(options, base_url, workdir):
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_BOT_TOKEN': '1:loadtest',
+        'TELEGRAM_BASE_URL': base_url,
+        'DATA_DIR': os.path.join(workdir, 'data'),
+        'FAKE_YTDLP_SEARCH_LATENCY': str(options.search_latency),
+        'FAKE_YTDLP_DOWNLOAD_LATENCY': str(options.download_latency),
+        'FAKE_YTDLP_AUDIO_BYTES': str(options.audio_bytes),
+        'WEBHOOK_URL': '',
+        'METRICS_PORT': '0',
+    })
+    # Valores por defecto que se pueden pisar exportándolos antes de correr la prueba
+    env.setdefault('STATE_BACKEND', 'memory')
+    env.setdefault('RATE_LIMIT_PER_MINUTE', '1000000')
+    env.setdefault('RATE_LIMIT_GLOBAL_PER_MINUTE', '100000000')
+    if options.no_flood_limits:
+        env.setdefault('OUTBOUND_PER_SECOND', '1000000')
+        env.setdefault('OUTBOUND_CHAT_PER_SECOND', '1000000')
+        env.setdefault('OUTBOUND_CHAT_BURST', '1000000')
+    return env
+
+
+async def wait_ready(api, bot, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not api.calls['getUpdates']:
+        if bot.poll() is not None:
+            raise RuntimeError(f"el bot terminó al arrancar (código {bot.returncode})")
+        if time.monotonic() > deadline:
+            raise RuntimeError('el bot no empezó a pedir updates')
+        await asyncio.sleep(0.1)
+
+
+async def stop_bot(bot, timeout=30):
+    """SIGINT como Ctrl+C; el loop sigue atendiendo la Bot API mientras el bot se apaga"""
+    if bot.poll() is None:
+        bot.send_signal(signal.SIGINT)
+    deadline = time.monotonic() + timeout
+    while bot.poll() is None:
+        if time.monotonic() > deadline:
+            bot.kill()
+            bot.wait()
+            break
+        await asyncio.sleep(0.1)
+
+
+async def run(options):
+    flood = not options.no_flood_limits
+    api = FakeBotApi(
+        chat_rate=1.0 if flood else 0, chat_burst=3, global_rate=30.0 if flood else 0, retry_after=1
+    )
+    port = await api.start('127.0.0.1', 0)
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    log_path = os.path.join(workdir, 'bot.log')
+    with open(log_path, 'w') as log_file:
+        bot = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--bot'],
+            cwd=workdir, env=bot_environment(options, f"http://127.0.0.1:{port}", workdir),
+            stdout=log_file, stderr=subprocess.STDOUT,
+        )
+    driver = LoadDriver(api, options.step_timeout)
+    sampler = MemorySampler(bot.pid, driver, options.sample_interval)
+    sampler_task = None
+    try:
+        await wait_ready(api, bot)
+        print(f"Bot listo (pid {bot.pid}); corriendo {options.sessions} sesiones de a {options.concurrency}...")
+        sampler_task = asyncio.create_task(sampler.run())
+        limit = asyncio.Semaphore(options.concurrency)
+
+        async def session(index):
+            async with limit:
+                await driver.run_session(BASE_USER_ID + index, f"carga {index % options.distinct_queries}")
+
+        started = time.monotonic()
+        await asyncio.gather(*(session(index) for index in range(options.sessions)))
+        elapsed = time.monotonic() - started
+        sampler.sample()
+    finally:
+        if sampler_task:
+            sampler_task.cancel()
+        await stop_bot(bot)
+        await api.stop()
+    return report(options, driver, sampler, api, elapsed, log_path)
+
+
+def report(options, driver, sampler, api, elapsed, log_path):
+    sessions = driver.completed + driver.failed
+    steps = {}
+    for name in STEPS:
+        values = driver.latencies[name]
+        steps[name] = {
+            'count': len(values),
+            'failures': driver.failures[name],
+            'p50': percentile(values, 0.5),
+            'p90': percentile(values, 0.9),
+            'p99': percentile(values, 0.99),
+            'max': max(values) if values else None,
+        }
+    first, last = sampler.samples[0], sampler.samples[-1]
+    result = {
+        'sessions': sessions,
+        'completed': driver.completed,
+        'failed': driver.failed,
+        'seconds': elapsed,
+        'sessions_per_sec': sessions / elapsed,
+        'steps_per_sec': sum(len(values) for values in driver.latencies.values()) / elapsed,
+        'steps': steps,
+        'failure_reasons': dict(driver.failure_reasons),
+        'memory': sampler.samples,
+        'api': api.stats(),
+        'options': vars(options),
+    }
+
+    def ms(value):
+        return f"{value * 1000:>8.0f}" if value is not None else f"{'-':>8}"
+
+    print(
+        f"\n{driver.completed}/{sessions} sesiones completas en {elapsed:.1f} s: "
+        f"{result['sessions_per_sec']:.1f} sesiones/s, {result['steps_per_sec']:.1f} pasos/s"
+    )
+    print(f"\n{'paso':<16} {'n':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'fallas':>7}")
+    for name, stats in steps.items():
+        print(
+            f"{name:<16} {stats['count']:>6} {ms(stats['p50'])} {ms(stats['p90'])} "
+            f"{ms(stats['p99'])} {ms(stats['max'])} {stats['failures']:>7}"
+        )
+    for reason, count in sorted(driver.failure_reasons.items(), key=lambda item: -item[1]):
+        print(f"  ⚠️ {count} × {reason}")
+
+    print(f"\n{'t (s)':>8} {'sesiones':>9} {'bot MB':>8} {'total MB':>9} {'procesos':>9}")
+    step = max(1, len(sampler.samples) // 10)
+    for sample in sampler.samples[::step] + ([last] if (len(sampler.samples) - 1) % step else []):
+        print(
+            f"{sample['elapsed']:>8.1f} {sample['sessions']:>9} {sample['bot_rss'] / 2 ** 20:>8.1f} "
+            f"{sample['total_rss'] / 2 ** 20:>9.1f} {sample['processes']:>9}"
+        )
+    growth = (last['bot_rss'] - first['bot_rss']) / 2 ** 20
+    print(
+        f"Crecimiento del bot: {growth:+.1f} MB "
+        f"({growth * 1024 / max(sessions, 1):+.1f} KB por sesión); "
+        f"429 de la Bot API: {api.flood_errors}"
+    )
+    print(f"Log del bot: {log_path}")
+
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(result, output_file, indent=2)
+        print(f"Resultados en {options.output}")
+    return result
+
+
+def run_bot():
+    """Modo subproceso: el bot real, con logs reducidos para no medir la escritura del log"""
+    import bot_musical
+    logging.getLogger().setLevel(logging.WARNING)
+    bot_musical.main()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=1000, help='sesiones de usuario a simular')
+    parser.add_argument('--concurrency', type=int, default=100, help='sesiones en curso a la vez')
+    parser.add_argument('--distinct-queries', type=int, default=50,
+                        help='búsquedas distintas (menos = más aciertos de cache y descargas compartidas)')
+    parser.add_argument('--search-latency', type=float, default=0.3, help='segundos por búsqueda en yt-dlp falso')
+    parser.add_argument('--download-latency', type=float, default=1.0, help='segundos por descarga en yt-dlp falso')
+    parser.add_argument('--audio-bytes', type=int, default=256 * 1024, help='tamaño del audio falso')
+    parser.add_argument('--step-timeout', type=float, default=120, help='segundos máximos de espera por paso')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='segundos entre muestras de memoria')
+    parser.add_argument('--no-flood-limits', action='store_true',
+                        help='sin límites de envío en la Bot API ni en el bot (mide solo el bot)')
+    parser.add_argument('--output', help='archivo JSON con el resultado completo')
+    parser.add_argument('--bot', action='store_true', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.bot:
+        run_bot()
+        return
+    asyncio.run(run(options))
+
+
+if __name__ == '__main__':
+    main()